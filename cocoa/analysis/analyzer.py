@@ -6,8 +6,8 @@ import numpy as np
 
 from cocoa.core.entity import is_entity
 from cocoa.model.util import entropy, safe_div
-from cocoa.model.counter import build_vocabulary, count_ngrams
-from cocoa.model.ngram import MLENgramModel
+from cocoa.model.counter import build_vocabulary, count_ngrams_array
+from cocoa.model.ngram import ArrayNgramModel
 
 from core.tokenizer import tokenize
 
@@ -51,18 +51,13 @@ class Analyzer(object):
         return np.power(2, H)
 
     def total_entropy(self, model, sequences):
-        H = 0.
-        N = 0
-        for s in sequences:
-            h, n = model.entropy(s, average=False)
-            H += h
-            N += n
-        return H, N
+        H, N = model.entropies(sequences, average=False)
+        return np.sum(H), np.sum(N)
 
     def build_lm(self, sequences, n):
         vocab = build_vocabulary(1, *sequences)
-        counter = count_ngrams(n, vocab, sequences, pad_left=True, pad_right=False)
-        model = MLENgramModel(counter)
+        counter = count_ngrams_array(n, vocab, sequences, pad_left=True, pad_right=False)
+        model = ArrayNgramModel(counter)
         return model
 
     def sequence_perplexity(self, sequences, n=3):
@@ -0,0 +1,62 @@
+"""NLTK functions and data, loaded on first use.
+
+Importing nltk takes over a second, so modules that only need it on some code
+paths get it from here instead of importing it at the top. Data (punkt,
+stopwords, ...) is looked up in the local NLTK data directories only; nothing
+is downloaded at runtime. Install it once with e.g.
+    python -m nltk.downloader punkt stopwords averaged_perceptron_tagger
+"""
+
+_cache = {}
+
+def require(resource, package):
+    """Make sure the NLTK data `resource` is installed.
+
+    Raises:
+        LookupError: with the command that installs `package`.
+    """
+    import nltk
+    try:
+        nltk.data.find(resource)
+    except LookupError:
+        raise LookupError('NLTK data {} is not installed (searched {}). Install it with:\n'
+                '    python -m nltk.downloader {}'.format(resource, ', '.join(nltk.data.path), package))
+
+def _get(name, load):
+    if name not in _cache:
+        _cache[name] = load()
+    return _cache[name]
+
+def _load_word_tokenize():
+    require('tokenizers/punkt', 'punkt')
+    from nltk.tokenize import word_tokenize
+    return word_tokenize
+
+def _load_sent_tokenizer():
+    import nltk
+    require('tokenizers/punkt', 'punkt')
+    return nltk.data.load('tokenizers/punkt/english.pickle')
+
+def _load_pos_tag():
+    require('taggers/averaged_perceptron_tagger', 'averaged_perceptron_tagger')
+    from nltk import pos_tag
+    return pos_tag
+
+def _load_stopwords():
+    require('corpora/stopwords', 'stopwords')
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
+
+def word_tokenize(text):
+    return _get('word_tokenize', _load_word_tokenize)(text)
+
+def sent_tokenize(text):
+    return _get('sent_tokenizer', _load_sent_tokenizer).tokenize(text)
+
+def pos_tag(tokens):
+    return _get('pos_tag', _load_pos_tag)(tokens)
+
+def stopwords():
+    """English stopwords (frozenset).
+    """
+    return _get('stopwords', _load_stopwords)
@@ -1,15 +1,58 @@
-import nltk
-nltk.download('punkt')
-from nltk.tokenize import word_tokenize
-from nltk.tokenize.moses import MosesDetokenizer
+from collections import OrderedDict
 
-detokenizer = MosesDetokenizer()
+from word_tokenizer import word_tokenize
+
+detokenizer = None
 
 def detokenize(tokens):
+    global detokenizer
+    if detokenizer is None:
+        from nltk.tokenize.moses import MosesDetokenizer
+        detokenizer = MosesDetokenizer()
     return detokenizer.detokenize(tokens, return_str=True)
 
-def tokenize(utterance, lowercase=True):
+class TokenCache(object):
+    """LRU cache of tokenized utterances.
+
+    Dialogues repeat a lot of utterances ("deal", "ok", ...) and the same
+    utterance is tokenized again by preprocessing, parsing and evaluation.
+    Tokens are stored as tuples and returned as new lists, so callers may
+    modify them.
+    """
+    def __init__(self, tokenize, size=100000):
+        self.tokenize = tokenize
+        self.size = size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, utterance, lowercase=True):
+        key = (utterance, lowercase)
+        tokens = self.cache.pop(key, None)
+        if tokens is None:
+            self.misses += 1
+            tokens = tuple(self.tokenize(utterance, lowercase))
+            if len(self.cache) >= self.size:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+        self.cache[key] = tokens
+        return list(tokens)
+
+    def batch(self, utterances, lowercase=True):
+        return [self(utterance, lowercase) for utterance in utterances]
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = self.misses = 0
+
+def _tokenize(utterance, lowercase=True):
     if lowercase:
         utterance = utterance.lower()
     tokens = word_tokenize(utterance)
     return tokens
+
+tokenize = TokenCache(_tokenize)
+
+def tokenize_batch(utterances, lowercase=True):
+    return tokenize.batch(utterances, lowercase)
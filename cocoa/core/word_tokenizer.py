@@ -0,0 +1,161 @@
+"""A faster drop-in for nltk.word_tokenize.
+
+nltk.word_tokenize runs the Punkt sentence splitter (loading it from the
+pickle cache on every call) and then ~25 Treebank regex substitutions on every
+sentence. Chat messages are short and most of those rules cannot match them,
+e.g. quote rules on a message without quotes. Here every Treebank rule has a
+list of trigger substrings, at least one of which must be in the text for
+the rule to match; rules without a trigger in the text are skipped, and Punkt
+only runs on texts that contain a sentence-ending character. The output is
+the same as nltk.word_tokenize.
+
+The rules are those of NLTK 3.4 (Treebank rules plus the unicode quote rules
+that nltk.tokenize adds to them). If the installed NLTK tokenizes differently
+(see `_same_rules`), nltk.word_tokenize is used instead.
+"""
+
+import re
+
+from nltk_resources import require
+
+# Non-ASCII triggers are searched with a regex: `in` would try to decode
+# a byte string
+_OPEN_QUOTES = re.compile(u'[\xab\u201c\u2018\u201e]', re.U)
+_CLOSE_QUOTES = re.compile(u'[\xbb\u201d\u2019]', re.U)
+
+# (pattern, substitution, triggers, trigger regex)
+STARTING_QUOTES = [
+    (re.compile(u'([\xab\u201c\u2018\u201e]|[`]+)', re.U), r' \1 ', ('`',), _OPEN_QUOTES),
+    (re.compile(r'^\"'), r'``', ('"',)),
+    (re.compile(r'(``)'), r' \1 ', ('``',)),
+    (re.compile(r"([ \(\[{<])(\"|\'{2})"), r'\1 `` ', ('"', "''")),
+    (re.compile(r"(?i)(\')(?!re|ve|ll|m|t|s|d)(\w)\b", re.U), r'\1 \2', ("'",)),
+]
+
+PUNCTUATION = [
+    (re.compile(ur'([^\.])(\.)([\]\)}>"\'\u00bb\u201d\u2019 ]*)\s*$', re.U), r'\1 \2 \3 ', ('.',)),
+    (re.compile(r'([:,])([^\d])'), r' \1 \2', (':', ',')),
+    (re.compile(r'([:,])$'), r' \1 ', (':', ',')),
+    (re.compile(r'\.\.\.'), r' ... ', ('...',)),
+    (re.compile(r'[;@#$%&]'), r' \g<0> ', tuple(';@#$%&')),
+    (re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), r'\1 \2\3 ', ('.',)),
+    (re.compile(r'[?!]'), r' \g<0> ', ('?', '!')),
+    (re.compile(r"([^'])' "), r"\1 ' ", ("' ",)),
+]
+
+PARENS_BRACKETS = [
+    (re.compile(r'[\]\[\(\)\{\}\<\>]'), r' \g<0> ', tuple('[](){}<>')),
+]
+
+DOUBLE_DASHES = [
+    (re.compile(r'--'), r' -- ', ('--',)),
+]
+
+ENDING_QUOTES = [
+    (re.compile(u'([\xbb\u201d\u2019])', re.U), r' \1 ', (), _CLOSE_QUOTES),
+    (re.compile(r'"'), " '' ", ('"',)),
+    (re.compile(r'(\S)(\'\')'), r'\1 \2 ', ("''",)),
+    (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 ", ("'",)),
+    (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 ", ("'",)),
+]
+
+# Case-insensitive; triggers are matched against the lowercased text
+CONTRACTIONS = [
+    (re.compile(r'(?i)\b(can)(?#X)(not)\b'), ('cannot',)),
+    (re.compile(r"(?i)\b(d)(?#X)('ye)\b"), ("d'ye",)),
+    (re.compile(r'(?i)\b(gim)(?#X)(me)\b'), ('gimme',)),
+    (re.compile(r'(?i)\b(gon)(?#X)(na)\b'), ('gonna',)),
+    (re.compile(r'(?i)\b(got)(?#X)(ta)\b'), ('gotta',)),
+    (re.compile(r'(?i)\b(lem)(?#X)(me)\b'), ('lemme',)),
+    (re.compile(r"(?i)\b(mor)(?#X)('n)\b"), ("mor'n",)),
+    (re.compile(r'(?i)\b(wan)(?#X)(na)\s'), ('wanna',)),
+    (re.compile(r"(?i) ('t)(?#X)(is)\b"), ("'tis",)),
+    (re.compile(r"(?i) ('t)(?#X)(was)\b"), ("'twas",)),
+]
+
+def _triggered(rule, text):
+    for trigger in rule[2]:
+        if trigger in text:
+            return True
+    return len(rule) > 3 and rule[3].search(text) is not None
+
+def _apply(rules, text):
+    for rule in rules:
+        if _triggered(rule, text):
+            text = rule[0].sub(rule[1], text)
+    return text
+
+def treebank_tokenize(text):
+    """Same as nltk's TreebankWordTokenizer().tokenize(text).
+    """
+    text = _apply(STARTING_QUOTES, text)
+    text = _apply(PUNCTUATION, text)
+    text = _apply(PARENS_BRACKETS, text)
+    text = _apply(DOUBLE_DASHES, text)
+    text = " " + text + " "
+    text = _apply(ENDING_QUOTES, text)
+    lower = text.lower()
+    for regexp, triggers in CONTRACTIONS:
+        for trigger in triggers:
+            if trigger in lower:
+                text = regexp.sub(r' \1 \2 ', text)
+                break
+    return text.split()
+
+def _same_rules(tokenizer):
+    """Check that NLTK's treebank tokenizer uses the rules above.
+    """
+    def patterns(rules):
+        return [(r[0].pattern, r[0].flags, r[1]) for r in rules]
+    try:
+        nltk_rules = (
+            patterns(tokenizer.STARTING_QUOTES),
+            patterns(tokenizer.PUNCTUATION),
+            patterns([tokenizer.PARENS_BRACKETS]),
+            patterns([tokenizer.DOUBLE_DASHES]),
+            patterns(tokenizer.ENDING_QUOTES),
+            [r.pattern for r in tokenizer.CONTRACTIONS2 + tokenizer.CONTRACTIONS3],
+            )
+    except (AttributeError, TypeError):
+        return False
+    return nltk_rules == (
+            patterns(STARTING_QUOTES),
+            patterns(PUNCTUATION),
+            patterns(PARENS_BRACKETS),
+            patterns(DOUBLE_DASHES),
+            patterns(ENDING_QUOTES),
+            [r[0].pattern for r in CONTRACTIONS],
+            )
+
+_tokenize = None
+
+def _load():
+    import nltk
+    from nltk.tokenize import _treebank_word_tokenizer
+    require('tokenizers/punkt', 'punkt')
+    if not _same_rules(_treebank_word_tokenizer):
+        print 'WARNING: NLTK {} tokenizer rules differ from NLTK 3.4; using nltk.word_tokenize'.format(nltk.__version__)
+        from nltk.tokenize import word_tokenize
+        return word_tokenize
+
+    punkt = nltk.data.load('tokenizers/punkt/english.pickle')
+    # Byte strings so that `in` works on utf-8 encoded text too
+    sent_end_chars = [str(c) for c in punkt._lang_vars.sent_end_chars]
+
+    def word_tokenize(text):
+        for c in sent_end_chars:
+            if c in text:
+                return [token for sent in punkt.tokenize(text) for token in treebank_tokenize(sent)]
+        # Without a sentence-ending character Punkt returns the whole text,
+        # minus trailing whitespace
+        return treebank_tokenize(text.rstrip())
+
+    return word_tokenize
+
+def word_tokenize(text):
+    """Same as nltk.word_tokenize(text).
+    """
+    global _tokenize
+    if _tokenize is None:
+        _tokenize = _load()
+    return _tokenize(text)
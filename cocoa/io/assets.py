@@ -0,0 +1,108 @@
+"""Build assets once and share them between processes.
+
+Assets (e.g. TF-IDF matrices, template columns, model weights) are built into a
+cache directory as .npy files and loaded memory-mapped, so that several workers
+serving the same systems share the pages through the OS instead of each holding
+its own copy.
+"""
+
+import os
+import fcntl
+import hashlib
+import shutil
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from cocoa.io.utils import read_pickle, write_pickle
+
+def write_arrays(path, arrays):
+    """Save a dict of numpy arrays as one .npy file per array.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(path, '%s.npy' % name), np.ascontiguousarray(array))
+    write_pickle(sorted(arrays.keys()), os.path.join(path, 'arrays.pkl'))
+
+def read_arrays(path, mmap_mode='r'):
+    """Load arrays saved by `write_arrays`, memory-mapped by default.
+    """
+    names = read_pickle(os.path.join(path, 'arrays.pkl'))
+    return {name: np.load(os.path.join(path, '%s.npy' % name), mmap_mode=mmap_mode) for name in names}
+
+def csr_to_arrays(matrix, prefix):
+    return {
+            '%s.data' % prefix: matrix.data,
+            '%s.indices' % prefix: matrix.indices,
+            '%s.indptr' % prefix: matrix.indptr,
+            '%s.shape' % prefix: np.array(matrix.shape, dtype=np.int64),
+            }
+
+def arrays_to_csr(arrays, prefix):
+    shape = tuple(int(x) for x in arrays['%s.shape' % prefix])
+    return csr_matrix((arrays['%s.data' % prefix], arrays['%s.indices' % prefix], arrays['%s.indptr' % prefix]), shape=shape, copy=False)
+
+
+class AssetRegistry(object):
+    """Builds each asset once into `cache_dir` and loads it in every process.
+
+    An asset is identified by its name and the files it is built from, and is
+    rebuilt when any of them changes. The first process to request an asset
+    builds it while holding a lock; the others wait and then load the same
+    files. Loaded assets are also cached per process, so systems sharing an
+    asset in one process get the same object.
+    """
+    _loaded = {}
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, name, sources):
+        h = hashlib.sha1(name)
+        for source in sources:
+            stat = os.stat(source)
+            h.update('%s:%d:%d' % (os.path.abspath(source), stat.st_size, int(stat.st_mtime)))
+        return '%s-%s' % (name, h.hexdigest()[:16])
+
+    def _build(self, path, build):
+        lock_file = open(path + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.isdir(path):
+                return
+            tmp_path = '%s.tmp%d' % (path, os.getpid())
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            os.makedirs(tmp_path)
+            build(tmp_path)
+            os.rename(tmp_path, path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def get(self, name, sources, load, build=None, key=()):
+        """Return the asset `name` built from the files `sources`.
+
+        Args:
+            load (function): `load(path)` returns the asset from its directory.
+                If `build` is None, it is called as `load()` and the asset is
+                only cached in this process.
+            build (function): `build(path)` writes the asset to the directory.
+            key (tuple): other arguments `load` depends on (e.g. whether the
+                model is on GPU); assets loaded with different keys are not
+                shared in this process.
+        """
+        asset_key = self.key(name, sources)
+        cache_key = (os.path.abspath(self.cache_dir), asset_key) + tuple(key)
+        if not cache_key in self._loaded:
+            if build is None:
+                asset = load()
+            else:
+                path = os.path.join(self.cache_dir, asset_key)
+                if not os.path.isdir(path):
+                    self._build(path, build)
+                asset = load(path)
+            self._loaded[cache_key] = asset
+        return self._loaded[cache_key]
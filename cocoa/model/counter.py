@@ -11,6 +11,7 @@ from collections import Counter, defaultdict
 from copy import copy
 from itertools import chain
 
+import numpy as np
 from nltk.util import ngrams
 from nltk.probability import FreqDist, ConditionalFreqDist
 from nltk import compat
@@ -27,6 +28,12 @@ def count_ngrams(order, vocabulary, training_sents, **counter_kwargs):
     return counter
 
 
+def count_ngrams_array(order, vocabulary, training_sents, **counter_kwargs):
+    counter = ArrayNgramCounter(order, vocabulary, **counter_kwargs)
+    counter.train_counts(training_sents)
+    return counter
+
+
 @compat.python_2_unicode_compatible
 class NgramModelVocabulary(Counter):
     """Stores language model vocabulary.
@@ -158,3 +165,163 @@ class NgramCounter(object):
         :type sequence: any iterable
         """
         return ngrams(sequence, self.order, **self.ngrams_kwargs)
+
+
+@compat.python_2_unicode_compatible
+class ArrayNgramCounter(NgramCounter):
+    """Counts ngrams in sorted integer arrays instead of ConditionalFreqDists.
+
+    Words are integer-encoded and an ngram of order k is packed into a single
+    int64 key in base V (the number of word ids), so that the keys of all
+    ngrams sharing a context are contiguous once sorted. For each order we
+    keep the sorted unique keys with their counts, plus the sorted context keys
+    with their total counts; lookups are then `np.searchsorted` over many
+    ngrams at once.
+    """
+
+    def __init__(self, order, vocabulary, unk_cutoff=None, unk_label="<UNK>", **ngrams_kwargs):
+        super(ArrayNgramCounter, self).__init__(order, vocabulary, unk_cutoff=unk_cutoff, unk_label=unk_label, **ngrams_kwargs)
+        # Replaced by the arrays below
+        self.ngrams = None
+        self.unigrams = None
+        self._build_word_index()
+        self.keys = {}
+        self.counts = {}
+        self.context_keys = {}
+        self.context_counts = {}
+        for k in range(2, self.order + 1):
+            self._set_counts(k, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.unigram_counts = np.zeros(len(self.words), dtype=np.int64)
+
+    @classmethod
+    def from_counter(cls, counter):
+        """Convert a trained `NgramCounter` (e.g. from an old pickle).
+        """
+        # The pickled vocabulary is not reliable (Counter subclasses are
+        # unpickled without their cutoff), so rebuild it from the counts.
+        words = set(counter.unigrams)
+        for k in range(2, counter.order + 1):
+            for context, freqdist in counter.ngrams[k].iteritems():
+                words.update(context)
+                words.update(freqdist)
+        vocabulary = NgramModelVocabulary(1, words)
+        new_counter = cls(counter.order, vocabulary, unk_label=counter.unk_label, **counter.ngrams_kwargs)
+        for k in range(2, counter.order + 1):
+            ngrams = []
+            counts = []
+            for context, freqdist in counter.ngrams[k].iteritems():
+                for word, count in freqdist.iteritems():
+                    ngrams.append(new_counter.encode(context + (word,)))
+                    counts.append(count)
+            ngrams = np.array(ngrams, dtype=np.int64).reshape(-1, k)
+            new_counter._add_counts(k, new_counter.pack(ngrams), np.array(counts, dtype=np.int64))
+        for word, count in counter.unigrams.iteritems():
+            new_counter.unigram_counts[new_counter.word_to_id.get(word, new_counter.unk_id)] += count
+        return new_counter
+
+    def _build_word_index(self):
+        words = set(word for word in self.vocabulary if word in self.vocabulary)
+        words.add(self.unk_label)
+        self.words = sorted(words)
+        self.word_to_id = {word: i for i, word in enumerate(self.words)}
+        self.unk_id = self.word_to_id[self.unk_label]
+        self.base = len(self.words)
+        if float(self.base) ** self.order >= 2 ** 63:
+            raise ValueError("Vocabulary of size {0} is too large to pack {1}-grams in int64".format(self.base, self.order))
+
+    def encode(self, words):
+        """Map words to ids, where words not in the vocabulary are unknown.
+        """
+        return [self.word_to_id.get(word, self.unk_id) for word in words]
+
+    def pack(self, ngrams):
+        """Pack rows of word ids of shape (N, k) into int64 keys of shape (N,).
+        """
+        keys = np.zeros(ngrams.shape[0], dtype=np.int64)
+        for j in range(ngrams.shape[1]):
+            keys = keys * self.base + ngrams[:, j]
+        return keys
+
+    def to_ngram_array(self, texts):
+        """Return all (padded) ngrams of `texts` as an (N, order) array.
+
+        Same ngrams as `to_ngrams`. Also returns the index of the text each
+        ngram comes from, and the padded word ids of texts with ngrams.
+        """
+        left = self.order - 1 if self.ngrams_kwargs['pad_left'] else 0
+        right = self.order - 1 if self.ngrams_kwargs['pad_right'] else 0
+        lpad = [self.word_to_id.get(self.ngrams_kwargs.get('left_pad_symbol'), self.unk_id)] * left
+        rpad = [self.word_to_id.get(self.ngrams_kwargs.get('right_pad_symbol'), self.unk_id)] * right
+
+        padded = [lpad + self.encode(text) + rpad for text in texts]
+        lengths = np.array([len(p) for p in padded], dtype=np.int64)
+        num_ngrams = np.maximum(lengths - self.order + 1, 0)
+        ids = np.array([i for p in padded for i in p], dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+
+        text_ids = np.repeat(np.arange(len(padded)), num_ngrams)
+        # Position of each ngram within its text
+        positions = np.arange(num_ngrams.sum()) - np.repeat(np.cumsum(num_ngrams) - num_ngrams, num_ngrams)
+        starts = offsets[text_ids] + positions
+        ngrams = ids[starts[:, None] + np.arange(self.order)[None, :]].reshape(-1, self.order)
+
+        has_ngrams = np.repeat(num_ngrams > 0, lengths)
+        return ngrams, text_ids, ids[has_ngrams]
+
+    def _set_counts(self, k, keys, counts):
+        self.keys[k] = keys
+        self.counts[k] = counts
+        contexts = keys // self.base
+        self.context_keys[k], starts = np.unique(contexts, return_index=True)
+        if len(keys) > 0:
+            self.context_counts[k] = np.add.reduceat(counts, starts)
+        else:
+            self.context_counts[k] = np.zeros(0, dtype=np.int64)
+
+    def _add_counts(self, k, keys, counts):
+        keys = np.concatenate((self.keys[k], keys))
+        counts = np.concatenate((self.counts[k], counts))
+        keys, inverse = np.unique(keys, return_inverse=True)
+        self._set_counts(k, keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64))
+
+    def train_counts(self, training_text):
+        # Note here "1" indicates an empty vocabulary!
+        # See NgramModelVocabulary __len__ method for more.
+        if len(self.vocabulary) <= 1:
+            raise EmptyVocabularyError("Cannot start counting ngrams until "
+                                       "vocabulary contains more than one item.")
+
+        ngrams, _, words = self.to_ngram_array(training_text)
+        for k in range(2, self.order + 1):
+            keys, counts = np.unique(self.pack(ngrams[:, self.order-k:]), return_counts=True)
+            self._add_counts(k, keys, counts)
+        self.unigram_counts += np.bincount(words, minlength=len(self.words))
+
+    def _lookup(self, sorted_keys, values, keys):
+        if len(sorted_keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+        index = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[index] == keys, values[index], 0)
+
+    def ngram_counts(self, ngrams):
+        """Counts of rows in an (N, k) array of word ids.
+        """
+        k = ngrams.shape[1]
+        return self._lookup(self.keys[k], self.counts[k], self.pack(ngrams))
+
+    def context_totals(self, contexts):
+        """Total counts of ngrams following each row of an (N, k-1) array of word ids.
+        """
+        k = contexts.shape[1] + 1
+        return self._lookup(self.context_keys[k], self.context_counts[k], self.pack(contexts))
+
+    def continuations(self, context):
+        """Return ids and counts of words following `context` (a sequence of word ids).
+        """
+        k = len(context) + 1
+        if not k in self.keys:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        key = self.pack(np.array([context], dtype=np.int64))[0] * self.base
+        keys = self.keys[k]
+        lo, hi = np.searchsorted(keys, [key, key + self.base])
+        return keys[lo:hi] % self.base, self.counts[k][lo:hi]
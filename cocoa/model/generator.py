@@ -1,66 +1,188 @@
+import os
 import numpy as np
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 from cocoa.core.util import read_pickle, write_pickle
-from cocoa.model.counter import build_vocabulary, count_ngrams
-from cocoa.model.ngram import MLENgramModel
+from cocoa.io.assets import write_arrays, read_arrays, csr_to_arrays, arrays_to_csr
 
 from core.tokenizer import detokenize
 
+class TemplateIndex(object):
+    """Columnar view of the templates for fast filtering.
+
+    Categorical columns are integer-coded and each value has a precomputed
+    boolean mask over rows, so filters are combined with numpy ops instead of
+    building pandas Series on every query.
+    """
+    def __init__(self, templates, columns=(), arrays=None, values=None):
+        self.templates = templates
+        self.size = templates.shape[0]
+        self.ids = templates['id'].values
+        self.row_of_id = {id_: row for row, id_ in enumerate(self.ids)}
+        self.all_rows = self._readonly(np.ones(self.size, dtype=bool))
+        self.no_rows = self._readonly(np.zeros(self.size, dtype=bool))
+        self.codes = {}
+        self.values = {}
+        self.mask_arrays = {}
+        self.masks = {}
+        if arrays is not None:
+            # Loaded by from_arrays
+            for column, column_values in values.iteritems():
+                self._set_column(column, arrays['codes.%s' % column], column_values, arrays['masks.%s' % column])
+        else:
+            for column in columns:
+                if column in templates.columns:
+                    self.add_column(column)
+
+    @classmethod
+    def _readonly(cls, array):
+        # Masks are shared by all sessions
+        array.flags.writeable = False
+        return array
+
+    def _set_column(self, column, codes, values, mask_array):
+        self.codes[column] = codes
+        self.values[column] = values
+        self.mask_arrays[column] = mask_array
+        self.masks[column] = {value: self._readonly(mask_array[i]) for i, value in enumerate(values)}
+
+    def add_column(self, column):
+        codes, uniques = pd.factorize(self.templates[column])
+        codes = codes.astype(np.int32)
+        mask_array = codes[None, :] == np.arange(len(uniques), dtype=np.int32)[:, None]
+        self._set_column(column, codes, list(uniques), mask_array)
+
+    def to_arrays(self):
+        """Return the arrays of all coded columns and their values.
+        """
+        arrays = {}
+        for column in self.codes:
+            arrays['codes.%s' % column] = self.codes[column]
+            arrays['masks.%s' % column] = self.mask_arrays[column]
+        return arrays, dict(self.values)
+
+    @classmethod
+    def from_arrays(cls, templates, arrays, values):
+        return cls(templates, arrays=arrays, values=values)
+
+    def mask(self, column, value):
+        if not column in self.masks:
+            self.add_column(column)
+        return self.masks[column].get(value, self.no_rows)
+
+    def used_mask(self, used_templates):
+        if isinstance(used_templates, UsedTemplates):
+            return used_templates.mask
+        mask = np.zeros(self.size, dtype=bool)
+        rows = [self.row_of_id[id_] for id_ in used_templates if id_ in self.row_of_id]
+        mask[rows] = True
+        return mask
+
+class UsedTemplates(object):
+    """Ids of templates used in a session, mirrored as a row mask.
+
+    The mask is updated incrementally as templates are added so that
+    filtering does not need to look up all used ids on every turn.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.ids = set()
+        self.mask = np.zeros(index.size, dtype=bool)
+
+    def add(self, template_id):
+        self.ids.add(template_id)
+        row = self.index.row_of_id.get(template_id)
+        if row is not None:
+            self.mask[row] = True
+
+    def __contains__(self, template_id):
+        return template_id in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
 class Generator(object):
-    def __init__(self, templates):
+    # Columns used in get_filter; masks of other columns are built on demand
+    filter_columns = ()
+
+    def __init__(self, templates, index=None, vectorizer=None, tfidf_matrix=None):
         self.templates = templates.templates
-        self.vectorizer = TfidfVectorizer()
-        self.build_tfidf()
+        self.index = index or TemplateIndex(self.templates, self.filter_columns)
+        self.logp = self.templates['logp'].values
+        if vectorizer is None:
+            self.vectorizer = TfidfVectorizer()
+            self.build_tfidf()
+        else:
+            self.vectorizer = vectorizer
+            self.tfidf_matrix = tfidf_matrix
 
     def build_tfidf(self):
         documents = self.templates['context'].values
         self.tfidf_matrix = self.vectorizer.fit_transform(documents)
 
+    def write_assets(self, path):
+        """Write the TF-IDF matrix and template columns as arrays to `path`.
+        """
+        arrays, values = self.index.to_arrays()
+        arrays.update(csr_to_arrays(self.tfidf_matrix, 'tfidf'))
+        write_arrays(path, arrays)
+        write_pickle({'templates': self.templates, 'vectorizer': self.vectorizer, 'values': values},
+                os.path.join(path, 'generator.pkl'))
+
+    @classmethod
+    def from_assets(cls, path):
+        """Load a generator written by `write_assets`, with arrays memory-mapped.
+        """
+        data = read_pickle(os.path.join(path, 'generator.pkl'))
+        arrays = read_arrays(path)
+        templates = Templates(templates=data['templates'], finalized=True)
+        index = TemplateIndex.from_arrays(templates.templates, arrays, data['values'])
+        return cls(templates, index=index, vectorizer=data['vectorizer'], tfidf_matrix=arrays_to_csr(arrays, 'tfidf'))
+
+    def new_used_templates(self):
+        return UsedTemplates(self.index)
+
     def _add_filter(self, locs, cond):
         locs.append(locs[-1] & cond)
 
     def _select_filter(self, locs):
-        print [np.sum(loc) for loc in locs]
         for loc in locs[::-1]:
-            if np.sum(loc) > 0:
+            if loc.any():
                 return loc
         return locs[0]
 
     def get_filter(self, used_templates=None):
         if used_templates:
-            loc = (~self.templates.id.isin(used_templates))
-            if np.sum(loc) > 0:
+            loc = ~self.index.used_mask(used_templates)
+            if loc.any():
                 return loc
         # All templates
-        return self.templates.id.notnull()
+        return self.index.all_rows
 
     def retrieve(self, context, used_templates=None, topk=20, T=1., **kwargs):
         loc = self.get_filter(used_templates=used_templates, **kwargs)
         if loc is None:
             return None
+        rows = np.flatnonzero(loc)
 
         if isinstance(context, list):
             context = detokenize(context)
         features = self.vectorizer.transform([context])
         scores = self.tfidf_matrix * features.T
-        scores = scores.todense()[loc]
-        scores = np.squeeze(np.array(scores), axis=1)
-        ids = np.argsort(scores)[::-1][:topk]
-
-        candidates = self.templates[loc]
-        candidates = candidates.iloc[ids]
-        rows = self.templates[loc]
-        rows = rows.iloc[ids]
-        logp = rows['logp'].values
+        scores = scores.toarray()[rows, 0]
+        ids = rows[np.argsort(scores)[::-1][:topk]]
+        logp = self.logp[ids]
 
-        return self.sample(logp, candidates, T)
+        return self.sample(logp, ids, T)
 
-    def sample(self, scores, templates, T=1.):
+    def sample(self, scores, rows, T=1.):
         probs = self.softmax(scores, T=T)
         template_id = np.random.multinomial(1, probs).argmax()
-        template = templates.iloc[template_id]
+        template = self.templates.iloc[rows[template_id]]
         return template
 
     def softmax(self, scores, T=1.):
@@ -94,11 +216,15 @@ class Templates(object):
         write_pickle(self.templates, output)
 
     def score_templates(self):
+        # nltk (used by the n-gram model) is slow to import and only needed here
+        from cocoa.model.counter import build_vocabulary, count_ngrams_array
+        from cocoa.model.ngram import ArrayNgramModel
         sequences = [s.split() for s in self.templates.template.values]
         vocab = build_vocabulary(1, *sequences)
-        counter = count_ngrams(3, vocab, sequences, pad_left=True, pad_right=False)
-        model = MLENgramModel(counter)
-        scores = [-1.*model.entropy(s)*len(s) for s in sequences]
+        counter = count_ngrams_array(3, vocab, sequences, pad_left=True, pad_right=False)
+        model = ArrayNgramModel(counter)
+        lengths = np.array([len(s) for s in sequences])
+        scores = -1. * model.entropies(sequences) * lengths
         if not 'logp' in self.templates.columns:
             self.templates.insert(0, 'logp', 0)
         self.templates['logp'] = scores
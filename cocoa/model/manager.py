@@ -1,6 +1,6 @@
 from cocoa.core.util import read_pickle, write_pickle
-from cocoa.model.counter import build_vocabulary, count_ngrams
-from cocoa.model.ngram import MLENgramModel
+from cocoa.model.counter import build_vocabulary, count_ngrams_array
+from cocoa.model.ngram import ArrayNgramModel
 from cocoa.model.util import entropy
 
 class Manager(object):
@@ -11,8 +11,8 @@ class Manager(object):
     @classmethod
     def from_train(cls, sequences, n=3):
         vocab = build_vocabulary(1, *sequences)
-        counter = count_ngrams(n, vocab, sequences, pad_left=True, pad_right=False)
-        model = MLENgramModel(counter)
+        counter = count_ngrams_array(n, vocab, sequences, pad_left=True, pad_right=False)
+        model = ArrayNgramModel(counter)
         actions = vocab.keys()
         #print model.score('init-price', ('<start>',))
         #print model.ngrams.most_common(10)
@@ -59,4 +59,6 @@ class Manager(object):
     @classmethod
     def from_pickle(cls, path):
         data = read_pickle(path)
-        return cls(data['model'], data['actions'])
+        # Convert models pickled as MLENgramModel
+        model = ArrayNgramModel.from_model(data['model'])
+        return cls(model, data['actions'])
@@ -7,8 +7,10 @@
 from __future__ import unicode_literals, division
 from math import log
 
+import numpy as np
 from nltk import compat
-from util import safe_div
+from util import safe_div, EPS
+from counter import ArrayNgramCounter
 
 
 NEG_INF = float("-inf")
@@ -168,6 +170,93 @@ class LaplaceNgramModel(LidstoneNgramModel):
 
 
 
+@compat.python_2_unicode_compatible
+class ArrayNgramModel(BaseNgramModel):
+    """MLE ngram model backed by an `ArrayNgramCounter`.
+
+    Gives the same scores as `MLENgramModel`, and scores many texts at once
+    with `logprobs` and `entropies`.
+    """
+
+    def __init__(self, ngram_counter):
+        self.ngram_counter = ngram_counter
+        self._order = ngram_counter.order
+        # Policies query a small set of contexts many times
+        self._freqdists = {}
+
+    @classmethod
+    def from_model(cls, model):
+        """Convert an `MLENgramModel`, e.g. loaded from an old pickle.
+        """
+        if isinstance(model, cls):
+            return model
+        return cls(ArrayNgramCounter.from_counter(model.ngram_counter))
+
+    def _context_ids(self, context):
+        """Word ids of the context, or None if it contains an unseen word.
+        """
+        word_to_id = self.ngram_counter.word_to_id
+        if any(not word in word_to_id for word in context):
+            return None
+        return [word_to_id[word] for word in context]
+
+    def score(self, word, context):
+        context = self.check_context(context)
+        ids = self._context_ids(context + (word,))
+        if ids is None or len(ids) < 2:
+            return 0.
+        ngram = np.array([ids], dtype=np.int64)
+        total = self.ngram_counter.context_totals(ngram[:, :-1])[0]
+        if total == 0:
+            return 0.
+        return self.ngram_counter.ngram_counts(ngram)[0] / float(total)
+
+    def freqdist(self, context):
+        context = self.check_context(context)
+        if not context in self._freqdists:
+            ids = self._context_ids(context)
+            if ids is None:
+                dist = []
+            else:
+                words, counts = self.ngram_counter.continuations(ids)
+                vocab = self.ngram_counter.words
+                dist = [(vocab[w], c) for w, c in zip(words.tolist(), counts.tolist())]
+            self._freqdists[context] = dist
+        return list(self._freqdists[context])
+
+    def logprobs(self, texts):
+        """Total log probability (base 2) of each text and its number of ngrams.
+
+        :param texts: words of each text
+        :type texts: List[Iterable[str]]
+        """
+        texts = list(texts)
+        ngrams, text_ids, _ = self.ngram_counter.to_ngram_array(texts)
+        counts = self.ngram_counter.ngram_counts(ngrams)
+        totals = self.ngram_counter.context_totals(ngrams[:, :-1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logscores = np.log2(np.where(totals > 0, counts / np.maximum(totals, 1).astype(np.float64), 0.))
+        num_ngrams = np.bincount(text_ids, minlength=len(texts))
+        H = np.bincount(text_ids, weights=logscores, minlength=len(texts))
+        return H, num_ngrams
+
+    def entropies(self, texts, average=True):
+        """Vectorized `entropy` over many texts.
+        """
+        H, num_ngrams = self.logprobs(texts)
+        if average:
+            return -1. * H / (num_ngrams + EPS)
+        else:
+            return -1. * H, num_ngrams
+
+    def entropy(self, text, average=True):
+        H, num_ngrams = self.logprobs([text])
+        if average:
+            return -1. * safe_div(H[0], num_ngrams[0])
+        else:
+            return -1. * H[0], num_ngrams[0]
+
+
 #####################################################
 if __name__ == '__main__':
     from counter import build_vocabulary, count_ngrams
@@ -2,6 +2,8 @@ import numpy as np
 import time
 from collections import Counter
 
+from word_vectors import WordVectors
+
 class Vocabulary(object):
 
     UNK = '<unk>'
@@ -76,15 +78,11 @@ class Vocabulary(object):
         print 'Loading pretrained word vectors:', wordvec_file
         start_time = time.time()
         embeddings = np.random.uniform(-1., 1., [self.size, dim])
-        num_exist = 0
-        with open(wordvec_file, 'r') as f:
-            for line in f:
-                ss = line.split()
-                word = ss[0]
-                if word in self.word_to_ind:
-                    num_exist += 1
-                    vec = np.array([float(x) for x in ss[1:]])
-                    embeddings[self.word_to_ind[word]] = vec
+        wordvec = WordVectors.from_file(wordvec_file)
+        words = [self.ind_to_word[i] for i in xrange(self.size)]
+        found, vectors = wordvec.lookup(words)
+        embeddings[found] = vectors
+        num_exist = len(found)
         print '[%d s]' % (time.time() - start_time)
         print '%d pretrained' % num_exist
         return embeddings
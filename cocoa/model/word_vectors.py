@@ -0,0 +1,118 @@
+"""Pretrained word vectors (e.g. GloVe) in a binary format that loads fast.
+
+A text file of word vectors is converted once to
+    <file>.words: one word per line, in row order
+    <file>.npy: float32 matrix of shape (num_words, dim)
+next to the text file. The matrix is memory-mapped, so only the rows of words
+in the vocabulary are read from disk.
+"""
+
+import os
+import time
+import numpy as np
+from itertools import izip, count
+
+def _parse_line(line):
+    word, _, vec = line.rstrip('\n').partition(' ')
+    return word, vec
+
+def _is_header(line):
+    # word2vec text files start with "<num_words> <dim>"
+    return len(line.split()) == 2
+
+def convert_word_vectors(wordvec_file, output_prefix=None):
+    """Convert a text word vector file to the binary format.
+
+    Returns:
+        output_prefix (str)
+    """
+    if output_prefix is None:
+        output_prefix = wordvec_file
+    print 'Converting word vectors:', wordvec_file
+    start_time = time.time()
+
+    num_words, dim = 0, None
+    with open(wordvec_file, 'r') as fin:
+        for i, line in enumerate(fin):
+            if i == 0 and _is_header(line):
+                continue
+            if dim is None:
+                dim = len(line.split()) - 1
+            num_words += 1
+
+    tmp_words = output_prefix + '.words.tmp'
+    tmp_npy = output_prefix + '.tmp.npy'
+    vectors = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.float32, shape=(num_words, dim))
+    with open(wordvec_file, 'r') as fin, open(tmp_words, 'w') as fout:
+        row = 0
+        for i, line in enumerate(fin):
+            if i == 0 and _is_header(line):
+                continue
+            word, vec = _parse_line(line)
+            vectors[row] = np.fromstring(vec, dtype=np.float32, sep=' ')
+            fout.write(word + '\n')
+            row += 1
+    vectors.flush()
+    del vectors
+    # Rename the matrix last: its presence marks a complete conversion
+    os.rename(tmp_words, output_prefix + '.words')
+    os.rename(tmp_npy, output_prefix + '.npy')
+
+    print '%d words, dim=%d [%d s]' % (num_words, dim, time.time() - start_time)
+    return output_prefix
+
+
+class WordVectors(object):
+    """Word vectors backed by a memory-mapped matrix.
+    """
+    def __init__(self, words, vectors):
+        self.word_to_row = dict(izip(words, count()))
+        self.vectors = vectors
+        self.dim = vectors.shape[1]
+
+    @classmethod
+    def is_converted(cls, wordvec_file):
+        npy = wordvec_file + '.npy'
+        return os.path.exists(npy) and os.path.exists(wordvec_file + '.words') and \
+                (not os.path.exists(wordvec_file) or os.path.getmtime(npy) >= os.path.getmtime(wordvec_file))
+
+    @classmethod
+    def from_file(cls, wordvec_file):
+        """Load word vectors from a text file, converting it on first use.
+        """
+        if not cls.is_converted(wordvec_file):
+            convert_word_vectors(wordvec_file)
+        with open(wordvec_file + '.words', 'r') as fin:
+            words = fin.read().split('\n')[:-1]
+        vectors = np.load(wordvec_file + '.npy', mmap_mode='r')
+        return cls(words, vectors)
+
+    def __contains__(self, word):
+        return word in self.word_to_row
+
+    def lookup(self, words):
+        """Return vectors of the words that exist.
+
+        Returns:
+            found (list[int]): positions in `words` that have a vector
+            vectors (np.ndarray): (len(found), dim)
+        """
+        found, rows = [], []
+        for i, word in enumerate(words):
+            row = self.word_to_row.get(word)
+            if row is not None:
+                found.append(i)
+                rows.append(row)
+        # Sorted rows make the reads sequential on disk
+        order = np.argsort(rows)
+        vectors = np.empty((len(rows), self.dim), dtype=np.float32)
+        vectors[order] = self.vectors[np.array(rows, dtype=np.int64)[order]]
+        return found, vectors
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert text word vectors to a memory-mapped binary format')
+    parser.add_argument('wordvec_file', help='Text file with one word and its vector per line (e.g. GloVe)')
+    parser.add_argument('--output', help='Output prefix (default: the input path)')
+    args = parser.parse_args()
+    convert_word_vectors(args.wordvec_file, args.output)
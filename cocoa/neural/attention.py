@@ -1,8 +1,9 @@
 import torch
 import torch.nn as nn
+from torch.autograd import Variable
 
 from onmt.modules.UtilClass import BottleLinear
-from onmt.Utils import aeq, sequence_mask
+from onmt.Utils import aeq, MaskCache
 
 
 class GlobalAttention(nn.Module):
@@ -63,11 +64,25 @@ class GlobalAttention(nn.Module):
         if coverage:
             self.linear_cover = nn.Linear(1, dim, bias=False)
 
-    def score(self, h_t, h_s):
+        self.mask_cache = MaskCache()
+
+    def memory_keys(self, memory_bank):
+        """The part of the scores of `memory_bank` `[batch x src_len x dim]`
+        that does not depend on the query ("mlp" attention), or None. It can
+        be computed once per batch and passed to `forward`.
+        """
+        if self.attn_type != "mlp":
+            return None
+        batch, src_len, dim = memory_bank.size()
+        uh = self.linear_context(memory_bank.contiguous().view(-1, dim))
+        return uh.view(batch, src_len, dim)
+
+    def score(self, h_t, h_s, memory_keys=None):
         """
         Args:
           h_t (`FloatTensor`): sequence of queries `[batch x tgt_len x dim]`
           h_s (`FloatTensor`): sequence of sources `[batch x src_len x dim]`
+          memory_keys (`FloatTensor`): `memory_keys(h_s)`, or None
 
         Returns:
           :obj:`FloatTensor`:
@@ -97,8 +112,9 @@ class GlobalAttention(nn.Module):
             wq = wq.view(tgt_batch, tgt_len, 1, dim)
             wq = wq.expand(tgt_batch, tgt_len, src_len, dim)
 
-            uh = self.linear_context(h_s.contiguous().view(-1, dim))
-            uh = uh.view(src_batch, 1, src_len, dim)
+            if memory_keys is None:
+                memory_keys = self.memory_keys(h_s)
+            uh = memory_keys.view(src_batch, 1, src_len, dim)
             uh = uh.expand(src_batch, tgt_len, src_len, dim)
 
             # (batch, t_len, s_len, d)
@@ -106,7 +122,8 @@ class GlobalAttention(nn.Module):
 
             return self.v(wquh.view(-1, dim)).view(tgt_batch, tgt_len, src_len)
 
-    def forward(self, input, memory_bank, memory_lengths=None, coverage=None):
+    def forward(self, input, memory_bank, memory_lengths=None, coverage=None,
+                memory_keys=None, pad_mask=None):
         """
 
         Args:
@@ -114,6 +131,11 @@ class GlobalAttention(nn.Module):
           memory_bank (`FloatTensor`): source vectors `[batch x src_len x dim]`
           memory_lengths (`LongTensor`): the source context lengths `[batch]`
           coverage (`FloatTensor`): None (not supported yet)
+          memory_keys (`FloatTensor`): see `memory_keys`; ignored with
+            coverage, which changes the memory bank
+          pad_mask (`ByteTensor`): 1 at the padding of the memory bank
+            `[batch x src_len]`, e.g. `DecoderMemory.pad_mask`; built from
+            `memory_lengths` (once for the same lengths) if not given
 
         Returns:
           (`FloatTensor`, `FloatTensor`):
@@ -144,14 +166,17 @@ class GlobalAttention(nn.Module):
             cover = coverage.view(-1).unsqueeze(1)
             memory_bank += self.linear_cover(cover).view_as(memory_bank)
             memory_bank = self.tanh(memory_bank)
+            memory_keys = None
 
         # compute attention scores, as in Luong et al.
-        align = self.score(input, memory_bank)
+        align = self.score(input, memory_bank, memory_keys)
 
-        if memory_lengths is not None:
-            mask = sequence_mask(memory_lengths)
-            mask = mask.unsqueeze(1)  # Make it broadcastable.
-            align.data.masked_fill_(1 - mask, -float('inf'))
+        if pad_mask is None and memory_lengths is not None:
+            pad_mask = self.mask_cache.get(memory_lengths, sourceL)
+        if pad_mask is not None:
+            # Make it broadcastable.
+            pad_mask = pad_mask.unsqueeze(1).expand_as(align.data)
+            align.data.masked_fill_(pad_mask, -float('inf'))
 
         # Softmax to normalize attention weights
         align_vectors = self.sm(align.view(batch*targetL, sourceL))
@@ -194,19 +219,145 @@ class GlobalAttention(nn.Module):
 
         return attn_h, align_vectors
 
+def stack_memory_banks(memory_banks, memory_lengths=None, bank_masks=None):
+    """Pad memory banks to the same length and stack them.
+
+    Args:
+        memory_banks (list of `FloatTensor`): `[batch x src_len_k x dim]`
+        memory_lengths (`LongTensor`): lengths of the first bank `[batch]`;
+            the other banks are not padded.
+        bank_masks (list of `ByteTensor`): padding mask of each bank
+            `[batch x src_len_k]`, e.g. of rows of different batches
+            decoded together (see `DecoderMemory.cat`), or None
+
+    Returns:
+        banks (`FloatTensor`): `[batch x num_banks x max_len x dim]`
+        pad_mask (`ByteTensor`): 1 at padding `[batch x num_banks x max_len]`
+        bank_lengths (list of int): `src_len_k` of each bank
+    """
+    batch, _, dim = memory_banks[0].size()
+    bank_lengths = [bank.size(1) for bank in memory_banks]
+    max_len = max(bank_lengths)
+    padded = []
+    for bank in memory_banks:
+        if bank.size(1) < max_len:
+            padding = Variable(bank.data.new(batch, max_len - bank.size(1), dim).zero_())
+            bank = torch.cat([bank, padding], 1)
+        padded.append(bank)
+    banks = torch.stack(padded, 1)
+
+    lengths = torch.LongTensor(bank_lengths).view(1, -1).repeat(batch, 1)
+    if memory_lengths is not None:
+        if isinstance(memory_lengths, Variable):
+            memory_lengths = memory_lengths.data
+        lengths[:, 0] = memory_lengths.cpu()
+    steps = torch.arange(0, max_len).long().view(1, 1, -1).expand(batch, len(memory_banks), max_len)
+    pad_mask = steps.ge(lengths.unsqueeze(2).expand_as(steps))
+    if banks.is_cuda:
+        pad_mask = pad_mask.cuda()
+    if bank_masks is not None:
+        for k, mask in enumerate(bank_masks):
+            pad_mask[:, k, :mask.size(1)].masked_fill_(mask, 1)
+    return banks, pad_mask, bank_lengths
+
+
+class MemoryBankCache(object):
+    """The last stacked memory banks. Memory banks do not change between
+    decoding steps, so they are stacked once per batch.
+    """
+    def __init__(self):
+        self.key = None
+        self.value = None
+
+    def get(self, memory_banks, memory_lengths, bank_masks=None):
+        def tensor_key(t):
+            t = t.data if isinstance(t, Variable) else t
+            return (t.data_ptr(), t.size(), t.stride())
+        key = [tensor_key(bank) for bank in memory_banks]
+        key.append(tensor_key(memory_lengths) if memory_lengths is not None else None)
+        key.extend(tensor_key(mask) for mask in bank_masks or [])
+        if key != self.key:
+            # Keep the inputs so that their memory is not reused while cached
+            self.key, self.inputs = key, (memory_banks, memory_lengths, bank_masks)
+            self.value = stack_memory_banks(memory_banks, memory_lengths, bank_masks)
+        return self.value
+
+
+def banks_to_outputs(attn_h, align_vectors, bank_lengths, one_step):
+    """Attention outputs `[batch x tgt_len x dim]` and distributions
+    `[batch x tgt_len x num_banks x max_len]` in the shapes of GlobalAttention.
+    The distributions of the banks are concatenated without their padding.
+    """
+    batch, target_len, _, max_len = align_vectors.size()
+    if min(bank_lengths) == max_len:
+        align_vectors = align_vectors.contiguous().view(batch, target_len, -1)
+    else:
+        align_vectors = torch.cat([align_vectors[:, :, k, :length]
+            for k, length in enumerate(bank_lengths)], 2)
+    if one_step:
+        return attn_h.squeeze(1), align_vectors.squeeze(1)
+    return attn_h.transpose(0, 1).contiguous(), align_vectors.transpose(0, 1).contiguous()
+
+
 class MultibankGlobalAttention(nn.Module):
+    """Attention over several memory banks with shared weights; the attention
+    outputs of the banks are summed.
+
+    The banks are attended to at once: they are stacked along the source axis
+    (see stack_memory_banks), scores are computed in one call and normalized
+    over each bank separately.
+    """
     def __init__(self, dim, coverage=False, attn_type="dot"):
         super(MultibankGlobalAttention, self).__init__()
         self.attention = GlobalAttention(dim, coverage, attn_type)
+        self.bank_cache = MemoryBankCache()
 
-    def forward(self, input, memory_banks, memory_lengths=None, coverage=None):
+    def forward(self, input, memory_banks, memory_lengths=None, coverage=None, pad_mask=None):
         # memory_banks have shape (batch_size, seq_len, hidden_dim)
+        # pad_mask: padding mask of each bank, see stack_memory_banks
+        if coverage is not None:
+            return self.forward_per_bank(input, memory_banks, memory_lengths, coverage, pad_mask)
+
+        one_step = input.dim() == 2
+        if one_step:
+            input = input.unsqueeze(1)
+        if self.training:
+            banks, pad_mask, bank_lengths = stack_memory_banks(memory_banks, memory_lengths, pad_mask)
+        else:
+            banks, pad_mask, bank_lengths = self.bank_cache.get(memory_banks, memory_lengths, pad_mask)
+        batch, num_banks, max_len, dim = banks.size()
+        target_len = input.size(1)
+        attention = self.attention
+
+        align = attention.score(input, banks.view(batch, num_banks * max_len, dim))
+        align = align.view(batch, target_len, num_banks, max_len)
+        align.data.masked_fill_(pad_mask.unsqueeze(1), -float('inf'))
+        align_vectors = attention.sm(align.view(-1, max_len))
+        align_vectors = align_vectors.view(batch, target_len, num_banks, max_len)
+
+        # Context vector of each bank
+        # (batch*num_banks, t_len, max_len) x (batch*num_banks, max_len, d)
+        c = torch.bmm(align_vectors.transpose(1, 2).contiguous().view(batch * num_banks, target_len, max_len),
+                      banks.view(batch * num_banks, max_len, dim))
+        c = c.view(batch, num_banks, target_len, dim)
+        q = input.unsqueeze(1).expand(batch, num_banks, target_len, dim)
+        concat_c = torch.cat([c, q], 3).view(-1, dim * 2)
+        attn_h = attention.linear_out(concat_c).view(batch, num_banks, target_len, dim)
+        if attention.attn_type in ["general", "dot"]:
+            attn_h = attention.tanh(attn_h)
+        attn_h = attn_h.sum(1)
+
+        return banks_to_outputs(attn_h, align_vectors, bank_lengths, one_step)
+
+    def forward_per_bank(self, input, memory_banks, memory_lengths=None, coverage=None, pad_mask=None):
         attention_hidden_states = []
         alignment_vectors = []
 
         for idx, memory_bank in enumerate(memory_banks):
             memory_lengths = None if idx > 0 else memory_lengths
-            attn_h, align_vectors = self.attention(input, memory_bank, memory_lengths, coverage)
+            mask = pad_mask[idx] if pad_mask is not None else None
+            attn_h, align_vectors = self.attention(input, memory_bank, memory_lengths, coverage,
+                                                   pad_mask=mask)
             attention_hidden_states.append(attn_h)
             alignment_vectors.append(align_vectors)
 
@@ -215,22 +366,74 @@ class MultibankGlobalAttention(nn.Module):
         return final_attn_h, final_align_v
 
 class MultibankConcatGlobalAttention(nn.Module):
+    """Attention over several memory banks, with separate weights for each
+    bank; the attention outputs of the banks are concatenated and projected.
+
+    As in MultibankGlobalAttention the scores of the banks are computed at
+    once ("dot" and "general" attention); the layers of each bank are then
+    applied separately.
+    """
     def __init__(self, dim, memory_dims, coverage=False, attn_type="dot"):
         super(MultibankConcatGlobalAttention, self).__init__()
         self.attentions = nn.ModuleList(
                 [GlobalAttention(d, coverage, attn_type) for d in memory_dims]
                 )
         self.proj = nn.Linear(sum(memory_dims), dim)
+        self.bank_cache = MemoryBankCache()
 
-    def forward(self, input, memory_banks, memory_lengths=None, coverage=None):
+    def forward(self, input, memory_banks, memory_lengths=None, coverage=None, pad_mask=None):
         # memory_banks have shape (batch_size, seq_len, hidden_dim)
+        if coverage is not None or self.attentions[0].attn_type == "mlp":
+            return self.forward_per_bank(input, memory_banks, memory_lengths, coverage, pad_mask)
+
+        one_step = input.dim() == 2
+        if one_step:
+            input = input.unsqueeze(1)
+        # The banks are not masked, but for the padding masks given
+        if self.training:
+            banks, pad_mask, bank_lengths = stack_memory_banks(memory_banks, None, pad_mask)
+        else:
+            banks, pad_mask, bank_lengths = self.bank_cache.get(memory_banks, None, pad_mask)
+        batch, num_banks, max_len, dim = banks.size()
+        target_len = input.size(1)
+
+        # Queries of each bank: (batch, num_banks, t_len, d)
+        if self.attentions[0].attn_type == "general":
+            flat_input = input.contiguous().view(batch * target_len, dim)
+            q = torch.stack([attention.linear_in(flat_input) for attention in self.attentions], 1)
+            q = q.view(batch, target_len, num_banks, dim).transpose(1, 2)
+        else:
+            q = input.unsqueeze(1).expand(batch, num_banks, target_len, dim)
+        q = q.contiguous().view(batch * num_banks, target_len, dim)
+
+        # (batch*num_banks, t_len, d) x (batch*num_banks, d, max_len)
+        banks = banks.view(batch * num_banks, max_len, dim)
+        align = torch.bmm(q, banks.transpose(1, 2)).view(batch, num_banks, target_len, max_len)
+        align.data.masked_fill_(pad_mask.unsqueeze(2), -float('inf'))
+        align_vectors = self.attentions[0].sm(align.view(-1, max_len))
+        align_vectors = align_vectors.view(batch * num_banks, target_len, max_len)
+
+        # Context of each bank: (num_banks, batch, t_len, d)
+        c = torch.bmm(align_vectors, banks).view(batch, num_banks, target_len, dim).transpose(0, 1)
+        concat_c = torch.cat([c, input.unsqueeze(0).expand_as(c)], 3)
+        concat_c = concat_c.contiguous().view(num_banks, batch * target_len, dim * 2)
+        attn_h = torch.cat([torch.tanh(attention.linear_out(concat_c[i]))
+            for i, attention in enumerate(self.attentions)], 1)
+        attn_h = self.proj(attn_h).view(batch, target_len, -1)
+
+        align_vectors = align_vectors.view(batch, num_banks, target_len, max_len).transpose(1, 2)
+        return banks_to_outputs(attn_h, align_vectors, bank_lengths, one_step)
+
+    def forward_per_bank(self, input, memory_banks, memory_lengths=None, coverage=None, pad_mask=None):
         attention_hidden_states = []
         alignment_vectors = []
 
         for idx, memory_bank in enumerate(memory_banks):
             #memory_lengths = None if idx > 0 else memory_lengths
             memory_lengths = None
-            attn_h, align_vectors = self.attentions[idx](input, memory_bank, memory_lengths, coverage)
+            mask = pad_mask[idx] if pad_mask is not None else None
+            attn_h, align_vectors = self.attentions[idx](input, memory_bank, memory_lengths, coverage,
+                                                         pad_mask=mask)
             attention_hidden_states.append(attn_h)
             alignment_vectors.append(align_vectors)
 
@@ -0,0 +1,66 @@
+"""Group dialogues into batches that waste little compute on padding.
+"""
+
+import random
+import numpy as np
+
+
+def dialogue_shape(dialogue):
+    """Return (number of turns, length of the longest turn) of a dialogue.
+    """
+    turns = dialogue.turns
+    max_len = max([len(turn) for stage_turns in turns for turn in stage_turns] or [0])
+    return len(turns[0]), max_len
+
+def bucket_dialogues(dialogues, batch_size, batch_tokens=0, shape=dialogue_shape):
+    """Split dialogues into groups that are batched together.
+
+    Dialogues are sorted by `shape`, i.e. (number of turns, longest turn).
+    Without a token budget, groups have `batch_size` dialogues. Otherwise a
+    group grows while its padded size (dialogues x max turns x max turn
+    length) stays within `batch_tokens`, and never exceeds `batch_size`.
+
+    Returns:
+        groups (list[list])
+    """
+    shapes = {id(d): shape(d) for d in dialogues}
+    dialogues = sorted(dialogues, key=lambda d: shapes[id(d)])
+    groups = []
+    group, max_turns, max_len = [], 0, 0
+    for dialogue in dialogues:
+        num_turns, length = shapes[id(dialogue)]
+        new_turns, new_len = max(max_turns, num_turns), max(max_len, length)
+        if group and (len(group) >= batch_size or \
+                (batch_tokens > 0 and (len(group) + 1) * new_turns * new_len > batch_tokens)):
+            groups.append(group)
+            group, new_turns, new_len = [], num_turns, length
+        group.append(dialogue)
+        max_turns, max_len = new_turns, new_len
+    if group:
+        groups.append(group)
+    return groups
+
+def padding_ratio(dialogue_batches, input_pad, target_pad):
+    """Fraction of encoder input and target positions that are padding.
+    """
+    num_pads, num_total = 0, 0
+    for dialogue_batch in dialogue_batches:
+        for batch in dialogue_batch:
+            for array, pad in ((batch['encoder_args']['inputs'], input_pad),
+                               (batch['decoder_args']['targets'], target_pad)):
+                num_pads += np.count_nonzero(array == pad)
+                num_total += array.size
+    return num_pads / float(max(num_total, 1))
+
+def shuffled_order(n, seed=None):
+    """Return a random permutation of range(n).
+
+    If `seed` is given (e.g. derived from the epoch number), the order is the
+    same every time it is called with that seed.
+    """
+    inds = range(n)
+    if seed is None:
+        random.shuffle(inds)
+    else:
+        random.Random(seed).shuffle(inds)
+    return inds
@@ -0,0 +1,143 @@
+"""Inference checkpoints and a per-process model cache.
+
+A training checkpoint (.pt) pickles the options, the weights and the
+optimizer, and the vocabulary is read from the mappings directory of the
+training run. An inference checkpoint is a directory that holds only what is
+needed to run the model:
+    opt.pkl: model options
+    vocab.pkl: the mappings
+    arrays.pkl, *.npy: weights of the model and the generator (see
+        cocoa.io.assets.write_arrays)
+The weights are memory-mapped, so processes loading the same checkpoint share
+them through the page cache. A checkpoint converted with --quantize runs on
+CPU with int8 weights in its Linear and LSTM layers (see quantize_dynamic);
+these are quantized on load, so they are not shared between processes.
+
+Convert a training checkpoint from the task directory (the checkpoint refers
+to task modules), e.g.
+    PYTHONPATH=..:. python ../cocoa/neural/checkpoint.py model/model_best.pt model/model_best [--quantize]
+"""
+
+import os
+import shutil
+import torch
+import torch.nn as nn
+
+from cocoa.io.utils import read_pickle, write_pickle
+from cocoa.io.assets import write_arrays, read_arrays
+
+def is_inference_checkpoint(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'arrays.pkl'))
+
+def checkpoint_mtime(path):
+    if is_inference_checkpoint(path):
+        # Written last by convert_checkpoint
+        return os.path.getmtime(os.path.join(path, 'opt.pkl'))
+    return os.path.getmtime(path)
+
+def convert_checkpoint(model_path, output_path, quantize=False):
+    """Write the training checkpoint `model_path` as an inference checkpoint.
+    With `quantize`, the model is quantized when it is loaded.
+    """
+    checkpoint = torch.load(model_path, map_location=lambda storage, loc: storage)
+    model_opt = checkpoint['opt']
+    model_opt.quantize = quantize
+    tmp_path = '%s.tmp%d' % (output_path.rstrip('/'), os.getpid())
+    arrays = {}
+    for part in ('model', 'generator'):
+        for name, tensor in checkpoint[part].iteritems():
+            arrays['%s.%s' % (part, name)] = tensor.cpu().numpy()
+    write_arrays(tmp_path, arrays)
+    shutil.copyfile(os.path.join(model_opt.mappings, 'vocab.pkl'), os.path.join(tmp_path, 'vocab.pkl'))
+    write_pickle(model_opt, os.path.join(tmp_path, 'opt.pkl'))
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.rename(tmp_path, output_path)
+
+def load_checkpoint(path):
+    """Load a training or an inference checkpoint for inference.
+
+    Returns:
+        checkpoint (dict): 'opt', 'model' and 'generator' (state dicts) as in
+            a training checkpoint, plus the raw mappings in 'vocab'. Weights of
+            an inference checkpoint are memory-mapped (copy-on-write).
+    """
+    if not is_inference_checkpoint(path):
+        checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+        checkpoint.pop('optim', None)
+        checkpoint['vocab'] = read_pickle(os.path.join(checkpoint['opt'].mappings, 'vocab.pkl'))
+        return checkpoint
+
+    checkpoint = {
+            'opt': read_pickle(os.path.join(path, 'opt.pkl')),
+            'vocab': read_pickle(os.path.join(path, 'vocab.pkl')),
+            'model': {},
+            'generator': {},
+            'mmap': True,
+            }
+    for key, array in read_arrays(path, mmap_mode='c').iteritems():
+        part, name = key.split('.', 1)
+        checkpoint[part][name] = torch.from_numpy(array)
+    return checkpoint
+
+def share_weights(model, checkpoint):
+    """Point the parameters of a CPU model built from an inference checkpoint
+    to the memory-mapped weights (load_state_dict copies them).
+    """
+    if checkpoint.get('mmap'):
+        for name, param in model.named_parameters():
+            if name.startswith('generator.'):
+                param.data = checkpoint['generator'][name[len('generator.'):]]
+            else:
+                param.data = checkpoint['model'][name]
+
+def quantize_dynamic(model):
+    """Quantize the Linear and LSTM layers of a CPU model to int8 in place.
+    Weights are quantized once; activations are quantized on the fly.
+    """
+    try:
+        from torch.quantization import quantize_dynamic
+    except ImportError:
+        raise ValueError('Quantization requires PyTorch 1.3 or later (found %s)' % torch.__version__)
+    for module in model.modules():
+        # Unused in inference, and the quantized LSTM of PyTorch 1.4 fails on
+        # dropout with a single layer
+        if isinstance(module, nn.RNNBase):
+            module.dropout = 0
+    return quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8, inplace=True)
+
+def freeze(model):
+    for param in model.parameters():
+        param.requires_grad = False
+
+
+class ModelCache(object):
+    """Models loaded in this process, keyed by checkpoint path and mtime.
+
+    Agents and systems loading the same checkpoint share one model, which
+    must not be trained. A checkpoint that changes on disk is loaded again.
+    """
+    _models = {}
+
+    @classmethod
+    def get(cls, path, load, *key):
+        """Return `load()` for the checkpoint `path`. `key` holds other
+        arguments the loaded model depends on (e.g. whether it is on GPU).
+        """
+        cache_key = (os.path.abspath(path), checkpoint_mtime(path)) + key
+        if cache_key not in cls._models:
+            cls._models[cache_key] = load()
+        return cls._models[cache_key]
+
+    @classmethod
+    def clear(cls):
+        cls._models.clear()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert a training checkpoint to an inference checkpoint')
+    parser.add_argument('model_path', help='Training checkpoint (.pt)')
+    parser.add_argument('output_path', help='Output directory')
+    parser.add_argument('--quantize', action='store_true', help='Run the model with int8 Linear and LSTM weights (CPU only)')
+    args = parser.parse_args()
+    convert_checkpoint(args.model_path, args.output_path, args.quantize)
@@ -0,0 +1,104 @@
+"""Multi-process data-parallel training on CPU with torch.distributed (gloo).
+
+Each rank is a forked process that holds a full copy of the model and
+trains on its own shard of the dialogue batches. Gradients are summed across
+ranks before every optimizer step, so all replicas stay identical.
+"""
+
+import multiprocessing
+import torch
+import torch.distributed as dist
+
+# torch < 1.0 calls it reduce_op
+ReduceOp = getattr(dist, 'ReduceOp', None) or dist.reduce_op
+
+_rank = 0
+_world_size = 1
+
+def init_process_group(rank, world_size, init_method='tcp://127.0.0.1:23456', backend='gloo'):
+    global _rank, _world_size
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    _rank, _world_size = rank, world_size
+
+def get_rank():
+    return _rank
+
+def get_world_size():
+    return _world_size
+
+def is_master():
+    return _rank == 0
+
+def broadcast_parameters(model):
+    """Copy parameters of rank 0 to all other ranks.
+    """
+    if _world_size > 1:
+        for param in model.parameters():
+            dist.broadcast(param.data, 0)
+
+def all_reduce_sum(value):
+    """Sum a number over all ranks.
+    """
+    if _world_size == 1:
+        return value
+    tensor = torch.DoubleTensor([float(value)])
+    dist.all_reduce(tensor, op=ReduceOp.SUM)
+    return float(tensor[0])
+
+def all_reduce_max(value):
+    if _world_size == 1:
+        return value
+    tensor = torch.DoubleTensor([float(value)])
+    dist.all_reduce(tensor, op=ReduceOp.MAX)
+    return float(tensor[0])
+
+def all_reduce_gradients(params, normalization=1.):
+    """Sum gradients over all ranks (in one flat buffer) and divide them by
+    `normalization`.
+
+    Parameters without a gradient on this rank (e.g. it had no batch in
+    this step) contribute zeros.
+    """
+    params = [p for p in params if p.requires_grad]
+    if _world_size > 1:
+        grads = [p.grad.data.view(-1) if p.grad is not None else p.data.new(p.numel()).zero_() for p in params]
+        flat = torch.cat(grads)
+        dist.all_reduce(flat, op=ReduceOp.SUM)
+        offset = 0
+        for p in params:
+            n = p.numel()
+            grad = flat[offset:offset+n].view_as(p.data)
+            if p.grad is None:
+                p.grad = torch.autograd.Variable(grad)
+            else:
+                p.grad.data.copy_(grad)
+            offset += n
+    if normalization != 1.:
+        for p in params:
+            if p.grad is not None:
+                p.grad.data.div_(normalization)
+
+def _run(rank, world_size, init_method, num_threads, train, args):
+    torch.set_num_threads(num_threads)
+    init_process_group(rank, world_size, init_method)
+    train(*args)
+
+def launch(train, world_size, init_method='tcp://127.0.0.1:23456', args=()):
+    """Fork `world_size` processes that each call `train(*args)`.
+
+    The processes are forked, so data loaded before calling this (e.g. the
+    DataGenerator) is shared instead of loaded again by every rank. CPU
+    threads are split evenly between ranks.
+    """
+    num_threads = max(1, multiprocessing.cpu_count() // world_size)
+    workers = []
+    for rank in xrange(world_size):
+        worker = multiprocessing.Process(target=_run,
+                args=(rank, world_size, init_method, num_threads, train, args))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError('Training failed on rank(s) {}'.format(failed))
@@ -2,15 +2,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import division
-import six
 import sys
 import os
 import numpy as np
 import argparse
 import torch
-from tqdm import tqdm as progress_bar
 
 from cocoa.io.utils import read_pickle
+from cocoa.model.word_vectors import WordVectors
 
 parser = argparse.ArgumentParser(description='embeddings_to_torch.py')
 parser.add_argument('--emb-file', required=True,
@@ -34,30 +33,26 @@ def get_vocabs(vocab_path, vocab_type):
     return vocab
 
 def get_embeddings(file_):
-    embs = dict()
-    with open(file_, 'r') as f:
-        for l in progress_bar(f):
-            l_split = l.strip().split()
-            embs[l_split[0]] = [float(em) for em in l_split[1:]]
-    print("Got {} embeddings from {}".format(len(embs), file_))
+    # Converted to a memory-mapped binary format on first use
+    embs = WordVectors.from_file(file_)
+    print("Got {} embeddings from {}".format(len(embs.word_to_row), file_))
 
     return embs
 
 
 def match_embeddings(vocab, emb):
-    dim = len(six.next(six.itervalues(emb)))
-    filtered_embeddings = np.zeros((len(vocab), dim))
-    count = {"match": 0, "miss": 0}
-    for w, w_id in vocab.word_to_ind.items():
-        if w in emb:
-            filtered_embeddings[w_id] = emb[w]
-            count['match'] += 1
-        else:
-            if opt.verbose:
+    filtered_embeddings = np.zeros((len(vocab), emb.dim), dtype=np.float32)
+    words = [vocab.to_word(i) for i in range(len(vocab))]
+    found, vectors = emb.lookup(words)
+    filtered_embeddings[found] = vectors
+    count = {"match": len(found), "miss": len(words) - len(found)}
+    if opt.verbose:
+        found = set(found)
+        for i, w in enumerate(words):
+            if i not in found:
                 print(u"not found:\t{}".format(w), file=sys.stderr)
-            count['miss'] += 1
 
-    return torch.Tensor(filtered_embeddings), count
+    return torch.from_numpy(filtered_embeddings), count
 
 
 def main():
@@ -2,10 +2,11 @@ import torch
 from torch.autograd import Variable
 
 import onmt.io
-from onmt.Utils import aeq
+from onmt.Utils import aeq, select_rows, cat_rows
 
 from symbols import markers
 from beam import Beam
+from scheduler import ActiveBatch
 from utterance import UtteranceBuilder
 
 
@@ -83,6 +84,57 @@ class Generator(object):
             memory_bank = enc_memory_bank
         return memory_bank
 
+    def _repeat_memory(self, memory_bank, lengths, dec_states, n):
+        """Repeat the memory bank(s), their lengths and the decoder states
+        `n` times along the batch dimension (in place for `dec_states`).
+        """
+        if isinstance(memory_bank, list):
+            memory_bank = [bank.repeat(1, n, 1) for bank in memory_bank]
+        else:
+            memory_bank = memory_bank.repeat(1, n, 1)
+        dec_states.repeat_beam_size_times(n)
+        return memory_bank, lengths.repeat(n)
+
+    def score_batch(self, batch, candidates, gt_prefix=1, enc_state=None):
+        """Log probability of candidate responses, computed in one
+        teacher-forced pass of the decoder over all candidates of the batch.
+
+        Args:
+            candidates (LongTensor): batch_size x num_candidates x seq_len
+                token ids; tokens after the first EOS are not scored
+
+        Returns:
+            scores (FloatTensor): batch_size x num_candidates
+            lengths (LongTensor): batch_size x num_candidates number of scored
+                tokens (EOS included)
+        """
+        batch_size, num_candidates, seq_len = candidates.size()
+        pad = self.vocab.to_ind(markers.PAD)
+        # Rows ordered by candidate, then by example, as in beam search
+        targets = candidates.transpose(0, 1).contiguous().view(-1, seq_len).t()
+        eos = targets.eq(self.vocab.to_ind(markers.EOS)).long()
+        after_eos = (eos.cumsum(0) - eos).gt(0)
+        targets = targets.masked_fill(after_eos, pad)
+
+        dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
+        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
+        lengths = batch.lengths
+        if num_candidates > 1:
+            memory_bank, lengths = self._repeat_memory(memory_bank, lengths, dec_states, num_candidates)
+        # The output at the last prefix token predicts the first target
+        inp = torch.cat([batch.decoder_inputs[:gt_prefix].repeat(1, num_candidates),
+                         Variable(targets[:-1], volatile=True)], 0)
+        dec_out, _, _ = self.model.decoder(
+            inp, memory_bank, dec_states, memory_lengths=lengths)
+        dec_out = dec_out[gt_prefix-1:]
+
+        out = self.model.generator.forward(dec_out.view(-1, dec_out.size(2))).data
+        scores = out.gather(1, targets.view(-1, 1)).view(seq_len, -1)
+        scores.masked_fill_(after_eos, 0)
+        scores = scores.sum(0).view(num_candidates, batch_size).t()
+        lengths = (seq_len - after_eos.long().sum(0)).view(num_candidates, batch_size).t()
+        return scores, lengths
+
     def generate_batch(self, batch, gt_prefix=1, enc_state=None):
         """
         Generate a batch of sentences.
@@ -106,8 +158,7 @@ class Generator(object):
             than 1, use the last symbol as the starting symbol. The rest (previous
             ones) will be force decoded later. See (1.1) Go over forced prefix.
             """
-            bos = batch.decoder_inputs[gt_prefix-1][b].data.cpu().numpy()[0]
-            return bos
+            return int(batch.decoder_inputs[gt_prefix-1][b])
 
         beam = [Beam(beam_size, n_best=self.n_best,
                      cuda=self.cuda,
@@ -123,11 +174,8 @@ class Generator(object):
 
         def rvar(a): return var(a.repeat(1, beam_size, 1))
 
-        def bottle(m):
-            return m.view(batch_size * beam_size, -1)
-
-        def unbottle(m):
-            return m.view(beam_size, batch_size, -1)
+        def unbottle(m, n):
+            return m.view(beam_size, n, -1)
 
         # (1) Run the encoder on the src.
         lengths = batch.lengths
@@ -150,15 +198,27 @@ class Generator(object):
             memory_bank = rvar(memory_bank.data)
         memory_lengths = lengths.repeat(beam_size)
         dec_states.repeat_beam_size_times(beam_size)
+        memory = self.model.decoder.init_decoder_memory(memory_bank, memory_lengths)
 
         # (3) run the decoder to generate sentences, using beam search.
+        # Examples whose beam is done are evicted from the batch: `active`
+        # holds the index in `beam` of the examples still decoded.
+        active = range(batch_size)
         for i in range(self.max_length):
-            if all((b.done() for b in beam)):
+            live = [j for j in active if not beam[j].done()]
+            if not live:
                 break
+            if len(live) < len(active):
+                positions = [active.index(j) for j in live]
+                rows = memory.lengths.new([k * len(active) + p
+                                           for k in range(beam_size) for p in positions])
+                memory = memory.index_select(rows)
+                dec_states = dec_states.index_select(rows)
+                active = live
 
             # Construct batch x beam_size nxt words.
             # Get all the pending current beam words and arrange for forward.
-            inp = var(torch.stack([b.get_current_state() for b in beam])
+            inp = var(torch.stack([beam[j].get_current_state() for j in active])
                      .t().contiguous().view(1, -1))
 
             # Turn any copied words to UNKs
@@ -172,14 +232,13 @@ class Generator(object):
             #inp = inp.unsqueeze(2)
 
             # Run one step.
-            dec_out, dec_states, attn = self.model.decoder(inp, memory_bank,
-                        dec_states, memory_lengths=memory_lengths)
-            dec_out = dec_out.squeeze(0)
+            dec_out, dec_states, attn = self.model.decoder.decode_step(
+                inp, memory, dec_states)
             # dec_out: beam x rnn_size
 
             # (b) Compute a vector of batch*beam word scores.
             out = self.model.generator.forward(dec_out).data
-            out = unbottle(out)
+            out = unbottle(out, len(active))
             # beam x tgt_vocab
 
             #if not self.copy_attn:
@@ -197,14 +256,15 @@ class Generator(object):
             #    # beam x tgt_vocab
             #    out = out.log()
 
-            # (c) Advance each beam.
-            # beam: (batch_size,)
-            # out: (beam_size, batch_size, vocab_size)
-            for j, b in enumerate(beam):
+            # (c) Advance each live beam.
+            # out: (beam_size, len(active), vocab_size)
+            beam_attn = unbottle(attn["std"].data, len(active))
+            for p, j in enumerate(active):
+                b = beam[j]
                 b.advance(
-                    out[:, j],
-                    unbottle(attn["std"]).data[:, j, :memory_lengths[j]])
-                dec_states.beam_update(j, b.get_current_origin(), beam_size)
+                    out[:, p],
+                    beam_attn[:, p, :memory.lengths[p]])
+                dec_states.beam_update(p, b.get_current_origin(), beam_size)
 
         # (4) Extract sentences from beam.
         ret = self._from_beam(beam)
@@ -263,9 +323,52 @@ class Generator(object):
             gold_scores += scores
         return gold_scores
 
+def truncate_scores(scores, top_k=0, top_p=1., nucleus_k=64):
+    """Set to -inf (in place) the scores of tokens outside the `top_k` highest
+    and outside the nucleus: the fewest highest tokens whose probability
+    reaches `top_p`. Both use `topk` rather than a sort of the vocabulary:
+    without `top_k`, the vocabulary is sorted only if the nucleus of some row
+    is not within its `nucleus_k` highest tokens.
+
+    Args:
+        scores (FloatTensor): batch x vocab unnormalized log probabilities
+    """
+    vocab_size = scores.size(1)
+    if 0 < top_k < vocab_size:
+        top_scores = scores.topk(top_k, 1)[0]
+        if top_p >= 1:
+            kth = top_scores[:, -1:]
+            return scores.masked_fill_(scores < kth.expand_as(scores), -float('inf'))
+        max_scores = top_scores[:, :1]
+        probs = top_scores.sub(max_scores.expand_as(top_scores)).exp_()
+        probs.div_(probs.sum(1, keepdim=True).expand_as(probs))
+    elif top_p < 1:
+        max_scores = scores.max(1, keepdim=True)[0]
+        norm = scores.sub(max_scores.expand_as(scores)).exp_().sum(1, keepdim=True)
+        top_scores = scores.topk(min(nucleus_k, vocab_size), 1)[0]
+        probs = top_scores.sub(max_scores.expand_as(top_scores)).exp_().div_(norm.expand_as(top_scores))
+        if probs.sum(1).min() < top_p:
+            # Flat distribution in some row
+            top_scores = scores.sort(1, descending=True)[0]
+            probs = top_scores.sub(max_scores.expand_as(top_scores)).exp_().div_(norm.expand_as(top_scores))
+    else:
+        return scores
+    # Tokens before the one reaching top_p, plus that one
+    num_kept = (probs.cumsum(1) < top_p).long().sum(1, keepdim=True).clamp_(max=probs.size(1)-1)
+    threshold = top_scores.gather(1, num_kept)
+    return scores.masked_fill_(scores < threshold.expand_as(scores), -float('inf'))
+
 class Sampler(Generator):
+    """Sample responses token by token.
+
+    The distribution of each step can be truncated to the `top_k` tokens
+    and/or to the nucleus of probability `top_p` (see `truncate_scores`), and
+    restricted by an additive vocabulary mask (see `vocab_mask`). Each context
+    can be sampled `num_samples` times in one pass.
+    """
     def __init__(self, model, vocab,
-                 temperature=1, max_length=100, cuda=False):
+                 temperature=1, max_length=100, cuda=False,
+                 top_k=0, top_p=1., num_samples=1):
         self.model = model
         self.vocab = vocab
         self.temperature = temperature
@@ -273,12 +376,64 @@ class Sampler(Generator):
         self.cuda = cuda
         self.tt = torch.cuda if cuda else torch
         self.eos = vocab.to_ind(markers.EOS)
+        self.top_k = top_k
+        self.top_p = top_p
+        self.num_samples = num_samples
+        self.pad = vocab.to_ind(markers.PAD)
 
         # For debugging
         self.builder = UtteranceBuilder(vocab)
 
-    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
-        # (1) Run the encoder on the src.
+    def vocab_mask(self, allow=None, deny=None):
+        """Additive mask over the vocabulary (0 or -inf) that allows the token
+        ids in `allow` (all tokens if None) except the ones in `deny`. Build
+        it once, e.g. per session, and pass it to `generate_batch`. Every step
+        must have a token left, e.g. one allowed by the grammar of LFSampler.
+        """
+        mask = self.tt.FloatTensor(self.vocab.size)
+        if allow is None:
+            mask.zero_()
+        else:
+            mask.fill_(-float('inf'))
+            mask[self.tt.LongTensor(list(allow))] = 0
+        if deny:
+            mask[self.tt.LongTensor(list(deny))] = -float('inf')
+        return mask
+
+    def sample(self, out, temperature=None, mask=None):
+        """Sample one token per row.
+
+        Args:
+            out (FloatTensor): batch x vocab log probabilities
+            temperature (float or FloatTensor): one for all rows or one per row
+                (default `self.temperature`)
+            mask (FloatTensor): additive mask, vocab or batch x vocab
+
+        Returns:
+            pred (LongTensor): (batch_size,)
+        """
+        if temperature is None:
+            temperature = self.temperature
+        if isinstance(temperature, (int, float)):
+            scores = out.div(temperature)
+        else:
+            scores = out.div(temperature.view(-1, 1).expand_as(out))
+        if mask is not None:
+            scores.add_(mask.view(-1, out.size(1)).expand_as(scores))
+        truncate_scores(scores, self.top_k, self.top_p)
+        scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
+        return torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
+
+    def _start_decoder(self, batch, gt_prefix, enc_state, num_samples):
+        """Run the encoder and the forced prefix, then repeat each row
+        `num_samples` times: rows are ordered by sample, then by example, as
+        in beam search.
+
+        Returns:
+            dec_out (Variable): (batch_size * num_samples, rnn_size)
+            dec_states (DecoderState)
+            memory (DecoderMemory)
+        """
         lengths = batch.lengths
         dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
         memory_bank = self._run_attention_memory(batch, enc_memory_bank)
@@ -287,31 +442,82 @@ class Sampler(Generator):
         inp = batch.decoder_inputs[:gt_prefix]
         dec_out, dec_states, _ = self.model.decoder(
             inp, memory_bank, dec_states, memory_lengths=lengths)
+        dec_out = dec_out.squeeze(0)  # (batch_size, rnn_size)
+
+        if num_samples > 1:
+            dec_out = dec_out.repeat(num_samples, 1)
+            memory_bank, lengths = self._repeat_memory(memory_bank, lengths, dec_states, num_samples)
+        memory = self.model.decoder.init_decoder_memory(memory_bank, lengths)
+        return dec_out, dec_states, memory
+
+    def _row_data(self, num_rows, num_samples, temperature=None, vocab_mask=None):
+        """Tensors with one entry per row of the batch (see `_start_decoder`
+        for the order of the rows): the temperature and vocabulary mask of
+        the row, its tokens and their log probabilities, and its number of
+        steps.
+        """
+        if temperature is None:
+            temperature = self.temperature
+        if isinstance(temperature, (int, float)):
+            temperature = self.tt.FloatTensor(num_rows).fill_(temperature)
+        else:
+            temperature = temperature.repeat(num_samples)
+        if vocab_mask is None:
+            vocab_mask = self.tt.FloatTensor(num_rows, self.vocab.size).zero_()
+        elif vocab_mask.dim() == 1:
+            vocab_mask = vocab_mask.repeat(num_rows, 1)
+        else:
+            vocab_mask = vocab_mask.repeat(num_samples, 1)
+        return {'temperature': temperature,
+                'vocab_mask': vocab_mask,
+                'preds': self.tt.LongTensor(num_rows, self.max_length).fill_(self.pad),
+                'log_probs': self.tt.FloatTensor(num_rows, self.max_length).zero_(),
+                'step': self.tt.LongTensor(num_rows).zero_(),
+                }
+
+    def _start_rows(self, batch, gt_prefix, first_id, enc_state=None,
+                    temperature=None, vocab_mask=None, num_samples=None):
+        """ActiveBatch of the rows of `batch`, with ids from `first_id`.
+        """
+        num_samples = num_samples or self.num_samples
+        dec_out, dec_states, memory = self._start_decoder(batch, gt_prefix, enc_state, num_samples)
+        num_rows = batch.size * num_samples
+        ids = self.tt.LongTensor(range(first_id, first_id + num_rows))
+        data = self._row_data(num_rows, num_samples, temperature, vocab_mask)
+        return ActiveBatch(ids, dec_out, dec_states, memory, **data)
 
-        # (2) Sampling
-        batch_size = batch.size
-        preds = []
-        for i in xrange(self.max_length):
-            # Outputs to probs
-            dec_out = dec_out.squeeze(0)  # (batch_size, rnn_size)
-            out = self.model.generator.forward(dec_out).data  # Logprob (batch_size, vocab_size)
-            # Sample with temperature
-            scores = out.div(self.temperature)
-            scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
-            pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
-            preds.append(pred)
-            # Forward step
-            inp = Variable(pred.view(1, -1))  # (seq_len=1, batch_size)
-            dec_out, dec_states, _ = self.model.decoder(
-                inp, memory_bank, dec_states, memory_lengths=lengths)
+    def _sample_rows(self, out, data):
+        """Sample the next token of each live row.
 
-        preds = torch.stack(preds).t()  # (batch_size, seq_len)
-        # Insert one dimension (n_best) so that its structure is consistent
-        # with beam search generator
-        preds = preds.unsqueeze(1)
-        # TODO: add actual scores
+        Args:
+            out (FloatTensor): rows x vocab log probabilities
+            data (dict): the data of the live rows (see `_row_data`)
+        """
+        return self.sample(out, data['temperature'], data['vocab_mask'])
+
+    def _sum_log_probs(self, preds, log_probs):
+        """Log probability of each sample up to its first EOS.
+
+        Args:
+            preds (LongTensor): seq_len x batch_size sampled tokens
+            log_probs (FloatTensor): seq_len x batch_size their log probabilities
+        """
+        eos = preds.eq(self.eos).long()
+        after_eos = (eos.cumsum(0) - eos).gt(0)
+        return log_probs.masked_fill_(after_eos, 0).sum(0)
+
+    def _output(self, batch, num_samples, data, dec_states):
+        batch_size = batch.size
+        seq_len = int(data['step'].max())
+        preds = data['preds'][:, :seq_len].t()  # (seq_len, batch_size * num_samples)
+        scores = self._sum_log_probs(preds, data['log_probs'][:, :seq_len].t())
+        preds = preds.t()
+        # Samples of an example go in the n_best dimension so that the
+        # structure is consistent with beam search generator
+        preds = preds.contiguous().view(num_samples, batch_size, -1).transpose(0, 1)
+        scores = scores.view(num_samples, batch_size).t().tolist()
         ret = {"predictions": preds,
-               "scores": [[0]] * batch_size,
+               "scores": scores,
                "attention": [None] * batch_size,
                "dec_states": dec_states,
                }
@@ -320,6 +526,137 @@ class Sampler(Generator):
         ret["batch"] = batch
         return ret
 
+    def generate_batch(self, batch, gt_prefix=1, enc_state=None,
+                       temperature=None, vocab_mask=None, num_samples=None):
+        """Sample `num_samples` (default `self.num_samples`) responses per
+        example. Each row stops at its EOS (or at `max_length`) and is
+        evicted from the batch, see `generate_stream`.
+
+        Args:
+            temperature (float or FloatTensor): see `sample`; per-row values are
+                given for each example of the batch
+            vocab_mask (FloatTensor): see `vocab_mask`; vocab or
+                batch x vocab (one mask per example)
+
+        Returns:
+            predictions (LongTensor): batch x num_samples x seq_len, padded
+                after EOS
+            scores: log probability of each sample (up to EOS) for each example
+            dec_states: decoder states of the batch_size * num_samples rows
+                at their EOS (see `_cat_states`)
+        """
+        request = (batch, {'enc_state': enc_state, 'temperature': temperature,
+                           'vocab_mask': vocab_mask, 'num_samples': num_samples})
+        for _, output in self.generate_stream([request], gt_prefix=gt_prefix):
+            return output
+
+    def generate_stream(self, requests, max_rows=None, gt_prefix=1):
+        """Sample responses for a stream of requests with continuous batching:
+        the rows of the requests in progress are decoded in one batch (an
+        ActiveBatch), rows are evicted from it as they finish, and the next
+        requests join it at step boundaries as long as it has at most
+        `max_rows` rows (a request always joins an empty batch). Joining a
+        batch in progress needs decoder states that can be concatenated (RNN
+        decoders); otherwise the requests are decoded one after the other.
+
+        Args:
+            requests: iterable of batches, or of (batch, kwargs) where kwargs
+                are options of `generate_batch` (enc_state, temperature,
+                vocab_mask, num_samples)
+            max_rows (int): maximum number of rows (None: no maximum)
+
+        Yields:
+            (i, output): the position of a request in `requests` and its output
+            (see `generate_batch`), as requests finish
+        """
+        requests = enumerate(requests)
+        next_request = next(requests, None)
+        active = ActiveBatch(None, None, None, None)
+        pending = {}
+        next_id = 0
+        # Whether the decoder states can be concatenated
+        can_join = None
+        while next_request is not None or len(active) > 0:
+            num_rows = len(active)
+            # (1) New requests join at a step boundary
+            joining = []
+            while next_request is not None:
+                i, request = next_request
+                batch, kwargs = request if isinstance(request, tuple) else (request, {})
+                num_samples = kwargs.get('num_samples') or self.num_samples
+                if num_rows > 0 and (not can_join or
+                        (max_rows and num_rows + batch.size * num_samples > max_rows)):
+                    break
+                rows = self._start_rows(batch, gt_prefix, next_id, **kwargs)
+                if can_join is None:
+                    can_join = hasattr(rows.dec_states, 'cat')
+                rows.data['request'] = rows.ids.new(len(rows)).fill_(i)
+                pending[i] = {'batch': batch, 'num_samples': num_samples,
+                              'rows': [], 'num_finished': 0}
+                joining.append(rows)
+                next_id += len(rows)
+                num_rows += len(rows)
+                next_request = next(requests, None)
+            if joining:
+                active.join(joining)
+
+            # (2) Sample the next token of each row
+            out = self.model.generator.forward(active.dec_out).data  # Logprob (rows, vocab_size)
+            data = active.data
+            pred = self._sample_rows(out, data)
+            step = data['step'].view(-1, 1)
+            data['preds'].scatter_(1, step, pred.view(-1, 1))
+            data['log_probs'].scatter_(1, step, out.gather(1, pred.view(-1, 1)))
+            data['step'].add_(1)
+            data['pred'] = pred
+
+            # (3) Evict finished rows and return the requests they complete
+            done = pred.eq(self.eos).masked_fill_(data['step'].ge(self.max_length), 1)
+            finished = active.evict(done)
+            if finished is not None:
+                for i, output in self._finish_requests(finished, pending):
+                    yield i, output
+
+            # (4) Forward step
+            if len(active) > 0:
+                inp = Variable(active.data.pop('pred').view(1, -1))  # (seq_len=1, rows)
+                active.dec_out, active.dec_states, _ = self.model.decoder.decode_step(
+                    inp, active.memory, active.dec_states)
+
+    def _finish_requests(self, finished, pending):
+        """Collect the finished rows of each pending request; yield the output
+        of the requests whose rows are all finished.
+        """
+        ids, data, dec_states = finished
+        for i in sorted(set(data['request'].tolist())):
+            request = pending[i]
+            index = data['request'].eq(i).nonzero().view(-1)
+            request['rows'].append((ids.index_select(0, index), select_rows(data, index),
+                                    dec_states.index_select(index)))
+            request['num_finished'] += index.size(0)
+            batch, num_samples = request['batch'], request['num_samples']
+            if request['num_finished'] < batch.size * num_samples:
+                continue
+            del pending[i]
+            # Rows in the order of their ids
+            chunks = zip(*request['rows'])
+            order = cat_rows(list(chunks[0])).sort()[1]
+            rows_data = select_rows(cat_rows(list(chunks[1])), order)
+            yield i, self._output(batch, num_samples, rows_data, self._cat_states(chunks[2], order))
+
+    def _cat_states(self, states, order):
+        """Decoder states of the rows of `states` in one batch, in `order`;
+        None if they cannot be concatenated (Transformer decoder states of
+        rows that finished at different steps).
+        """
+        if len(states) == 1:
+            state = states[0]
+        elif hasattr(states[0], 'cat'):
+            state = type(states[0]).cat(list(states))
+        else:
+            return None
+        return state.index_select(order)
+
 class LMSampler(Sampler):
     def generate_batch(self, batch, gt_prefix=1, enc_state=None):
         # (1.1) Go over forced prefix.
@@ -334,10 +671,7 @@ class LMSampler(Sampler):
             # Outputs to probs
             dec_out = dec_out.squeeze(0)  # (batch_size, rnn_size)
             out = self.model.generator.forward(dec_out).data  # Logprob (batch_size, vocab_size)
-            # Sample with temperature
-            scores = out.div(self.temperature)
-            scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
-            pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
+            pred = self.sample(out)
             preds.append(pred)
             # Forward step
             inp = Variable(pred.view(1, -1))  # (seq_len=1, batch_size)
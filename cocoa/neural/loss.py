@@ -1,8 +1,10 @@
 import time
 import torch
 import torch.nn as nn
+from torch.autograd import Variable
 
-from onmt.Loss import LossComputeBase
+import onmt
+from onmt.Loss import LossComputeBase, shards
 from onmt.Utils import aeq
 
 from symbols import markers
@@ -11,12 +13,17 @@ from symbols import markers
 class SimpleLossCompute(LossComputeBase):
     """
     Simpler Loss Computation class - does not perform Truncated BPTT,
-        removes label_smoothing, confidence-scores and sharding
+        removes label_smoothing and confidence-scores
+
+    With `shard_size` > 0, `sharded_compute_loss` runs the generator and the
+    loss on `shard_size` time steps at a time and back-propagates each shard,
+    so that the scores over the vocabulary are never built for the whole batch.
     """
-    def __init__(self, generator, tgt_vocab):
+    def __init__(self, generator, tgt_vocab, shard_size=0):
         super(LossComputeBase, self).__init__()
         self.generator = generator
         self.padding_idx = tgt_vocab.to_ind(markers.PAD)
+        self.shard_size = shard_size
         weight = torch.ones(tgt_vocab.size)
         weight[self.padding_idx] = 0
         self.criterion = nn.NLLLoss(weight, size_average=False)
@@ -31,13 +38,34 @@ class SimpleLossCompute(LossComputeBase):
         stats = self._stats(loss_data, scores.data, target.view(-1).data)
         return loss, stats
 
+    def sharded_compute_loss(self, target, output, normalization=1.):
+        """Compute the loss and back-propagate it (divided by `normalization`),
+        one shard of time steps at a time.
+
+        Returns:
+            :obj:`onmt.Statistics`: loss statistics
+        """
+        if not self.shard_size:
+            loss, stats = self.compute_loss(target, output)
+            loss.div(normalization).backward()
+            return stats
+
+        batch_stats = onmt.Statistics()
+        shard_state = {'target': target, 'output': output}
+        for shard in shards(shard_state, self.shard_size):
+            loss, stats = self.compute_loss(**shard)
+            loss.div(normalization).backward()
+            batch_stats.update(stats)
+        return batch_stats
+
 class ReinforceLossCompute(SimpleLossCompute):
     """Compute loss/reward for REINFORCE.
     """
-    def __init__(self, generator, tgt_vocab):
+    def __init__(self, generator, tgt_vocab, shard_size=0):
         super(LossComputeBase, self).__init__()
         self.generator = generator
         self.padding_idx = tgt_vocab.to_ind(markers.PAD)
+        self.shard_size = shard_size
         weight = torch.ones(tgt_vocab.size)
         weight[self.padding_idx] = 0
         self.criterion = nn.NLLLoss(weight, size_average=False, reduce=False)
@@ -52,3 +80,15 @@ class ReinforceLossCompute(SimpleLossCompute):
         gtruth = target.contiguous().view(-1)
         loss = self.criterion(scores, gtruth).view(-1, batch_size)  # (seq_len, batch_size)
         return loss, None
+
+    def sharded_compute_loss(self, target, output, rewards):
+        """Back-propagate the NLL of each token weighted by its (discounted)
+        reward, one shard of time steps at a time.
+
+        Args:
+            rewards (FloatTensor): (seq_len, batch_size)
+        """
+        shard_state = {'target': target, 'output': output, 'rewards': rewards}
+        for shard in shards(shard_state, self.shard_size or target.size(0)):
+            nll, _ = self.compute_loss(shard['target'], shard['output'])
+            (nll * Variable(shard['rewards'])).sum().backward()
@@ -1,4 +1,5 @@
 from __future__ import division
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -8,7 +9,8 @@ from torch.nn.utils.rnn import pack_padded_sequence as pack
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 
 import onmt
-from onmt.Utils import aeq
+from onmt.Models import DecoderMemory
+from onmt.Utils import aeq, padding_mask, select_rows, cat_rows
 
 from attention import MultibankGlobalAttention, GlobalAttention, MultibankConcatGlobalAttention
 
@@ -288,11 +290,16 @@ class RNNDecoderBase(nn.Module):
             self._copy = True
         self._reuse_copy_attn = reuse_copy_attn
 
-    def get_final_non_pad_output(self, tgt, outputs):
+    def get_lengths(self, tgt):
+        """Number of non-PAD tokens in each row of `tgt` (at least 1).
+        """
         # non-pad elements are 1
         mask = torch.eq(tgt, self.pad).long().eq(0).long()  # (seq_len, batch_size)
-        last_ind = torch.sum(mask, dim=0, keepdim=True) - 1  # (1, batch_size)
-        last_ind = torch.max(last_ind, torch.zeros_like(last_ind))  # (1, batch_size)
+        lengths = torch.sum(mask, dim=0)  # (batch_size,)
+        return torch.max(lengths, torch.ones_like(lengths))
+
+    def get_final_non_pad_output(self, tgt, outputs):
+        last_ind = self.get_lengths(tgt).unsqueeze(0) - 1  # (1, batch_size)
         # outputs: (seq_len, batch_size, rnn_size)
         gather_ind = last_ind.unsqueeze(2).expand(1, outputs.size(1), outputs.size(2))
         final_output = torch.gather(outputs, 0, gather_ind).squeeze(0)  # (batch_size, rnn_size)
@@ -348,6 +355,29 @@ class RNNDecoderBase(nn.Module):
 
         return decoder_outputs, state, attns
 
+    def init_decoder_memory(self, memory_banks, memory_lengths=None):
+        """Prepare the memory bank(s) `[src_len x batch x hidden]` of a batch
+        for `decode_step`: banks are made batch-first and the attention keys
+        that do not depend on the query are computed, once per batch.
+        """
+        if isinstance(memory_banks, list):
+            return DecoderMemory([bank.transpose(0, 1) for bank in memory_banks], memory_lengths)
+        banks = memory_banks.transpose(0, 1)
+        pad_mask = None
+        if memory_lengths is not None:
+            pad_mask = padding_mask(memory_lengths, banks.size(1))
+        return DecoderMemory(banks, memory_lengths, self.attn.memory_keys(banks), pad_mask)
+
+    def _attend(self, query, memory, coverage=None):
+        # Only the attention over one bank takes keys
+        kwargs = {}
+        if memory.keys is not None:
+            kwargs['memory_keys'] = memory.keys
+        if memory.pad_mask is not None:
+            kwargs['pad_mask'] = memory.pad_mask
+        return self.attn(query, memory.banks, memory_lengths=memory.lengths,
+                         coverage=coverage, **kwargs)
+
     def init_decoder_state(self, src, memory_bank, encoder_final):
         def _fix_enc_hidden(h):
             # The encoder hidden is  (layers*directions) x batch x dim.
@@ -393,6 +423,8 @@ class StdRNNDecoder(RNNDecoderBase):
             state (FloatTensor): hidden state from the encoder RNN for
                                  initializing the decoder.
             memory_lengths (LongTensor): the source memory_bank lengths.
+            lengths (LongTensor): the target lengths `[batch]`; counted from
+                                 the PAD tokens in `tgt` if not given.
         Returns:
             decoder_final (Variable): final hidden state from the decoder.
             decoder_outputs ([FloatTensor]): an array of output of every time
@@ -407,37 +439,19 @@ class StdRNNDecoder(RNNDecoderBase):
         # Initialize local and return variables.
         attns = {}
         emb = self.embeddings(tgt)
+        tgt_len, tgt_batch = tgt.size()
 
-        lengths = None
-        # TODO: Sort and pad emb
-        packed_emb = emb  # (seq_len, batch_size, emb_size)
-        #if lengths is not None:
-        #    lengths, ind = torch.sort(lengths, 0, descending=True)  # (batch_size,)
-        #    gather_inds = Variable(ind.view(1, -1, 1).expand(*emb.size()))
-        #    sorted_emb = torch.gather(emb, 1, gather_inds)
-        #    packed_emb = pack(sorted_emb, lengths.view(-1).tolist())
-
-        # Run the forward pass of the RNN.
-        if isinstance(self.rnn, nn.GRU):
-            rnn_output, decoder_final = self.rnn(packed_emb, state.hidden[0])
+        # Run the forward pass of the RNN. Skip the PAD positions when some
+        # rows are shorter (teacher forcing), so that the final state of each
+        # row is that after its last token.
+        if lengths is None and tgt_len > 1 and self.pad is not None:
+            lengths = self.get_lengths(tgt.data)
+        if lengths is not None and lengths.min() < tgt_len:
+            rnn_output, decoder_final = self._run_packed_rnn(emb, state.hidden, lengths)
         else:
-            rnn_output, decoder_final = self.rnn(packed_emb, state.hidden)
-
-        ## TODO: Unsort output and final
-        #def unsort(t, ind, dim):
-        #    gather_inds = Variable(ind.view(1, -1, 1).expand(*t.size()))
-        #    t.scatter_(dim, gather_inds, t)
-        #    return t
-
-        #if lengths is not None:
-        #    rnn_output = unpack(rnn_output)[0]
-        #    rnn_output = unsort(rnn_output, ind, 1)
-        #    h = unsort(decoder_final[0], ind, 1)
-        #    c = unsort(decoder_final[1], ind, 1)
-        #    decoder_final = (h, c)
+            rnn_output, decoder_final = self._run_rnn(emb, state.hidden)
 
         # Check
-        tgt_len, tgt_batch = tgt.size()
         output_len, output_batch, _ = rnn_output.size()
         aeq(tgt_len, output_len)
         aeq(tgt_batch, output_batch)
@@ -470,6 +484,60 @@ class StdRNNDecoder(RNNDecoderBase):
         decoder_outputs = self.dropout(decoder_outputs)
         return decoder_final, decoder_outputs, attns
 
+    def decode_step(self, input, memory, state):
+        """Run the decoder on one token per row, as `forward` does on a
+        `[1 x batch]` target.
+
+        Args:
+            input (`LongTensor`): tokens `[1 x batch]`
+            memory (:obj:`DecoderMemory`): from `init_decoder_memory`
+            state (:obj:`RNNDecoderState`): updated in place
+        Returns:
+            decoder_output (`FloatTensor`): `[batch x hidden]`
+            state (:obj:`RNNDecoderState`)
+            attns (dict): attention distributions `{"std": [batch x src_len]}`
+        """
+        emb = self.embeddings(input)
+        rnn_output, decoder_final = self._run_rnn(emb, state.hidden)
+        decoder_output, p_attn = self._attend(rnn_output.transpose(0, 1).contiguous(), memory)
+        decoder_output, p_attn = decoder_output.squeeze(0), p_attn.squeeze(0)
+        if self.context_gate is not None:
+            decoder_output = self.context_gate(
+                emb.squeeze(0), rnn_output.squeeze(0), decoder_output)
+        decoder_output = self.dropout(decoder_output)
+        state.update_state(decoder_final, decoder_output.unsqueeze(0), None)
+        return decoder_output, state, {"std": p_attn}
+
+    def _run_rnn(self, inputs, hidden):
+        if isinstance(self.rnn, nn.GRU):
+            return self.rnn(inputs, hidden[0])
+        return self.rnn(inputs, hidden)
+
+    def _run_packed_rnn(self, emb, hidden, lengths):
+        """Run the RNN on the first `lengths` steps of each row. Outputs at
+        the other steps are zeros.
+        """
+        # pack needs rows sorted by length
+        lengths, ind = torch.sort(lengths, 0, descending=True)
+        _, unsort_ind = torch.sort(ind, 0)
+        ind, unsort_ind = Variable(ind), Variable(unsort_ind)
+        packed_emb = pack(emb.index_select(1, ind), lengths.tolist())
+        hidden = tuple(h.index_select(1, ind) for h in hidden)
+
+        rnn_output, decoder_final = self._run_rnn(packed_emb, hidden)
+
+        rnn_output = unpack(rnn_output)[0].index_select(1, unsort_ind)
+        tgt_len = emb.size(0)
+        if rnn_output.size(0) < tgt_len:
+            # All rows end before tgt_len
+            padding = rnn_output.data.new(tgt_len - rnn_output.size(0), *rnn_output.size()[1:]).zero_()
+            rnn_output = torch.cat([rnn_output, Variable(padding)], 0)
+        if isinstance(decoder_final, tuple):
+            decoder_final = tuple(h.index_select(1, unsort_ind) for h in decoder_final)
+        else:
+            decoder_final = decoder_final.index_select(1, unsort_ind)
+        return rnn_output, decoder_final
+
     def _build_rnn(self, rnn_type, **kwargs):
         rnn, _ = rnn_factory(rnn_type, **kwargs)
         return rnn
@@ -509,10 +577,11 @@ class InputFeedRNNDecoder(RNNDecoderBase):
           G --> H
     """
 
-    def _run_forward_pass(self, tgt, memory_bank, state, memory_lengths=None):
+    def _run_forward_pass(self, tgt, memory_bank, state, memory_lengths=None, lengths=None):
         """
         See StdRNNDecoder._run_forward_pass() for description
-        of arguments and return values.
+        of arguments and return values. `lengths` is not used: the RNN runs
+        one step at a time.
         """
         # Additional args check.
         input_feed = state.input_feed.squeeze(0)
@@ -535,45 +604,64 @@ class InputFeedRNNDecoder(RNNDecoderBase):
         hidden = state.hidden
         coverage = state.coverage.squeeze(0) \
             if state.coverage is not None else None
+        memory = DecoderMemory(memory_bank.transpose(0, 1), memory_lengths)
 
         # Input feed concatenates hidden state with
         # input at every time step.
         for i, emb_t in enumerate(emb.split(1)):
-            emb_t = emb_t.squeeze(0)
-            decoder_input = torch.cat([emb_t, input_feed], 1)
-
-            rnn_output, hidden = self.rnn(decoder_input, hidden)
-            decoder_output, p_attn = self.attn(
-                rnn_output,
-                memory_bank.transpose(0, 1),
-                memory_lengths=memory_lengths)
-            if self.context_gate is not None:
-                # TODO: context gate should be employed
-                # instead of second RNN transform.
-                decoder_output = self.context_gate(
-                    decoder_input, rnn_output, decoder_output
-                )
-            decoder_output = self.dropout(decoder_output)
-
+            decoder_output, hidden, step_attns, coverage = self._run_step(
+                emb_t.squeeze(0), input_feed, hidden, coverage, memory)
+            input_feed = decoder_output
             decoder_outputs += [decoder_output]
-            attns["std"] += [p_attn]
-
-            # Update the coverage attention.
-            if self._coverage:
-                coverage = coverage + p_attn \
-                    if coverage is not None else p_attn
-                attns["coverage"] += [coverage]
-
-            # Run the forward pass of the copy attention layer.
-            if self._copy and not self._reuse_copy_attn:
-                _, copy_attn = self.copy_attn(decoder_output,
-                                              memory_bank.transpose(0, 1))
-                attns["copy"] += [copy_attn]
-            elif self._copy:
-                attns["copy"] = attns["std"]
+            for k in step_attns:
+                attns[k] += [step_attns[k]]
+
         # Return result.
+        decoder_outputs = torch.stack(decoder_outputs)
+        for k in attns:
+            attns[k] = torch.stack(attns[k])
         return hidden, decoder_outputs, attns
 
+    def _run_step(self, emb_t, input_feed, hidden, coverage, memory):
+        decoder_input = torch.cat([emb_t, input_feed], 1)
+
+        rnn_output, hidden = self.rnn(decoder_input, hidden)
+        decoder_output, p_attn = self._attend(rnn_output, memory)
+        if self.context_gate is not None:
+            # TODO: context gate should be employed
+            # instead of second RNN transform.
+            decoder_output = self.context_gate(
+                decoder_input, rnn_output, decoder_output
+            )
+        decoder_output = self.dropout(decoder_output)
+        attns = {"std": p_attn}
+
+        # Update the coverage attention.
+        if self._coverage:
+            coverage = coverage + p_attn \
+                if coverage is not None else p_attn
+            attns["coverage"] = coverage
+
+        # Run the forward pass of the copy attention layer.
+        if self._copy and not self._reuse_copy_attn:
+            _, copy_attn = self.copy_attn(decoder_output, memory.banks)
+            attns["copy"] = copy_attn
+        elif self._copy:
+            attns["copy"] = p_attn
+        return decoder_output, hidden, attns, coverage
+
+    def decode_step(self, input, memory, state):
+        """See StdRNNDecoder.decode_step()."""
+        coverage = state.coverage.squeeze(0) \
+            if state.coverage is not None else None
+        decoder_output, hidden, attns, coverage = self._run_step(
+            self.embeddings(input).squeeze(0), state.input_feed.squeeze(0),
+            state.hidden, coverage, memory)
+        if coverage is not None:
+            coverage = coverage.unsqueeze(0)
+        state.update_state(hidden, decoder_output.unsqueeze(0), coverage)
+        return decoder_output, state, attns
+
     def _build_rnn(self, rnn_type, input_size,
                    hidden_size, num_layers, dropout):
         assert not rnn_type == "SRU", "SRU doesn't support input feed! " \
@@ -710,6 +798,24 @@ class RNNDecoderState(DecoderState):
         self.hidden = tuple(vars[:-1])
         self.input_feed = vars[-1]
 
+    def index_select(self, index):
+        """ The state of the rows `index` of the batch. """
+        state = copy.copy(self)
+        state.update_state(select_rows(self.hidden, index, 1),
+                           select_rows(self.input_feed, index, 1),
+                           select_rows(self.coverage, index, 1))
+        return state
+
+    @staticmethod
+    def cat(states):
+        """ The state of the rows of `states` in one batch. """
+        state = copy.copy(states[0])
+        state.update_state(cat_rows([s.hidden for s in states], 1),
+                           cat_rows([s.input_feed for s in states], 1),
+                           cat_rows([s.coverage for s in states], 1,
+                                    pad_dim=2))
+        return state
+
 class MultiAttnDecoder(StdRNNDecoder):
 
     def __init__(self, rnn_type, bidirectional_encoder, num_layers,
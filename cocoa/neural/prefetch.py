@@ -0,0 +1,75 @@
+"""Build batches in a background thread while the model trains.
+"""
+
+import sys
+import time
+import threading
+from Queue import Queue
+
+
+class _End(object):
+    def __init__(self, exc_info=None):
+        self.exc_info = exc_info
+
+
+class BatchPrefetcher(object):
+    """Iterate over `iterable` with up to `depth` items built ahead of time.
+
+    Items are produced by a background thread in the same order as
+    `iterable`, including None (end-of-dialogue) markers, so it can wrap
+    `DataGenerator.generator` directly. Building a `Batch` (sorting, numpy
+    reshaping, tensor conversion and copying to GPU) then overlaps with the
+    forward/backward pass.
+
+    Attributes:
+        stall_time (float): seconds the consumer waited on an empty queue.
+        num_items (int): number of items consumed so far.
+        mean_queue_depth (float): average number of ready items when the
+            consumer asked for the next one.
+    """
+    def __init__(self, iterable, depth=4):
+        assert depth > 0
+        self.queue = Queue(maxsize=depth)
+        self.stall_time = 0.
+        self.num_items = 0
+        self.total_queue_depth = 0
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, args=(iter(iterable),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                self.queue.put(item)
+        except Exception:
+            self.queue.put(_End(sys.exc_info()))
+            return
+        self.queue.put(_End())
+
+    @property
+    def mean_queue_depth(self):
+        return self.total_queue_depth / float(max(self.num_items, 1))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        self.total_queue_depth += self.queue.qsize()
+        start_time = time.time()
+        item = self.queue.get()
+        self.stall_time += time.time() - start_time
+        if isinstance(item, _End):
+            self._done = True
+            self._thread.join()
+            if item.exc_info is not None:
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            raise StopIteration
+        self.num_items += 1
+        return item
+
+    def stats(self):
+        return 'prefetch queue depth %.1f, stalled %.1f s over %d items' % \
+                (self.mean_queue_depth, self.stall_time, self.num_items)
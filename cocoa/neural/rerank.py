@@ -0,0 +1,115 @@
+"""Rerank candidate responses by model score and task utility.
+"""
+import time
+import torch
+
+from generator import Sampler
+from symbols import markers
+
+
+class Reranker(object):
+    """Generate `num_candidates` responses per example in one pass of the
+    generator (samples, or the n-best hypotheses of beam search), rescore them
+    in one teacher-forced pass (see `Generator.score_batch`) and keep the best
+    one according to
+        log p(response) / lp(length) + weight * utility(tokens, kb)
+    where lp is the length penalty of beam search (`alpha`) and `utility` a
+    task function of the tokens built by the UtteranceBuilder (0 if None).
+
+    With a latency `budget` (seconds per call), the candidates are not
+    rescored once generating them took the whole budget (the first one is
+    kept), and the number of candidates is halved after a call over budget and
+    increased again (up to `num_candidates`) after calls under half of it.
+    """
+    def __init__(self, generator, builder, num_candidates, utility=None, weight=1.,
+                 alpha=0., budget=None):
+        if not isinstance(generator, Sampler) and generator.n_best < num_candidates:
+            raise ValueError('Beam search returns {} hypotheses (n_best); {} candidates cannot be '
+                             'reranked'.format(generator.n_best, num_candidates))
+        self.generator = generator
+        self.builder = builder
+        self.max_candidates = num_candidates
+        self.num_candidates = num_candidates
+        self.utility = utility
+        self.weight = weight
+        self.alpha = alpha
+        self.budget = budget
+        self.pad = generator.vocab.to_ind(markers.PAD)
+
+        # Calls that returned the first candidate because of the budget
+        self.num_skipped = 0
+
+    def _candidates(self, predictions):
+        """Candidates as a batch_size x num_candidates x seq_len LongTensor.
+        """
+        if torch.is_tensor(predictions):
+            return predictions
+        # n-best hypotheses of beam search, of different lengths
+        num_candidates = min([self.num_candidates] + [len(hyps) for hyps in predictions])
+        seq_len = max(len(hyp) for hyps in predictions for hyp in hyps[:num_candidates])
+        candidates = torch.LongTensor(len(predictions), num_candidates, seq_len).fill_(self.pad)
+        for i, hyps in enumerate(predictions):
+            for j, hyp in enumerate(hyps[:num_candidates]):
+                # Tokens of a hypothesis are ints or 0-dim tensors
+                candidates[i, j, :len(hyp)] = torch.LongTensor([int(token) for token in hyp])
+        return candidates
+
+    def _select_states(self, dec_states, best, candidates):
+        """The decoder states of the best sample of each example, where the
+        rows of `dec_states` are the samples of the batch, sample by sample.
+        """
+        batch_size = candidates.size(0)
+        rows = [k * batch_size + i for i, k in enumerate(best)]
+        return dec_states.index_select(candidates.new(rows))
+
+    def score(self, batch, candidates, kbs, gt_prefix=1, enc_state=None):
+        """Reranking score of each candidate: batch_size x num_candidates.
+        """
+        scores, lengths = self.generator.score_batch(batch, candidates, gt_prefix, enc_state)
+        if self.alpha:
+            scores.div_(lengths.float().add_(5).div_(6).pow_(self.alpha))
+        if self.utility is not None:
+            utilities = [[self.utility(self.builder.build_target_tokens(candidate, kb), kb)
+                          for candidate in example] for example, kb in zip(candidates, kbs)]
+            scores.add_(self.weight, scores.new(utilities))
+        return scores
+
+    def generate_batch(self, batch, kbs, gt_prefix=1, enc_state=None, **kwargs):
+        """Generate responses with the generator (`kwargs` are passed to its
+        `generate_batch`) and keep the best candidate of each example.
+
+        Returns:
+            The output of the generator, with "predictions" holding only the
+            best candidate (batch_size x 1 x seq_len) and "candidates" all
+            of them.
+        """
+        start_time = time.time()
+        if isinstance(self.generator, Sampler):
+            kwargs['num_samples'] = self.num_candidates
+        output_data = self.generator.generate_batch(batch, gt_prefix=gt_prefix, enc_state=enc_state, **kwargs)
+        candidates = self._candidates(output_data['predictions'])
+        batch_size, num_candidates = candidates.size(0), candidates.size(1)
+
+        if num_candidates == 1 or (self.budget and time.time() - start_time > self.budget):
+            best = [0] * batch_size
+            self.num_skipped += num_candidates > 1
+        else:
+            scores = self.score(batch, candidates, kbs, gt_prefix, enc_state)
+            best = scores.max(1)[1].view(-1).tolist()
+
+        # Only the sampler returns states: one row per sample
+        dec_states = output_data.get('dec_states')
+        if dec_states is not None and num_candidates > 1:
+            output_data['dec_states'] = self._select_states(dec_states, best, candidates)
+        output_data['candidates'] = candidates
+        output_data['predictions'] = candidates.gather(
+                1, candidates.new(best).view(-1, 1, 1).expand(batch_size, 1, candidates.size(2)))
+        if self.budget:
+            self._update_num_candidates(time.time() - start_time)
+        return output_data
+
+    def _update_num_candidates(self, elapsed):
+        if elapsed > self.budget:
+            self.num_candidates = max(1, self.num_candidates / 2)
+        elif elapsed < self.budget / 2.:
+            self.num_candidates = min(self.max_candidates, self.num_candidates + 1)
@@ -0,0 +1,70 @@
+"""Decode the live rows of a batch step by step.
+"""
+from onmt.Models import DecoderMemory
+from onmt.Utils import select_rows, cat_rows
+
+
+class ActiveBatch(object):
+    """The rows of a batch that are still being decoded step by step.
+
+    Rows that finish are evicted (see `evict`): their decoder state, memory
+    and data are index-selected away so that the next steps only run on the
+    live rows. The rows of other batches can join at a step boundary (see
+    `join`), which needs decoder states that can be concatenated (`cat` of
+    the RNN decoder states).
+
+    Args:
+        ids (LongTensor): id of each row `[rows]`
+        dec_out (Variable): decoder output of the last step `[rows x dim]`
+        dec_states (DecoderState)
+        memory (DecoderMemory)
+        data: tensors with one entry per row along their first dimension
+    """
+    def __init__(self, ids, dec_out, dec_states, memory, **data):
+        self.ids = ids
+        self.dec_out = dec_out
+        self.dec_states = dec_states
+        self.memory = memory
+        self.data = data
+
+    def __len__(self):
+        return 0 if self.ids is None else self.ids.size(0)
+
+    def evict(self, done):
+        """Remove the rows where `done` (`ByteTensor` `[rows]`) is 1.
+
+        Returns:
+            (ids, data, dec_states) of the removed rows, or None if no row
+            is done.
+        """
+        num_done = int(done.sum())
+        if num_done == 0:
+            return None
+        index = done.nonzero().view(-1)
+        finished = (self.ids.index_select(0, index), select_rows(self.data, index),
+                    self.dec_states.index_select(index))
+        if num_done == len(self):
+            self.ids = self.dec_out = self.dec_states = self.memory = None
+            self.data = {}
+        else:
+            index = done.eq(0).nonzero().view(-1)
+            self.ids = self.ids.index_select(0, index)
+            self.dec_out = select_rows(self.dec_out, index)
+            self.dec_states = self.dec_states.index_select(index)
+            self.memory = self.memory.index_select(index)
+            self.data = select_rows(self.data, index)
+        return finished
+
+    def join(self, others):
+        """Add the rows of the ActiveBatches `others` after the live rows.
+        """
+        batches = [self] + others if len(self) > 0 else others
+        if len(batches) == 1:
+            self.__dict__.update(batches[0].__dict__)
+            return self
+        self.ids = cat_rows([b.ids for b in batches])
+        self.dec_out = cat_rows([b.dec_out for b in batches])
+        self.dec_states = type(batches[0].dec_states).cat([b.dec_states for b in batches])
+        self.memory = DecoderMemory.cat([b.memory for b in batches])
+        self.data = cat_rows([b.data for b in batches])
+        return self
@@ -11,6 +11,7 @@ from onmt.Trainer import Statistics as BaseStatistics
 from onmt.Utils import use_gpu
 
 from cocoa.io.utils import create_path
+from cocoa.neural import distributed
 
 
 class Statistics(BaseStatistics):
@@ -48,12 +49,14 @@ class Trainer(object):
             optim(:obj:`onmt.Optim.Optim`):
                the optimizer responsible for update
             data_type(string): type of the source input: [text|img|audio]
-            norm_method(string): normalization methods: [sents|tokens]
-            grad_accum_count(int): accumulate gradients this many times.
+            norm_method(string): normalization of the summed loss of
+               accumulated batches: [none|tokens]
+            grad_accum_count(int): accumulate gradients over this many
+               batches (on every rank) before each update.
     """
 
     def __init__(self, model, train_loss, valid_loss, optim,
-                 data_type='text', norm_method="sents",
+                 data_type='text', norm_method="none",
                  grad_accum_count=1, utterance_builder=None):
         # Basic attributes.
         self.model = model
@@ -61,10 +64,12 @@ class Trainer(object):
         self.valid_loss = valid_loss
         self.optim = optim
         self.data_type = data_type
-        self.norm_method = norm_method # by sentences vs. by tokens
+        self.norm_method = norm_method # none vs. by tokens
         self.grad_accum_count = grad_accum_count
         self.cuda = False
         self.best_valid_loss = None
+        # Decoder state carried across batches of a dialogue (stateful models)
+        self.dec_state = None
 
         assert(grad_accum_count > 0)
 
@@ -84,17 +89,22 @@ class Trainer(object):
         print('\nStart training...')
         print(' * number of epochs: %d' % opt.epochs)
         print(' * batch size: %d' % opt.batch_size)
+        rank, world_size = distributed.get_rank(), distributed.get_world_size()
+        if world_size > 1:
+            print(' * rank %d of %d' % (rank, world_size))
+            distributed.broadcast_parameters(self.model)
 
         for epoch in range(opt.epochs):
             print('')
 
             # 1. Train for one epoch on the training set.
-            train_iter = data.generator('train', cuda=use_gpu(opt))
+            train_iter = data.generator('train', cuda=use_gpu(opt), prefetch=opt.prefetch, epoch=epoch,
+                    rank=rank, world_size=world_size)
             train_stats = self.train_epoch(train_iter, opt, epoch, report_func)
             print('Train loss: %g' % train_stats.mean_loss())
 
             # 2. Validate on the validation set.
-            valid_iter = data.generator('dev', cuda=use_gpu(opt))
+            valid_iter = data.generator('dev', cuda=use_gpu(opt), prefetch=opt.prefetch)
             valid_stats = self.validate(valid_iter)
             print('Validation loss: %g' % valid_stats.mean_loss())
 
@@ -110,7 +120,7 @@ class Trainer(object):
             self.epoch_step(valid_stats.ppl(), epoch)
 
             # 5. Drop a checkpoint if needed.
-            if epoch >= opt.start_checkpoint_at:
+            if epoch >= opt.start_checkpoint_at and distributed.is_master():
                 self.drop_checkpoint(opt, epoch, valid_stats)
 
 
@@ -131,29 +141,47 @@ class Trainer(object):
         report_stats = Statistics()
         true_batchs = []
         accum = 0
-        normalization = 0
         num_batches = train_iter.next()
         self.cuda = use_gpu(opt)
+        self.dec_state = None
+
+        # All ranks must take the same number of steps since gradients are
+        # reduced at each step; ranks with fewer batches take empty steps.
+        num_steps = int(math.ceil(num_batches / self.grad_accum_count))
+        num_steps = int(distributed.all_reduce_max(num_steps))
+        steps = 0
 
         for batch_idx, batch in enumerate(train_iter):
             true_batchs.append(batch)
-            accum += 1
+            # End-of-dialogue markers are kept to reset the decoder state
+            # but do not count as batches
+            if batch is not None:
+                accum += 1
 
             if accum == self.grad_accum_count:
                 self._gradient_accumulation(true_batchs, total_stats, report_stats)
                 true_batchs = []
                 accum = 0
+                steps += 1
 
             if report_func is not None:
                 report_stats = report_func(opt, epoch, batch_idx, num_batches,
                     total_stats.start_time, report_stats)
 
         # Accumulate gradients one last time if there are any leftover batches
-        # Should not run for us since we plan to accumulate gradients at every
-        # batch, so true_batches should always equal candidate batches
-        if len(true_batchs) > 0:
+        if accum > 0:
             self._gradient_accumulation(true_batchs, total_stats, report_stats)
             true_batchs = []
+            steps += 1
+        while steps < num_steps:
+            self._gradient_accumulation([], total_stats, report_stats)
+            steps += 1
+
+        elapsed = total_stats.elapsed_time()
+        print('Train throughput: %.1f batches/s, %.0f tgt tok/s' %
+              (num_batches / (elapsed + 1e-5), total_stats.n_words / (elapsed + 1e-5)))
+        if hasattr(train_iter, 'stats'):
+            print('Train data: %s' % train_iter.stats())
 
         return total_stats
 
@@ -247,24 +275,26 @@ class Trainer(object):
         raise NotImplementedError
 
     def _gradient_accumulation(self, true_batchs, total_stats, report_stats):
-        if self.grad_accum_count > 1:
-            self.model.zero_grad()
+        """Accumulate gradients of `true_batchs` and take one optimizer step.
 
-        dec_state = None
+        Gradients are summed over batches and ranks, then divided by the
+        total number of target tokens if `norm_method` is 'tokens'.
+        """
+        self.model.zero_grad()
+
+        num_tokens = 0
         for batch in true_batchs:
             if batch is None:
-                dec_state = None
+                self.dec_state = None
                 continue
             elif not self.model.stateful:
-                dec_state = None
-            enc_state = dec_state.hidden if dec_state is not None else None
+                self.dec_state = None
+            enc_state = self.dec_state.hidden if self.dec_state is not None else None
 
-            self.model.zero_grad()
             outputs, attns, dec_state = self._run_batch(batch, None, enc_state)
 
-            loss, batch_stats = self.train_loss.compute_loss(batch.targets, outputs)
-            loss.backward()
-            self.optim.step()
+            batch_stats = self.train_loss.sharded_compute_loss(batch.targets, outputs)
+            num_tokens += float(batch_stats.n_words)
 
             total_stats.update(batch_stats)
             report_stats.update(batch_stats)
@@ -272,3 +302,11 @@ class Trainer(object):
             # Don't backprop fully.
             if dec_state is not None:
                 dec_state.detach()
+            self.dec_state = dec_state
+
+        num_tokens = distributed.all_reduce_sum(num_tokens)
+        if num_tokens == 0:
+            return
+        normalization = num_tokens if self.norm_method == 'tokens' else 1.
+        distributed.all_reduce_gradients(self.model.parameters(), normalization)
+        self.optim.step()
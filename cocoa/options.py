@@ -56,6 +56,25 @@ def add_trainer_arguments(parser):
     #                    help='Data comes from a generator, which is unlimited, so we need to set some artificial limit.')
     group.add_argument('--epochs', type=int, default=14,
                        help='Number of training epochs')
+    group.add_argument('--grad-accum-count', type=int, default=1,
+                       help="""Accumulate gradients over this many batches
+                       before each update""")
+    group.add_argument('--normalization', default='none', choices=['none', 'tokens'],
+                       help="""Divide the summed loss of each update by the
+                       number of target tokens (over all accumulated batches
+                       and processes), or use the sum as is""")
+    group.add_argument('--world-size', type=int, default=1,
+                       help="""Number of processes for CPU data-parallel
+                       training (torch.distributed with gloo)""")
+    group.add_argument('--dist-init-method', default='tcp://127.0.0.1:23456',
+                       help='URL used by the processes to find each other')
+    group.add_argument('--prefetch', type=int, default=0,
+                       help="""Number of batches to build ahead of time in a
+                       background thread (0 to build them on the training thread)""")
+    group.add_argument('--shard-size', type=int, default=0,
+                       help="""Compute the generator and the loss on this many
+                       time steps at a time and back-propagate each shard, to
+                       save memory (0 for the whole batch at once)""")
     group.add_argument('--optim', default='sgd', help="""Optimization method.""",
                        choices=['sgd', 'adagrad', 'adadelta', 'adam'])
     group.add_argument('--max-grad-norm', type=float, default=5,
@@ -98,6 +117,10 @@ def add_rl_arguments(parser):
                        help='Number of training epochs')
     group.add_argument('--batch-size', type=int, default=64,
                        help='Maximum batch size for training')
+    group.add_argument('--shard-size', type=int, default=0,
+                       help="""Compute the generator and the loss on this many
+                       time steps at a time and back-propagate each shard, to
+                       save memory (0 for the whole batch at once)""")
     group.add_argument('--max-grad-norm', type=float, default=5,
                        help="""If the norm of the gradient vector exceeds this,
                        renormalize it to have the norm equal to max_grad_norm""")
@@ -132,6 +155,22 @@ def add_generator_arguments(parser):
                        help='Sample instead of beam search')
     group.add_argument('--temperature', type=float, default=1,
                 help="""Sample temperature""")
+    group.add_argument('--top-k', type=int, default=0,
+                help="""Sample from the k most likely tokens (0: all tokens)""")
+    group.add_argument('--top-p', type=float, default=1.,
+                help="""Sample from the most likely tokens whose probability reaches p (nucleus sampling)""")
+    group.add_argument('--num-samples', type=int, default=1,
+                help="""Number of responses sampled for each context in one pass""")
+
+    group = parser.add_argument_group('Rerank')
+    group.add_argument('--rerank-candidates', type=int, default=0,
+                help="""Number of candidate responses generated and reranked in sessions (samples, or the n-best of beam search, which needs --n-best at least as large)""")
+    group.add_argument('--rerank-utility', default='none',
+                help="""Task utility of a response added to its score, e.g. margin (craigslistbargain)""")
+    group.add_argument('--rerank-weight', type=float, default=1.,
+                help="""Weight of the utility""")
+    group.add_argument('--rerank-budget', type=float, default=None,
+                help="""Latency budget in seconds per response: fewer candidates after slow responses""")
 
     group = parser.add_argument_group('Efficiency')
     group.add_argument('--batch-size', type=int, default=30,
@@ -3,24 +3,15 @@ import json
 import re
 from collections import defaultdict
 from itertools import izip, ifilter
-import nltk
-from nltk.corpus import stopwords
-from nltk import pos_tag
-from nltk.tokenize import word_tokenize
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
 from cocoa.core.dataset import Example
 from cocoa.core.entity import Entity, is_entity, CanonicalEntity
+from cocoa.core.nltk_resources import pos_tag, sent_tokenize
 
 from core.scenario import Scenario
 from core.tokenizer import tokenize
 from speech_acts import SpeechActAnalyzer
 
-sent_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-nltk.download('stopwords')
-stopwords = set(stopwords.words('english'))
 
 class DialogueStage(object):
     INQUIRE = 0
@@ -87,7 +78,7 @@ class Turn(object):
     def from_event(cls, event, kbs, price_tracker):
         kb = kbs[event.agent]
         if event.action == 'message':
-            sents = sent_tokenizer.tokenize(event.data)
+            sents = sent_tokenize(event.data)
             utterances = [Utterance.from_text(sent, price_tracker, kb) for sent in sents]
         elif event.action == 'offer':
             utterances = [Utterance(str(event.data['price']), [], event.action)]
@@ -287,6 +278,9 @@ class Dialogue(object):
         Plot price trend and utterances by mpld3 and return the json dict for html rendering.
         '''
         import mpld3
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
         data = {k: [] for k in ('time_step', 'price', 'speech_acts', 'text', 'role')}
         turn_boundary = []
         stage_boundary = []
@@ -1,5 +1,6 @@
 import math
 import re
+import weakref
 from collections import defaultdict
 from itertools import chain
 
@@ -8,6 +9,11 @@ from cocoa.core.util import read_json, write_pickle, read_pickle
 
 from tokenizer import tokenize
 
+_currency_chars = re.compile(r'[\$\,]')
+_non_word_chars = re.compile(r'[^\w0-9\.,]')
+# float() only accepts strings with a digit or spelling out inf/nan
+_maybe_number = re.compile(r'\d|inf|nan', re.IGNORECASE | re.UNICODE)
+
 
 class PriceScaler(object):
     @classmethod
@@ -70,8 +76,14 @@ class PriceScaler(object):
         return price._replace(canonical=price.canonical._replace(value=p))
 
 class PriceTracker(object):
+    # Parsed numbers of numeric-looking tokens
+    _numbers = {}
+    _max_cached_numbers = 100000
+
     def __init__(self, model_path):
         self.model = read_pickle(model_path)
+        # Numbers and price parameters of each KB, dropped with the KB
+        self._kb_cache = weakref.WeakKeyDictionary()
 
     @classmethod
     def get_price(cls, token):
@@ -85,7 +97,7 @@ class PriceTracker(object):
 
     @classmethod
     def process_string(cls, token):
-        token = re.sub(r'[\$\,]', '', token)
+        token = _currency_chars.sub('', token)
         try:
             if token.endswith('k'):
                 token = str(float(token.replace('k', '')) * 1000)
@@ -93,6 +105,25 @@ class PriceTracker(object):
             pass
         return token
 
+    @classmethod
+    def parse_number(cls, token):
+        """Return the number denoted by the token, or None if it is not a number.
+        """
+        if not _maybe_number.search(token):
+            return None
+        try:
+            return cls._numbers[token]
+        except KeyError:
+            pass
+        try:
+            number = float(cls.process_string(token))
+        except ValueError:
+            number = None
+        if len(cls._numbers) >= cls._max_cached_numbers:
+            cls._numbers.clear()
+        cls._numbers[token] = number
+        return number
+
     def is_price(self, left_context, right_context):
         if left_context in self.model['left'] and right_context in self.model['right']:
             return True
@@ -100,60 +131,87 @@ class PriceTracker(object):
             return False
 
     def get_kb_numbers(self, kb):
-        title = tokenize(re.sub(r'[^\w0-9\.,]', ' ', kb.facts['item']['Title']))
-        description = tokenize(re.sub(r'[^\w0-9\.,]', ' ', ' '.join(kb.facts['item']['Description'])))
+        title = tokenize(_non_word_chars.sub(' ', kb.facts['item']['Title']))
+        description = tokenize(_non_word_chars.sub(' ', ' '.join(kb.facts['item']['Description'])))
         numbers = set()
         for token in chain(title, description):
-            try:
-                numbers.add(float(self.process_string(token)))
-            except ValueError:
-                continue
+            number = self.parse_number(token)
+            if number is not None:
+                numbers.add(number)
         return numbers
 
+    def get_kb_info(self, kb):
+        """Return cached (kb_numbers, list_price, scaling parameters) of the KB.
+        """
+        try:
+            return self._kb_cache[kb]
+        except KeyError:
+            pass
+        try:
+            params = PriceScaler.get_parameters(*PriceScaler.get_price_range(kb))
+        except AssertionError:
+            # Only fails if the price is actually scaled
+            params = None
+        info = (self.get_kb_numbers(kb), kb.facts['item']['Price'], params)
+        self._kb_cache[kb] = info
+        return info
+
+    @classmethod
+    def _scale_price(cls, kb, params, p):
+        if params is None:
+            return PriceScaler._scale_price(kb, p)
+        w, c = params
+        return float('{:.2f}'.format(w * p + c))
+
     def link_entity(self, raw_tokens, kb=None, scale=True, price_clip=None):
         tokens = ['<s>'] + raw_tokens + ['</s>']
         entity_tokens = []
         if kb:
-            kb_numbers = self.get_kb_numbers(kb)
-            list_price = kb.facts['item']['Price']
+            kb_numbers, list_price, params = self.get_kb_info(kb)
+        else:
+            params = None
+        inf = float('inf')
         for i in xrange(1, len(tokens)-1):
             token = tokens[i]
-            try:
-                number = float(self.process_string(token))
-                has_dollar = lambda token: token[0] == '$' or token[-1] == '$'
+            number = self.parse_number(token)
+            if number is not None:
+                has_dollar = token[0] == '$' or token[-1] == '$'
                 # Check context
-                if not has_dollar(token) and \
+                if not has_dollar and \
                         not self.is_price(tokens[i-1], tokens[i+1]):
                     number = None
                 # Avoid 'infinity' being recognized as a number
-                elif number == float('inf') or number == float('-inf'):
+                elif number == inf or number == -inf:
                     number = None
                 # Check if the price is reasonable
                 elif kb:
-                    if not has_dollar(token):
+                    if not has_dollar:
                         if number > 1.5 * list_price:
                             number = None
                         # Probably a spec number
                         if number != list_price and number in kb_numbers:
                             number = None
                     if number is not None and price_clip is not None:
-                        scaled_price = PriceScaler._scale_price(kb, number)
+                        scaled_price = self._scale_price(kb, params, number)
                         if abs(scaled_price) > price_clip:
                             number = None
-            except ValueError:
-                number = None
             if number is None:
                 new_token = token
             else:
                 assert not math.isnan(number)
                 if scale:
-                    scaled_price = PriceScaler._scale_price(kb, number)
+                    scaled_price = self._scale_price(kb, params, number)
                 else:
                     scaled_price = number
                 new_token = Entity(surface=token, canonical=CanonicalEntity(value=scaled_price, type='price'))
             entity_tokens.append(new_token)
         return entity_tokens
 
+    def link_entities(self, utterances, kb=None, scale=True, price_clip=None):
+        """Link entities in a list of tokenized utterances, e.g. a whole dialogue.
+        """
+        return [self.link_entity(tokens, kb=kb, scale=scale, price_clip=price_clip) for tokens in utterances]
+
     @classmethod
     def train(cls, examples, output_path=None):
         '''
@@ -1,11 +1,15 @@
-import nltk
-nltk.download('punkt')
-from nltk.tokenize import word_tokenize
 import re
 import string
 
+from cocoa.core.word_tokenizer import word_tokenize
+from cocoa.core.tokenizer import TokenCache
+
+number_re = re.compile(r'[.,0-9]+')
+dots_re = re.compile(r'\.{2,}')
+weird_chars_re = re.compile(r'\\|>|/')
+
 def is_number(s):
-    if re.match(r'[.,0-9]+', s):
+    if number_re.match(s):
         return True
     else:
         return False
@@ -53,22 +57,28 @@ def stick_marker_sign(tokens):
             in_brackets = False
     return new_tokens
 
-def tokenize(utterance, lowercase=True):
-    '''
-    'hi there!' => ['hi', 'there', '!']
-    '''
+def _tokenize(utterance, lowercase=True):
     #utterance = utterance.encode('utf-8')
     if lowercase:
         utterance = utterance.lower()
     # NLTK would not tokenize "xx..", so normalize dots to "...".
-    utterance = re.sub(r'\.{2,}', '...', utterance)
+    if '..' in utterance:
+        utterance = dots_re.sub('...', utterance)
     # Remove some weird chars
-    utterance = re.sub(r'\\|>|/', ' ', utterance)
+    utterance = weird_chars_re.sub(' ', utterance)
     tokens = word_tokenize(utterance)
     #tokens = stick_marker_sign(tokens)
-    tokens = stick_dollar_sign(tokens)
+    if '$' in utterance:
+        tokens = stick_dollar_sign(tokens)
     return tokens
 
+# tokenize(utterance, lowercase=True):
+#   'hi there!' => ['hi', 'there', '!']
+tokenize = TokenCache(_tokenize)
+
+def tokenize_batch(utterances, lowercase=True):
+    return tokenize.batch(utterances, lowercase)
+
 def detokenize(tokens):
     new_tokens = []
     for token in tokens:
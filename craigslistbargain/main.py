@@ -15,6 +15,7 @@ from cocoa.io.utils import read_json, write_json, read_pickle, write_pickle, cre
 from cocoa.core.schema import Schema
 from cocoa.neural.loss import SimpleLossCompute
 from cocoa.neural.trainer import Statistics
+from cocoa.neural import distributed
 
 import onmt
 from onmt.Utils import use_gpu
@@ -64,11 +65,12 @@ def build_optim(opt, model, checkpoint):
 def build_trainer(opt, model, vocab, optim):
     train_loss = make_loss(opt, model, vocab)
     valid_loss = make_loss(opt, model, vocab)
-    trainer = Trainer(model, train_loss, valid_loss, optim)
+    trainer = Trainer(model, train_loss, valid_loss, optim,
+            norm_method=opt.normalization, grad_accum_count=opt.grad_accum_count)
     return trainer
 
 def make_loss(opt, model, tgt_vocab):
-    loss = SimpleLossCompute(model.generator, tgt_vocab)
+    loss = SimpleLossCompute(model.generator, tgt_vocab, shard_size=opt.shard_size)
     if use_gpu(opt):
         loss.cuda()
     return loss
@@ -94,6 +96,29 @@ def report_func(opt, epoch, batch, num_batches, start_time, report_stats):
 
     return report_stats
 
+def train(args, model_args, data_generator):
+    mappings = data_generator.mappings
+
+    # TODO: load from checkpoint
+    ckpt = None
+
+    # Build the model
+    model = build_model(model_args, args, mappings, ckpt)
+    tally_parameters(model)
+    create_path(args.model_path)
+    config_path = os.path.join(args.model_path, 'config.json')
+    write_json(vars(args), config_path)
+
+    builder = UtteranceBuilder(mappings['tgt_vocab'], 1, has_tgt=True)
+
+    # Build optimizer and trainer
+    optim = build_optim(args, model, ckpt)
+    # vocab is used to make_loss, so use target vocab
+    trainer = build_trainer(args, model, mappings['tgt_vocab'], optim)
+    trainer.builder = builder
+    # Perform actual training
+    trainer.learn(args, data_generator, report_func)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--random-seed', help='Random seed', type=int, default=1)
@@ -128,22 +153,8 @@ if __name__ == '__main__':
     if args.verbose:
         print("Finished loading and pre-processing data, took {:.1f} seconds".format(tm.time() - loading_timer))
 
-    # TODO: load from checkpoint
-    ckpt = None
-
-    # Build the model
-    model = build_model(model_args, args, mappings, ckpt)
-    tally_parameters(model)
-    create_path(args.model_path)
-    config_path = os.path.join(args.model_path, 'config.json')
-    write_json(vars(args), config_path)
-
-    builder = UtteranceBuilder(mappings['tgt_vocab'], 1, has_tgt=True)
-
-    # Build optimizer and trainer
-    optim = build_optim(args, model, ckpt)
-    # vocab is used to make_loss, so use target vocab
-    trainer = build_trainer(args, model, mappings['tgt_vocab'], optim)
-    trainer.builder = builder
-    # Perform actual training
-    trainer.learn(args, data_generator, report_func)
+    if args.world_size > 1:
+        distributed.launch(train, args.world_size, args.dist_init_method,
+                args=(args, model_args, data_generator))
+    else:
+        train(args, model_args, data_generator)
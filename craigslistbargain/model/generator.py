@@ -3,15 +3,17 @@ from cocoa.model.generator import Templates as BaseTemplates, Generator as BaseG
 from core.tokenizer import detokenize
 
 class Generator(BaseGenerator):
+    filter_columns = ('role', 'category', 'tag', 'context_tag')
+
     def get_filter(self, used_templates=None, category=None, role=None, context_tag=None, tag=None, **kwargs):
         locs = [super(Generator, self).get_filter(used_templates)]
         assert category and role
-        self._add_filter(locs, self.templates.role == role)
-        self._add_filter(locs, self.templates.category == category)
+        self._add_filter(locs, self.index.mask('role', role))
+        self._add_filter(locs, self.index.mask('category', category))
         if tag:
-            self._add_filter(locs, self.templates.tag == tag)
+            self._add_filter(locs, self.index.mask('tag', tag))
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
+            self._add_filter(locs, self.index.mask('context_tag', context_tag))
         return self._select_filter(locs)
 
 class Templates(BaseTemplates):
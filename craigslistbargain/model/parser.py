@@ -1,18 +1,17 @@
 import re
 import numpy as np
-from nltk import ngrams
-from nltk.corpus import stopwords
 from collections import defaultdict
 from itertools import ifilter
 
 from cocoa.core.entity import is_entity
+from cocoa.core import nltk_resources
 from cocoa.model.parser import Parser as BaseParser, LogicalForm as LF, Utterance
 
 from core.tokenizer import tokenize
 
 class Parser(BaseParser):
-    stopwords = set(stopwords.words('english'))
-    stopwords.update(['may', 'might', 'rent', 'new', 'brand', 'low', 'high', 'now', 'available'])
+    # Loaded on first use (see title_stopwords) to keep nltk out of import time
+    stopwords = None
 
     price_patterns = [
             r'come down',
@@ -143,11 +142,18 @@ class Parser(BaseParser):
         tokens = [self._parse_price(token, dialogue_state) if self.is_price_token(token) else token for token in tokens]
         return tokens
 
+    @classmethod
+    def title_stopwords(cls):
+        if cls.stopwords is None:
+            cls.stopwords = set(nltk_resources.stopwords())
+            cls.stopwords.update(['may', 'might', 'rent', 'new', 'brand', 'low', 'high', 'now', 'available'])
+        return cls.stopwords
+
     def _parse_title(self, tokens, dialogue_state):
         title = dialogue_state.kb.title.lower().split()
         new_tokens = []
         for token in tokens:
-            if token in title and not token in self.stopwords:
+            if token in title and not token in self.title_stopwords():
                 if len(new_tokens) == 0 or new_tokens[-1] != '{title}':
                     new_tokens.append('{title}')
             else:
@@ -231,6 +237,7 @@ def parse_dialogue(example, lexicon, counter):
     counter['total_lf'] += len(lfs)
     counter['unk_lf'] += len([lf for lf in lfs if lf.intent == 'unknown'])
     if len(lfs) > 2:
+        from nltk.util import ngrams
         for seq in ngrams(lfs, 3):
             seq = [s.intent for s in seq]
             counter['seqs'][seq[0]][seq[1]][seq[2]] += 1
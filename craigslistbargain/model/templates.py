@@ -1,12 +1,14 @@
-from nltk.corpus import stopwords
-from pygtrie import Trie
+from itertools import izip
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 from cocoa.core.dataset import read_examples
 from cocoa.core.entity import is_entity
+from cocoa.core import nltk_resources
 from cocoa.core.util import read_pickle, write_json
+from cocoa.model.generator import TemplateIndex
 
 from core.scenario import Scenario
 from core.tokenizer import detokenize
@@ -17,6 +19,7 @@ from neural.preprocess import Preprocessor
 class Templates(object):
     def __init__(self, templates):
         self.templates = pd.DataFrame(templates)
+        self.index = TemplateIndex(self.templates, ('category', 'role', 'response_tag', 'context_tag'))
         self.vectorizer = TfidfVectorizer()
         self.build_tfidf()
 
@@ -31,59 +34,56 @@ class Templates(object):
         self.tfidf_matrix = self.vectorizer.fit_transform(documents)
 
     def search(self, context, category=None, role=None, context_tag=None, response_tag=None, used_templates=None, T=1.):
-        loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates).values
+        loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
+        rows = np.flatnonzero(loc)
         features = self.vectorizer.transform([context])
         scores = self.tfidf_matrix * features.T
 
-        scores = scores.todense()[loc]
-        rows = self.templates[loc]
-
-        scores = np.squeeze(np.array(scores))
-        ids = np.argsort(scores)[::-1][:20]
-        rows = rows.iloc[ids]
-        counts = rows['count'].values
-        return self.sample(counts, rows, T=T)
+        scores = scores.toarray()[rows, 0]
+        ids = rows[np.argsort(scores)[::-1][:20]]
+        counts = self.templates['count'].values[ids]
+        return self.sample(counts, ids, T=T)
 
     def softmax(self, scores, T=1.):
         exp_scores = np.exp((scores - np.max(scores)) / T)
         return exp_scores / np.sum(exp_scores)
 
-    def sample(self, counts, templates, T=1.):
+    def sample(self, counts, rows, T=1.):
         probs = self.softmax(counts, T=T)
         template_id = np.random.multinomial(1, probs).argmax()
-        template = templates.iloc[template_id]
+        template = self.templates.iloc[rows[template_id]]
         return template
 
     def get_filter(self, category=None, role=None, context_tag=None, response_tag=None, used_templates=None):
         locs = []
-        loc = True
+        loc = self.index.all_rows
         if used_templates:
-            loc = (~self.templates.id.isin(used_templates))
+            loc = ~self.index.used_mask(used_templates)
             locs.append(loc)
         assert category and role
-        loc = loc & (self.templates.category == category) & (self.templates.role == role)
+        loc = loc & self.index.mask('category', category) & self.index.mask('role', role)
         locs.append(loc)
         if response_tag:
-            loc = loc & (self.templates.response_tag == response_tag)
+            loc = loc & self.index.mask('response_tag', response_tag)
             locs.append(loc)
         if context_tag:
-            loc = loc & (self.templates.context_tag == context_tag)
+            loc = loc & self.index.mask('context_tag', context_tag)
             locs.append(loc)
         for loc in locs[::-1]:
-            if np.sum(loc) > 0:
+            if loc.any():
                 return loc
         return locs[0]
 
     def choose(self, used_templates=None, category=None, role=None, context_tag=None, response_tag=None, T=1.):
         loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
-        templates = self.templates[loc]
-        if len(templates) > 0:
-            counts = templates['count'].values
-            return self.sample(counts, templates, T)
+        rows = np.flatnonzero(loc)
+        if len(rows) > 0:
+            counts = self.templates['count'].values[rows]
+            return self.sample(counts, rows, T)
 
         print 'WARNING: no available templates found, returning a random one'
         counts = self.templates['count'].values
-        return self.sample(counts, self.templates, T)
+        return self.sample(counts, np.arange(len(counts)), T)
 
         #for loc in locs[::-1]:
         #    templates = self.templates[loc][['id', 'count', 'response']].values
@@ -108,13 +108,79 @@ class Templates(object):
                     break
                 print row['count'], row['response'].encode('utf-8')
 
+class NgramTable(object):
+    """Ngram counts keyed by the 64-bit hash of the ngram.
+
+    Ngrams are buffered as they are added and reduced to sorted unique keys
+    with counts on `compact`. Tables counted on different shards are combined
+    with `merge`.
+    """
+    def __init__(self, keys=None, counts=None):
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else keys
+        self.counts = np.zeros(0, dtype=np.int64) if counts is None else counts
+        self._pending = []
+
+    @classmethod
+    def hash_ngram(cls, ngram):
+        return hash(tuple(ngram))
+
+    def add(self, ngram):
+        self._pending.append(self.hash_ngram(ngram))
+
+    def compact(self):
+        if self._pending:
+            pending = NgramTable(*np.unique(np.array(self._pending, dtype=np.int64), return_counts=True))
+            self._pending = []
+            merged = self.merge([self, pending])
+            self.keys, self.counts = merged.keys, merged.counts
+        return self
+
+    @classmethod
+    def merge(cls, tables):
+        keys = np.concatenate([t.compact().keys for t in tables])
+        counts = np.concatenate([t.counts for t in tables])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+        return cls(keys, counts)
+
+    def lookup(self, keys):
+        """Counts of an array of ngram keys.
+        """
+        self.compact()
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[index] == keys, self.counts[index], 0)
+
+# Inputs of the template extraction workers, set before forking them
+_shard_inputs = {}
+
+def _parse_shard(shard):
+    """Parse examples[start:end] with a fresh TemplateExtractor.
+
+    Returns the templates and ngram counts of the shard, and for each example
+    a list of (event index, template id) with ids local to the shard.
+    """
+    start, end = shard
+    examples = _shard_inputs['examples']
+    ngram_N = _shard_inputs['ngram_N']
+    extractor = TemplateExtractor(_shard_inputs['price_tracker'])
+    event_templates = []
+    for example in examples[start:end]:
+        if Preprocessor.skip_example(example):
+            event_templates.append([])
+            continue
+        extractor.parse_example(example, ngram_N)
+        event_templates.append([(i, event.template) for i, event in enumerate(example.events) if hasattr(event, 'template')])
+    return extractor.templates, extractor.ngram_counter.compact(), event_templates
+
 class TemplateExtractor(object):
-    stopwords = set(stopwords.words('english'))
-    stopwords.update(['may', 'might', 'rent', 'new', 'brand', 'low', 'high', 'now', 'available'])
+    # Loaded on first use (see title_stopwords) to keep nltk out of import time
+    stopwords = None
 
     def __init__(self, price_tracker):
         self.price_tracker = price_tracker
-        self.ngram_counter = Trie()
+        self.ngram_counter = NgramTable()
         self.templates = []
         self.template_id = 0
 
@@ -135,12 +201,19 @@ class TemplateExtractor(object):
             acts.append('greet')
         return acts
 
+    @classmethod
+    def title_stopwords(cls):
+        if cls.stopwords is None:
+            cls.stopwords = set(nltk_resources.stopwords())
+            cls.stopwords.update(['may', 'might', 'rent', 'new', 'brand', 'low', 'high', 'now', 'available'])
+        return cls.stopwords
+
     @classmethod
     def parse_title(cls, tokens, kb):
         title = kb.facts['item']['Title'].lower().split()
         new_tokens = []
         for token in tokens:
-            if token in title and not token in cls.stopwords:
+            if token in title and not token in cls.title_stopwords():
                 if len(new_tokens) > 0 and new_tokens[-1] == '{title}':
                     continue
                 else:
@@ -187,10 +260,7 @@ class TemplateExtractor(object):
 
         # Count ngrams
         for ngram in self.ngrams(response_tokens, n):
-            if ngram not in self.ngram_counter:
-                self.ngram_counter[ngram] = 1
-            else:
-                self.ngram_counter[ngram] += 1
+            self.ngram_counter.add(ngram)
 
         row = {
                 'category': category,
@@ -269,13 +339,36 @@ class TemplateExtractor(object):
             prev_tokens = tokens
             utterance_tags.append(tag)
 
-    def extract_templates(self, transcripts_paths, max_examples=-1, ngram_N=4, log=None):
+    def extract_templates(self, transcripts_paths, max_examples=-1, ngram_N=4, log=None, num_workers=1):
         examples = read_examples(transcripts_paths, max_examples, Scenario)
 
-        for example in examples:
-            if Preprocessor.skip_example(example):
-                continue
-            self.parse_example(example, ngram_N)
+        # Workers parse contiguous shards and their results are merged in
+        # order, so templates are the same as parsing serially.
+        num_shards = max(1, num_workers) * 4
+        shard_size = max(1, (len(examples) + num_shards - 1) / num_shards)
+        shards = [(start, min(start + shard_size, len(examples))) for start in xrange(0, len(examples), shard_size)]
+        _shard_inputs.update(examples=examples, ngram_N=ngram_N, price_tracker=self.price_tracker)
+        if num_workers > 1:
+            pool = Pool(num_workers)
+            results = pool.map(_parse_shard, shards)
+            pool.close()
+            pool.join()
+        else:
+            results = map(_parse_shard, shards)
+        _shard_inputs.clear()
+
+        tables = [self.ngram_counter]
+        for (start, end), (templates, ngram_counter, event_templates) in izip(shards, results):
+            offset = len(self.templates)
+            for row in templates:
+                row['id'] += offset
+            self.templates.extend(templates)
+            self.template_id += len(templates)
+            tables.append(ngram_counter)
+            for example, template_ids in izip(examples[start:end], event_templates):
+                for i, template_id in template_ids:
+                    example.events[i].template = None if template_id is None else template_id + offset
+        self.ngram_counter = NgramTable.merge(tables)
 
         self.add_counts(ngram_N)
         self.detokenize_templates()
@@ -305,16 +398,21 @@ class TemplateExtractor(object):
             row['context'] = detokenize(row['context'])
 
     def add_counts(self, n):
-        for row in self.templates:
+        keys = []
+        rows = []
+        for i, row in enumerate(self.templates):
             tokens = row['response']
-            counts = []
             for ngram in self.ngrams(tokens, n):
-                counts.append(self.ngram_counter[ngram])
-            if not counts:
-                print tokens
+                keys.append(NgramTable.hash_ngram(ngram))
+                rows.append(i)
+        counts = self.ngram_counter.lookup(np.array(keys, dtype=np.int64))
+        num_ngrams = np.bincount(rows, minlength=len(self.templates))
+        total_counts = np.bincount(rows, weights=counts, minlength=len(self.templates))
+        for row, total, num in izip(self.templates, total_counts, num_ngrams):
+            if num == 0:
+                print row['response']
                 import sys; sys.exit()
-            mean_count = np.mean(counts)
-            row['count'] = mean_count
+            row['count'] = total / num
 
 
 ############# TEST #############
@@ -331,6 +429,7 @@ if __name__ == '__main__':
     parser.add_argument('--output-transcripts', help='Path to JSON examples with templates')
     parser.add_argument('--templates', help='Path to load templates')
     parser.add_argument('--debug', default=False, action='store_true')
+    parser.add_argument('--num-workers', default=1, type=int, help='Number of processes to parse transcripts')
     args = parser.parse_args()
 
     if args.templates:
@@ -338,7 +437,7 @@ if __name__ == '__main__':
     else:
         price_tracker = PriceTracker(args.price_tracker_model)
         template_extractor = TemplateExtractor(price_tracker)
-        template_extractor.extract_templates(args.transcripts, args.max_examples)
+        template_extractor.extract_templates(args.transcripts, args.max_examples, num_workers=args.num_workers)
         write_pickle(template_extractor.templates, args.output)
         templates = Templates(template_extractor.templates)
 
@@ -1,5 +1,3 @@
-import onmt
-
 def get_data_generator(args, model_args, schema, test=False):
     from cocoa.core.scenario_db import ScenarioDB
     from cocoa.core.dataset import read_dataset
@@ -29,7 +27,7 @@ def get_data_generator(args, model_args, schema, test=False):
     data_generator = DataGenerator(train, dev, test, preprocessor, schema, mappings_path,
         cache=args.cache, ignore_cache=args.ignore_cache,
         num_context=model_args.num_context,
-        batch_size=args.batch_size,
+        batch_size=args.batch_size, batch_tokens=args.batch_tokens,
         model=model_args.model)
 
     return data_generator
@@ -61,6 +59,7 @@ def make_model_mappings(model, mappings):
     return mappings
 
 def build_optim(opt, model, checkpoint):
+    import onmt
     print('Making optimizer for training.')
     optim = onmt.Optim(
         opt.optim, opt.learning_rate, opt.max_grad_norm,
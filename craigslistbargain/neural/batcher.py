@@ -1,17 +1,18 @@
 import numpy as np
-from itertools import izip_longest, izip
-
-import torch
-from torch.autograd import Variable
+from itertools import izip
 
 from symbols import markers
 
 def pad_list_to_array(l, fillvalue, dtype):
     '''
-    l: list of lists with unequal length
+    l: list of lists (or arrays) with unequal length
     return: np array with minimal padding
     '''
-    return np.array(list(izip_longest(*l, fillvalue=fillvalue)), dtype=dtype).T
+    lengths = [len(x) for x in l]
+    array = np.full((len(l), max(lengths) if lengths else 0), fillvalue, dtype=dtype)
+    for i, (x, n) in enumerate(izip(l, lengths)):
+        array[i, :n] = x
+    return array
 
 class Batch(object):
     def __init__(self, encoder_args, decoder_args, context_data, vocab,
@@ -62,6 +63,8 @@ class Batch(object):
 
     @classmethod
     def to_tensor(cls, data, dtype, cuda=False):
+        # torch is imported on first use so that preprocessing alone does not load it
+        import torch
         if type(data) == np.ndarray:
             data = data.tolist()
         if dtype == "long":
@@ -75,6 +78,7 @@ class Batch(object):
     @classmethod
     def to_variable(cls, data, dtype, cuda=False):
         tensor = cls.to_tensor(data, dtype)
+        from torch.autograd import Variable
         var = Variable(tensor)
         return var.cuda() if cuda else var
 
@@ -157,7 +161,7 @@ class DialogueBatcher(object):
         #pad = Dialogue.mappings['kb_vocab'].to_ind(markers.PAD)
         title_batch = pad_list_to_array([d.title for d in dialogues], pad, np.int32)
         # TODO: hacky: handle empty description
-        description_batch = pad_list_to_array([[pad] if not d.description else d.description for d in dialogues], pad, np.int32)
+        description_batch = pad_list_to_array([[pad] if len(d.description) == 0 else d.description for d in dialogues], pad, np.int32)
         return {
                 'category': category_batch,
                 'title': title_batch,
@@ -12,9 +12,23 @@ from utterance import UtteranceBuilder
 
 
 class LFSampler(Sampler):
+    """Sample logical forms: an action, followed by a price for price actions.
+
+    The grammar is enforced by an additive mask over the vocabulary for each
+    grammar state, precomputed in `masks`:
+        FREE: any token (the first token)
+        PRICE: after a price action, only prices
+        END: after a price, another action or EOS, only EOS
+    `next_state` maps a sampled token to the state of the next step. Each row
+    of the batch has its own state, and stops at its EOS.
+    """
+    FREE, PRICE, END = 0, 1, 2
+
     def __init__(self, model, vocab,
-                 temperature=1, max_length=100, cuda=False):
-        super(LFSampler, self).__init__(model, vocab, temperature=temperature, max_length=max_length, cuda=cuda)
+                 temperature=1, max_length=100, cuda=False,
+                 top_k=0, top_p=1., num_samples=1):
+        super(LFSampler, self).__init__(model, vocab, temperature=temperature, max_length=max_length, cuda=cuda,
+                top_k=top_k, top_p=top_p, num_samples=num_samples)
         self.price_actions = map(self.vocab.to_ind, ('init-price', 'counter-price', markers.OFFER))
         self.prices = set([id_ for w, id_ in self.vocab.word_to_ind.iteritems() if is_entity(w)])
         self.price_list = list(self.prices)
@@ -24,70 +38,36 @@ class LFSampler(Sampler):
                 (is_entity(w) or w in category_markers or w in sequence_markers
                     or w in (vocab.UNK, '</sum>', '<slot>', '</slot>'))])
         self.actions = map(self.vocab.to_ind, actions)
+        self.masks, self.next_state = self._build_grammar()
 
-    def generate_batch(self, batch, gt_prefix=1, enc_state=None):
-        # This is to ensure we can stop at EOS for stateful models
-        assert batch.size == 1
-
-        # (1) Run the encoder on the src.
-        lengths = batch.lengths
-        dec_states, enc_memory_bank = self._run_encoder(batch, enc_state)
-        memory_bank = self._run_attention_memory(batch, enc_memory_bank)
-
-        # (1.1) Go over forced prefix.
-        inp = batch.decoder_inputs[:gt_prefix]
-        dec_out, dec_states, _ = self.model.decoder(
-            inp, memory_bank, dec_states, memory_lengths=lengths)
-
-        # (2) Sampling
-        batch_size = batch.size
-        preds = []
-        for i in xrange(self.max_length):
-            # Outputs to probs
-            dec_out = dec_out.squeeze(0)  # (batch_size, rnn_size)
-            out = self.model.generator.forward(dec_out).data  # Logprob (batch_size, vocab_size)
-            # Sample with temperature
-            scores = out.div(self.temperature)
-
-            # Masking to ensure valid LF
-            # NOTE: batch size must be 1. TODO: relax this restriction
-            if i > 0:
-                mask = torch.zeros(scores.size())
-                if pred[0] in self.price_actions:
-                    # Only price will be allowed
-                    mask[:, self.price_list] = 1
-                elif pred[0] in self.prices or pred[0] in self.actions:
-                    # Must end
-                    mask = torch.zeros(scores.size())
-                    mask[:, self.eos] = 1
-                else:
-                    mask[:, :] = 1
-                scores[mask == 0] = -100.
+    def _build_grammar(self):
+        vocab_size = self.vocab.size
+        next_state = torch.LongTensor(vocab_size).fill_(self.FREE)
+        for ids, state in ((list(self.prices) + self.actions + [self.eos], self.END),
+                           (self.price_actions, self.PRICE)):
+            next_state[torch.LongTensor(ids)] = state
 
-            scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
-            pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
-            preds.append(pred)
-            if pred[0] == self.eos:
-                break
-            # Forward step
-            inp = Variable(pred.view(1, -1))  # (seq_len=1, batch_size)
-            dec_out, dec_states, _ = self.model.decoder(
-                inp, memory_bank, dec_states, memory_lengths=lengths)
+        masks = torch.zeros(3, vocab_size)
+        for state, allowed in ((self.PRICE, self.price_list), (self.END, [self.eos])):
+            masks[state].fill_(-float('inf'))
+            masks[state][torch.LongTensor(allowed)] = 0
+        if self.cuda:
+            masks, next_state = masks.cuda(), next_state.cuda()
+        return masks, next_state
 
-        preds = torch.stack(preds).t()  # (batch_size, seq_len)
-        # Insert one dimension (n_best) so that its structure is consistent
-        # with beam search generator
-        preds = preds.unsqueeze(1)
-        # TODO: add actual scores
-        ret = {"predictions": preds,
-               "scores": [[0]] * batch_size,
-               "attention": [None] * batch_size,
-               "dec_states": dec_states,
-               }
+    def _row_data(self, num_rows, num_samples, temperature=None, vocab_mask=None):
+        data = super(LFSampler, self)._row_data(num_rows, num_samples, temperature, vocab_mask)
+        # Grammar state of each row
+        data['state'] = self.next_state.new(num_rows).fill_(self.FREE)
+        return data
 
-        ret["gold_score"] = [0] * batch_size
-        ret["batch"] = batch
-        return ret
+    def _sample_rows(self, out, data):
+        # Masking to ensure valid LF
+        mask = self.masks.index_select(0, data['state'])
+        mask.add_(data['vocab_mask'])
+        pred = self.sample(out, data['temperature'], mask)
+        data['state'] = self.next_state.index_select(0, pred)
+        return pred
 
 
 def get_generator(model, vocab, scorer, args, model_args):
@@ -96,11 +76,15 @@ def get_generator(model, vocab, scorer, args, model_args):
         if model_args.model == 'lf2lf':
             generator = LFSampler(model, vocab, args.temperature,
                                 max_length=args.max_length,
-                                cuda=use_gpu(args))
+                                cuda=use_gpu(args),
+                                top_k=args.top_k, top_p=args.top_p,
+                                num_samples=args.num_samples)
         else:
             generator = Sampler(model, vocab, args.temperature,
                                 max_length=args.max_length,
-                                cuda=use_gpu(args))
+                                cuda=use_gpu(args),
+                                top_k=args.top_k, top_p=args.top_p,
+                                num_samples=args.num_samples)
     else:
         generator = Generator(model, vocab,
                               beam_size=args.beam_size,
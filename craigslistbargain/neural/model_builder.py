@@ -17,6 +17,7 @@ from cocoa.neural.models import MeanEncoder, StdRNNEncoder, StdRNNDecoder, \
 from models import NegotiationModel
 
 from cocoa.io.utils import read_pickle
+from cocoa.neural.checkpoint import load_checkpoint, share_weights, quantize_dynamic, freeze, ModelCache
 
 from symbols import markers
 from neural import make_model_mappings
@@ -128,9 +129,27 @@ def make_decoder(opt, embeddings, tgt_dict):
                              embeddings=embeddings,
                              pad=pad)
 
-def load_test_model(model_path, opt, dummy_opt):
-    checkpoint = torch.load(model_path, map_location=lambda storage, loc: storage)
+def load_test_model(model_path, opt, dummy_opt, cache=True):
+    """Load a model for inference from a training checkpoint (.pt) or an
+    inference checkpoint (see cocoa.neural.checkpoint).
 
+    With `cache`, the model is loaded once per process and shared (read-only)
+    by all callers; use cache=False for a model that will be trained.
+    """
+    gpu = use_gpu(opt)
+    load = lambda: build_test_model(load_checkpoint(model_path), gpu, dummy_opt, read_only=cache)
+    if cache:
+        mappings, model, model_opt = ModelCache.get(model_path, load, gpu)
+    else:
+        mappings, model, model_opt = load()
+
+    # TODO: fix this
+    if model_opt.stateful and not opt.sample:
+        raise ValueError('Beam search generator does not work with stateful models yet')
+
+    return mappings, model, model_opt
+
+def build_test_model(checkpoint, gpu, dummy_opt, read_only=True):
     model_opt = checkpoint['opt']
     for arg in dummy_opt:
         if arg not in model_opt:
@@ -139,18 +158,20 @@ def load_test_model(model_path, opt, dummy_opt):
         if not hasattr(model_opt, attribute):
             model_opt.__dict__[attribute] = False
 
-    # TODO: fix this
-    if model_opt.stateful and not opt.sample:
-        raise ValueError('Beam search generator does not work with stateful models yet')
-
-    mappings = read_pickle('{}/vocab.pkl'.format(model_opt.mappings))
-
     # mappings = read_pickle('{0}/{1}/vocab.pkl'.format(model_opt.mappings, model_opt.model))
-    mappings = make_model_mappings(model_opt.model, mappings)
+    mappings = make_model_mappings(model_opt.model, checkpoint['vocab'])
 
-    model = make_base_model(model_opt, mappings, use_gpu(opt), checkpoint)
+    model = make_base_model(model_opt, mappings, gpu, checkpoint)
     model.eval()
     model.generator.eval()
+    if not gpu:
+        share_weights(model, checkpoint)
+    if getattr(model_opt, 'quantize', False):
+        if gpu:
+            raise ValueError('Quantized models run on CPU only')
+        quantize_dynamic(model)
+    if read_only:
+        freeze(model)
     return mappings, model, model_opt
 
 def make_base_model(model_opt, mappings, gpu, checkpoint=None):
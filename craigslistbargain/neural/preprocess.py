@@ -7,14 +7,16 @@ import re
 import time
 import os
 import numpy as np
-from itertools import izip
+from itertools import izip, chain
 
 from cocoa.core.util import read_pickle, write_pickle, read_json
 from cocoa.core.entity import Entity, CanonicalEntity, is_entity
 from cocoa.model.vocab import Vocabulary
+from cocoa.neural.prefetch import BatchPrefetcher
+from cocoa.neural.batching import dialogue_shape, bucket_dialogues, padding_ratio, shuffled_order
 
 from core.price_tracker import PriceTracker, PriceScaler
-from core.tokenizer import tokenize
+from core.tokenizer import tokenize, tokenize_batch
 from batcher import DialogueBatcherFactory, Batch
 from symbols import markers
 from vocab_builder import create_mappings
@@ -72,6 +74,52 @@ class TextIntMap(object):
             toks = [CanonicalEntity(value=p, type='price') if price_filler(x) else x for x, p in izip(toks, prices)]
         return toks
 
+class TurnArrays(object):
+    '''
+    Integer turns of one stage in a flat int32 array, where turn i is
+    tokens[offsets[i]:offsets[i+1]]. Indexing returns a view, so batches
+    are sliced from it without copying into Python lists.
+    '''
+    __slots__ = ('tokens', 'offsets')
+
+    def __init__(self, turns):
+        self.offsets = np.zeros(len(turns) + 1, dtype=np.int32)
+        np.cumsum([len(turn) for turn in turns], out=self.offsets[1:])
+        self.tokens = np.fromiter(chain.from_iterable(turns), dtype=np.int32, count=self.offsets[-1])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('turn index out of range')
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def pad(self, num_turns):
+        '''
+        Add empty turns up to num_turns.
+        '''
+        n = len(self)
+        if n < num_turns:
+            self.offsets = np.concatenate((self.offsets, np.full(num_turns - n, self.offsets[-1], dtype=np.int32)))
+
+    def __getstate__(self):
+        return (self.tokens, self.offsets)
+
+    def __setstate__(self, state):
+        self.tokens, self.offsets = state
+
+
 class Dialogue(object):
     textint_map = None
     ENC = 0
@@ -204,16 +252,20 @@ class Dialogue(object):
 
     def kb_context_to_int(self):
         self.category = self.mappings['cat_vocab'].to_ind(self.category)
-        self.title = map(self.mappings['kb_vocab'].to_ind, self.title)
-        self.description = map(self.mappings['kb_vocab'].to_ind, self.description)
+        self.title = np.array(map(self.mappings['kb_vocab'].to_ind, self.title), dtype=np.int32)
+        self.description = np.array(map(self.mappings['kb_vocab'].to_ind, self.description), dtype=np.int32)
 
     def lf_to_int(self):
         self.lf_token_turns = []
         for i, lf in enumerate(self.lfs):
             self.lf_token_turns.append(lf)
             self.lfs[i] = map(self.mappings['lf_vocab'].to_ind, lf)
+        self.lfs = TurnArrays(self.lfs)
 
     def convert_to_int(self):
+        '''
+        Map tokens to integers and store turns of each stage as TurnArrays.
+        '''
         if self.is_int:
             return
 
@@ -224,6 +276,7 @@ class Dialogue(object):
             #   encoding portion, decoding portion, or the target portion
             for portion, stage in izip(self.turns, ('encoding', 'decoding', 'target')):
                 portion.append(self.textint_map.text_to_int(turn, stage))
+        self.turns = [TurnArrays(portion) for portion in self.turns]
 
         self.kb_context_to_int()
         self.lf_to_int()
@@ -231,6 +284,9 @@ class Dialogue(object):
         self.is_int = True
 
     def _pad_list(self, l, size, pad):
+        if isinstance(l, TurnArrays):
+            l.pad(size)
+            return l
         for i in xrange(len(l), size):
             l.append(pad)
         return l
@@ -325,22 +381,29 @@ class Preprocessor(object):
             tokens.append(PriceScaler.scale_price(kb, price))
         return tokens
 
-    def _process_example(self, ex):
+    def _process_example(self, ex, interned):
         '''
         Convert example to turn-based dialogue from each agent's perspective
         Create two Dialogue objects for each example
+        Tokens are interned in `interned` (see preprocess).
         '''
         kbs = ex.scenario.kbs
+        if self.model not in ('lf2lf',):
+            # Messages are the same from both perspectives; tokenize them once
+            message_tokens = tokenize_batch([e.data for e in ex.events if e.action == 'message'])
         for agent in (0, 1):
             dialogue = Dialogue(agent, kbs[agent], ex.ex_id, model=self.model)
-            for e in ex.events:
-                if self.model in ('lf2lf',):
+            if self.model in ('lf2lf',):
+                utterances = []
+                for e in ex.events:
                     lf = e.metadata
                     assert lf is not None
-                    utterance = self.lf_to_tokens(dialogue.kb, lf)
-                else:
-                    utterance = self.process_event(e, dialogue.kb)
+                    utterances.append(self.lf_to_tokens(dialogue.kb, lf))
+            else:
+                utterances = self.process_events(ex.events, dialogue.kb, message_tokens=message_tokens)
+            for e, utterance in izip(ex.events, utterances):
                 if utterance:
+                    utterance = [interned.setdefault((type(x), x), x) for x in utterance]
                     dialogue.add_utterance(e.agent, utterance, lf=e.metadata)
             yield dialogue
 
@@ -378,6 +441,24 @@ class Preprocessor(object):
         else:
             raise ValueError('Unknown event action.')
 
+    def process_events(self, events, kb, message_tokens=None):
+        '''
+        Same as process_event for all events of a dialogue, where messages are
+        linked in one batch. `message_tokens` are the tokenized messages if
+        already available.
+        '''
+        if message_tokens is None:
+            message_tokens = tokenize_batch([e.data for e in events if e.action == 'message'])
+        linked_messages = iter(self.lexicon.link_entities(message_tokens, kb=kb, scale=True, price_clip=4.))
+        utterances = []
+        for e in events:
+            if e.action == 'message':
+                entity_tokens = next(linked_messages)
+                utterances.append(entity_tokens if entity_tokens else None)
+            else:
+                utterances.append(self.process_event(e, kb))
+        return utterances
+
     @classmethod
     def skip_example(cls, example):
         tokens = {0: 0, 1: 0}
@@ -393,12 +474,19 @@ class Preprocessor(object):
             return True
         return False
 
-    def preprocess(self, examples):
+    def preprocess(self, examples, interned=None):
+        '''
+        Tokens and entities repeat a lot across dialogues, so the dialogues
+        share one copy of each: `interned` maps (type, token) to that copy.
+        It only lives as long as the caller keeps it.
+        '''
+        if interned is None:
+            interned = {}
         dialogues = []
         for ex in examples:
             if self.skip_example(ex):
                 continue
-            for d in self._process_example(ex):
+            for d in self._process_example(ex, interned):
                 dialogues.append(d)
         return dialogues
 
@@ -406,17 +494,26 @@ class DataGenerator(object):
     def __init__(self, train_examples, dev_examples, test_examples, preprocessor,
             schema, mappings_path=None, cache='.cache',
             ignore_cache=False, num_context=1, batch_size=1,
-            model='seq2seq'):
+            model='seq2seq', batch_tokens=0):
         examples = {'train': train_examples, 'dev': dev_examples, 'test': test_examples}
         self.num_examples = {k: len(v) if v else 0 for k, v in examples.iteritems()}
         self.num_context = num_context
         self.model = model
+        self.batch_tokens = batch_tokens
+        # Batches are shuffled by a seed derived from this and the epoch
+        self.shuffle_seed = random.randint(0, 2**31)
 
         self.cache = cache
         self.ignore_cache = ignore_cache
-        if (not os.path.exists(cache)) or ignore_cache:
+        self.batch_size = batch_size
+        cache_files = [self._cache_file(k) for k, v in examples.iteritems() if v]
+        if ignore_cache or not all(os.path.exists(f) for f in cache_files):
             # NOTE: each dialogue is made into two examples from each agent's perspective
-            self.dialogues = {k: preprocessor.preprocess(v)  for k, v in examples.iteritems() if v}
+            start_time = time.time()
+            # The folds share their tokens
+            interned = {}
+            self.dialogues = {k: preprocessor.preprocess(v, interned)  for k, v in examples.iteritems() if v}
+            print 'Preprocessed examples [%d s]' % (time.time() - start_time)
 
             for fold, dialogues in self.dialogues.iteritems():
                 print '%s: %d dialogues out of %d examples' % (fold, len(dialogues), self.num_examples[fold])
@@ -437,6 +534,10 @@ class DataGenerator(object):
                         mappings=self.mappings, num_context=num_context)
 
         self.batches = {k: self.create_batches(k, dialogues, batch_size) for k, dialogues in self.dialogues.iteritems()}
+        self.padding = {k: padding_ratio(batches,
+                self.mappings['utterance_vocab'].to_ind(markers.PAD),
+                self.mappings['tgt_vocab'].to_ind(markers.PAD))
+            for k, batches in self.batches.iteritems()}
 
     def load_mappings(self, model_type, mappings_path, schema, preprocessor):
         vocab_path = os.path.join(mappings_path, 'vocab.pkl')
@@ -467,21 +568,12 @@ class DataGenerator(object):
         return DialogueBatcher(dialogues).create_batch()
 
     def dialogue_sort_score(self, d):
-        # Sort dialogues by number o turns
-        return len(d.turns[0])
+        # Sort dialogues by number of turns, then by the longest turn
+        return dialogue_shape(d)
 
     def create_dialogue_batches(self, dialogues, batch_size):
-        dialogue_batches = []
-        dialogues.sort(key=lambda d: self.dialogue_sort_score(d))
-        N = len(dialogues)
-        start = 0
-        while start < N:
-            # NOTE: last batch may have a smaller size if we don't have enough examples
-            end = min(start + batch_size, N)
-            dialogue_batch = dialogues[start:end]
-            dialogue_batches.append(self.dialogue_batcher.create_batch(dialogue_batch))
-            start = end
-        return dialogue_batches
+        groups = bucket_dialogues(dialogues, batch_size, self.batch_tokens, shape=self.dialogue_sort_score)
+        return [self.dialogue_batcher.create_batch(dialogue_batch) for dialogue_batch in groups]
 
     def get_all_responses(self, name):
         dialogues = self.dialogues[name]
@@ -491,10 +583,15 @@ class DataGenerator(object):
                 responses[role].extend(turn)
         return responses
 
+    def _cache_file(self, name):
+        # Batches depend on the batching parameters
+        return os.path.join(self.cache, '%s_batches_size%d_tokens%d.pkl' % (
+            name, self.batch_size, self.batch_tokens))
+
     def create_batches(self, name, dialogues, batch_size):
         if not os.path.isdir(self.cache):
             os.makedirs(self.cache)
-        cache_file = os.path.join(self.cache, '%s_batches.pkl' % name)
+        cache_file = self._cache_file(name)
         if (not os.path.exists(cache_file)) or self.ignore_cache:
             for dialogue in dialogues:
                 dialogue.convert_to_int()
@@ -511,12 +608,34 @@ class DataGenerator(object):
             print '[%d s]' % (time.time() - start_time)
         return dialogue_batches
 
-    def generator(self, name, shuffle=True, cuda=True):
+    def generator(self, name, shuffle=True, cuda=True, prefetch=0, epoch=None,
+            rank=0, world_size=1):
+        '''
+        Yield the number of batches, then batches of each dialogue followed by
+        None. If `prefetch` > 0, up to `prefetch` batches are built ahead of
+        time in a background thread. If `epoch` is given, the shuffled order
+        is the same whenever the same epoch is requested. For distributed
+        training, only every `world_size`-th dialogue starting from `rank` is
+        used.
+        '''
+        batches = self.batch_iter(name, shuffle=shuffle, cuda=cuda, epoch=epoch,
+                rank=rank, world_size=world_size)
+        if prefetch > 0:
+            return BatchPrefetcher(batches, prefetch)
+        return batches
+
+    def batch_iter(self, name, shuffle=True, cuda=True, epoch=None, rank=0, world_size=1):
         dialogue_batches = self.batches[name]
-        yield sum([len(b) for b in dialogue_batches])
-        inds = range(len(dialogue_batches))
         if shuffle:
-            random.shuffle(inds)
+            seed = None if epoch is None else (self.shuffle_seed, epoch)
+            inds = shuffled_order(len(dialogue_batches), seed)
+        else:
+            inds = range(len(dialogue_batches))
+        inds = inds[rank::world_size]
+        num_batches = sum([len(dialogue_batches[i]) for i in inds])
+        if rank == 0:
+            print '%s: %d batches, %.1f%% padding' % (name, num_batches, self.padding[name] * 100)
+        yield num_batches
         for ind in inds:
             for batch in dialogue_batches[ind]:
                 yield Batch(batch['encoder_args'],
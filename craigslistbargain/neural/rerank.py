@@ -0,0 +1,43 @@
+from cocoa.core.entity import is_entity
+from cocoa.neural.rerank import Reranker
+
+from core.price_tracker import PriceScaler
+
+def price_margin(tokens, kb):
+    """Margin of the last price in `tokens` for the agent of `kb`: 0 at its
+    bottomline and 1 at its target; 0 if there is no price (or if the target
+    is the bottomline).
+    """
+    prices = [token for token in tokens if is_entity(token)]
+    if not prices:
+        return 0.
+    b, t = PriceScaler.get_price_range(kb)
+    if t == b:
+        return 0.
+    price = PriceScaler.unscale_price(kb, prices[-1]).canonical.value
+    return float(price - b) / (t - b)
+
+utilities = {
+        'none': None,
+        'margin': price_margin,
+        }
+
+def get_reranker(generator, builder, args, config=None):
+    """Reranker of the responses of `generator` from the --rerank-* options,
+    overridden by `config` (e.g. {"candidates": 8, "utility": "margin"}) for
+    a system. Returns None if there is only one candidate.
+    """
+    options = {
+            'candidates': args.rerank_candidates,
+            'utility': args.rerank_utility,
+            'weight': args.rerank_weight,
+            'budget': args.rerank_budget,
+            }
+    options.update(config or {})
+    if options['candidates'] <= 1:
+        return None
+    if options['utility'] not in utilities:
+        raise ValueError('Unknown utility {}'.format(options['utility']))
+    return Reranker(generator, builder, options['candidates'],
+            utility=utilities[options['utility']], weight=options['weight'],
+            alpha=args.alpha, budget=options['budget'])
@@ -36,33 +36,34 @@ class RLTrainer(Trainer):
         model.train()
         model.generator.train()
 
-        nll = []
         # batch_iter gives a dialogue
+        batches = list(batch_iter)
+        total_seq_len = sum(batch.targets.size(0) for batch in batches)
+
+        # Discounted reward of each time step, counted back from the end
+        rewards = [torch.zeros(1, 1).fill_(reward)]
+        for i in xrange(1, total_seq_len):
+            rewards.append(rewards[-1] * discount)
+        rewards = rewards[::-1]
+        rewards = torch.cat(rewards)  # (total_seq_len, batch_size)
+
+        model.zero_grad()
         dec_state = None
-        for batch in batch_iter:
+        start = 0
+        for batch in batches:
             if not model.stateful:
                 dec_state = None
             enc_state = dec_state.hidden if dec_state is not None else None
 
             outputs, _, dec_state = self._run_batch(batch, None, enc_state)  # (seq_len, batch_size, rnn_size)
-            loss, _ = self.train_loss.compute_loss(batch.targets, outputs)  # (seq_len, batch_size)
-            nll.append(loss)
+            seq_len = batch.targets.size(0)
+            self.train_loss.sharded_compute_loss(batch.targets, outputs, rewards[start:start+seq_len])
+            start += seq_len
 
             # Don't backprop fully.
             if dec_state is not None:
                 dec_state.detach()
 
-        nll = torch.cat(nll)  # (total_seq_len, batch_size)
-
-        rewards = [Variable(torch.zeros(1, 1).fill_(reward))]
-        for i in xrange(1, nll.size(0)):
-            rewards.append(rewards[-1] * discount)
-        rewards = rewards[::-1]
-        rewards = torch.cat(rewards)
-
-        loss = nll.squeeze().dot(rewards.squeeze())
-        model.zero_grad()
-        loss.backward()
         nn.utils.clip_grad_norm(model.parameters(), 1.)
         self.optim.step()
 
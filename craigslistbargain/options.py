@@ -13,6 +13,7 @@ def add_preprocess_arguments(parser):
     parser.add_argument('--entity-target-form', choices=['canonical', 'type'], default='canonical', help='Output entity form to the decoder')
     parser.add_argument('--cache', default='.cache', help='Path to cache for preprocessed batches')
     parser.add_argument('--ignore-cache', action='store_true', help='Ignore existing cache')
+    parser.add_argument('--batch-tokens', type=int, default=0, help='Maximum padded tokens (dialogues x turns x turn length) per batch; 0 to batch by --batch-size only. Batches are cached per --batch-size and --batch-tokens')
     parser.add_argument('--mappings', help='Path to vocab mappings')
 
 def add_data_generator_arguments(parser):
@@ -92,6 +93,7 @@ def add_system_arguments(parser):
     cocoa.options.add_rulebased_arguments(parser)
     add_price_tracker_arguments(parser)
     add_neural_system_arguments(parser)
+    parser.add_argument('--asset-cache', help='Directory to build system assets (templates, TF-IDF, model weights) once and load them memory-mapped, shared by all worker processes')
     # NOTE: hybrid system arguments are covered by neural system and rulebased system
 
 def add_hybrid_system_arguments(parser):
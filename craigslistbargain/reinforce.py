@@ -24,7 +24,7 @@ from neural import build_optim
 import options
 
 def make_loss(opt, model, tgt_vocab):
-    loss = ReinforceLossCompute(model.generator, tgt_vocab)
+    loss = ReinforceLossCompute(model.generator, tgt_vocab, shard_size=opt.shard_size)
     if use_gpu(opt):
         loss.cuda()
     return loss
@@ -52,7 +52,8 @@ if __name__ == '__main__':
     valid_scenario_db = ScenarioDB.from_dict(schema, read_json(args.valid_scenarios_path), Scenario)
 
     assert len(args.agent_checkpoints) <= len(args.agents)
-    systems = [get_system(name, args, schema, False, args.agent_checkpoints[i]) for i, name in enumerate(args.agents)]
+    # The RL agent's model is trained, so agents do not share models
+    systems = [get_system(name, args, schema, False, args.agent_checkpoints[i], shared_model=False) for i, name in enumerate(args.agents)]
 
     rl_agent = 0
     system = systems[rl_agent]
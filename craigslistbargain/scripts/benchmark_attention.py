@@ -0,0 +1,117 @@
+'''
+Attention calls per second, one decoding step at a time, with the padding
+mask built on every call (as before) and taken from the mask of the memory
+bank built once per batch (MaskCache, DecoderMemory.pad_mask):
+    - GlobalAttention given the memory lengths, or the padding mask;
+    - MultiHeadedAttention given the padding mask expanded over the queries;
+and check that the outputs are the same.
+'''
+
+import argparse
+import math
+import time
+import torch
+from torch.autograd import Variable
+
+from onmt.Utils import sequence_mask, padding_mask
+from onmt.modules import GlobalAttention, MultiHeadedAttention
+
+def reference_global_attention(attn, input, memory_bank, memory_lengths):
+    """GlobalAttention.forward of one step, building the mask on every call.
+    """
+    input = input.unsqueeze(1)
+    batch, sourceL, dim = memory_bank.size()
+    align = attn.score(input, memory_bank)
+    mask = sequence_mask(memory_lengths).unsqueeze(1)
+    align.data.masked_fill_(1 - mask, -float('inf'))
+    align_vectors = attn.sm(align.view(batch, sourceL)).view(batch, 1, sourceL)
+    c = torch.bmm(align_vectors, memory_bank)
+    concat_c = torch.cat([c, input], 2).view(batch, dim*2)
+    attn_h = attn.tanh(attn.linear_out(concat_c))
+    return attn_h, align_vectors.squeeze(1)
+
+def reference_multi_headed_attention(attn, query, mask, projected):
+    """MultiHeadedAttention.forward masking out of place and normalizing twice.
+    """
+    key, value = projected
+    batch, k_len, d = key.size()
+
+    def shape_projection(x):
+        b, l, d = x.size()
+        return x.view(b, l, attn.head_count, attn.dim_per_head) \
+            .transpose(1, 2).contiguous() \
+            .view(b * attn.head_count, l, attn.dim_per_head)
+
+    key_up = shape_projection(key)
+    value_up = shape_projection(value)
+    query_up = shape_projection(attn.linear_query(query))
+    scaled = torch.bmm(query_up, key_up.transpose(1, 2)) / math.sqrt(attn.dim_per_head)
+    bh, l, k = scaled.size()
+    scaled = scaled.view(batch, attn.head_count, l, k)
+    mask = mask.unsqueeze(1).expand_as(scaled)
+    scaled = scaled.masked_fill(Variable(mask), -1e18).view(bh, l, k)
+    attn_ = attn.sm(scaled)
+    top_attn = attn_.view(batch, attn.head_count, l, k)[:, 0, :, :].contiguous()
+    drop_attn = attn.dropout(attn.sm(scaled))
+    out = torch.bmm(drop_attn, value_up).view(batch, attn.head_count, l, attn.dim_per_head) \
+        .transpose(1, 2).contiguous().view(batch, l, attn.head_count * attn.dim_per_head)
+    return attn.res_dropout(out), top_attn
+
+def calls_per_second(call, steps):
+    start_time = time.time()
+    for _ in xrange(steps):
+        call()
+    return steps / (time.time() - start_time)
+
+def max_diff(outputs, ref_outputs):
+    return max(float((o.data - r.data).abs().max()) for o, r in zip(outputs, ref_outputs))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 128])
+    parser.add_argument('--src-len', type=int, default=50)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=2000, help='Calls per setting')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+
+    global_attn = GlobalAttention(args.dim, attn_type='general')
+    multi_attn = MultiHeadedAttention(args.heads, args.dim, dropout=0.)
+    global_attn.eval()
+    multi_attn.eval()
+
+    print '{:<24} {:>6} {:>14} {:>14} {:>14} {:>9}'.format(
+            'attention', 'batch', 'mask/call', 'cached mask', 'pad_mask', 'max diff')
+    for batch_size in args.batch_sizes:
+        lengths = torch.LongTensor(batch_size).random_(1, args.src_len + 1)
+        lengths[0] = args.src_len
+        pad_mask = padding_mask(lengths, args.src_len)
+        bank = Variable(torch.randn(batch_size, args.src_len, args.dim), volatile=True)
+        query = Variable(torch.randn(batch_size, args.dim), volatile=True)
+
+        ref_outputs = reference_global_attention(global_attn, query, bank, lengths)
+        diff = max(max_diff(global_attn(query, bank, memory_lengths=lengths), ref_outputs),
+                   max_diff(global_attn(query, bank, pad_mask=pad_mask), ref_outputs))
+        print '{:<24} {:>6} {:>14.0f} {:>14.0f} {:>14.0f} {:>9.2g}'.format('GlobalAttention', batch_size,
+                calls_per_second(lambda: reference_global_attention(global_attn, query, bank, lengths), args.steps),
+                calls_per_second(lambda: global_attn(query, bank, memory_lengths=lengths), args.steps),
+                calls_per_second(lambda: global_attn(query, bank, pad_mask=pad_mask), args.steps),
+                diff)
+        assert diff < 1e-5
+
+        # One query per row; the reference builds the mask from the lengths
+        query = query.unsqueeze(1)
+        projected = multi_attn.project(bank, bank)
+        mask = pad_mask.unsqueeze(1).expand(batch_size, 1, args.src_len)
+        ref_mask = lambda: sequence_mask(lengths).eq(0).unsqueeze(1)
+        ref_outputs = reference_multi_headed_attention(multi_attn, query, ref_mask(), projected)
+        diff = max_diff(multi_attn(None, None, query, mask=mask, projected=projected), ref_outputs)
+        print '{:<24} {:>6} {:>14.0f} {:>14} {:>14.0f} {:>9.2g}'.format('MultiHeadedAttention', batch_size,
+                calls_per_second(lambda: reference_multi_headed_attention(multi_attn, query, ref_mask(), projected),
+                    args.steps),
+                '-',
+                calls_per_second(lambda: multi_attn(None, None, query, mask=mask, projected=projected), args.steps),
+                diff)
+        assert diff < 1e-5
@@ -0,0 +1,228 @@
+'''
+Decode the test turns with rows evicted from the batch as they finish,
+against the decoding loops they replaced:
+    - Sampler: the whole batch for max_length steps, or until all rows are
+      done, against `generate_batch` (eviction) and `generate_stream` (the
+      turns are queued one by one and join the batch at step boundaries),
+      and against decoding one turn at a time;
+    - Generator (beam search): all beams until the slowest one is done
+      against `generate_batch` (evicting the examples whose beam is done).
+With greedy decoding, check that each loop gives the responses of the turns
+decoded alone. Then report the throughput and the number of decoder
+row-steps of each loop, sampling responses of mixed lengths.
+'''
+
+import argparse
+import time
+import torch
+from torch.autograd import Variable
+
+from cocoa.core.schema import Schema
+from cocoa.options import add_generator_arguments
+from cocoa.neural.beam import Beam, Scorer
+from cocoa.neural.generator import Generator
+from cocoa.neural.symbols import markers
+
+from neural import get_data_generator, make_model_mappings
+from neural import model_builder
+from neural.generator import get_generator
+from neural.utterance import UtteranceBuilder
+import options
+
+def reference_sample_batch(sampler, batch, until_done=False):
+    """Sampler.generate_batch before eviction: every row is decoded for
+    max_length steps (or until all rows are done).
+
+    Returns:
+        predictions (LongTensor): batch x 1 x seq_len
+        row_steps (int)
+    """
+    dec_out, dec_states, memory = sampler._start_decoder(batch, 1, None, 1)
+    data = sampler._row_data(batch.size, 1)
+    preds = []
+    finished = torch.zeros(batch.size).byte()
+    for i in xrange(sampler.max_length):
+        out = sampler.model.generator.forward(dec_out).data
+        pred = sampler._sample_rows(out, data)
+        preds.append(pred)
+        finished.masked_fill_(pred.eq(sampler.eos), 1)
+        if until_done and finished.min() == 1:
+            break
+        inp = Variable(pred.view(1, -1))
+        dec_out, dec_states, _ = sampler.model.decoder.decode_step(inp, memory, dec_states)
+    return torch.stack(preds).t().unsqueeze(1), batch.size * len(preds)
+
+def reference_beam_batch(generator, batch):
+    """Generator.generate_batch before eviction: all beams are advanced until
+    the last one is done.
+
+    Returns:
+        predictions: n-best token lists of each example
+        row_steps (int)
+    """
+    beam_size, batch_size, vocab = generator.beam_size, batch.size, generator.vocab
+    beam = [Beam(beam_size, n_best=generator.n_best, cuda=generator.cuda,
+                 global_scorer=generator.global_scorer,
+                 pad=vocab.to_ind(markers.PAD),
+                 bos=int(batch.decoder_inputs[0][b]),
+                 eos=vocab.to_ind(markers.EOS),
+                 min_length=generator.min_length)
+            for b in range(batch_size)]
+    dec_states, enc_memory_bank = generator._run_encoder(batch)
+    memory_bank = generator._run_attention_memory(batch, enc_memory_bank)
+    if isinstance(memory_bank, list):
+        memory_bank = [Variable(bank.data.repeat(1, beam_size, 1), volatile=True) for bank in memory_bank]
+    else:
+        memory_bank = Variable(memory_bank.data.repeat(1, beam_size, 1), volatile=True)
+    memory_lengths = batch.lengths.repeat(beam_size)
+    dec_states.repeat_beam_size_times(beam_size)
+    memory = generator.model.decoder.init_decoder_memory(memory_bank, memory_lengths)
+
+    steps = 0
+    for i in range(generator.max_length):
+        if all((b.done() for b in beam)):
+            break
+        steps += 1
+        inp = Variable(torch.stack([b.get_current_state() for b in beam])
+                       .t().contiguous().view(1, -1), volatile=True)
+        dec_out, dec_states, attn = generator.model.decoder.decode_step(inp, memory, dec_states)
+        out = generator.model.generator.forward(dec_out).data.view(beam_size, batch_size, -1)
+        beam_attn = attn["std"].data.view(beam_size, batch_size, -1)
+        for j, b in enumerate(beam):
+            b.advance(out[:, j], beam_attn[:, j, :memory_lengths[j]])
+            dec_states.beam_update(j, b.get_current_origin(), beam_size)
+    return generator._from_beam(beam)['predictions'], batch_size * beam_size * steps
+
+def read_batches(args, model_args, schema, batch_size):
+    args.batch_size = batch_size
+    data = get_data_generator(args, model_args, schema, test=True)
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    return [batch for batch in data_iter if batch is not None]
+
+def tokens(builder, predictions):
+    return [builder.build_target_tokens(preds[0]) for preds in predictions]
+
+def response_steps(responses, max_length):
+    # Each row is decoded up to its EOS (or max_length)
+    return sum(min(len(r) + 1, max_length) for r in responses)
+
+def run(decode, batches):
+    """Responses of each turn in order, and the decoding time.
+    """
+    start_time = time.time()
+    responses = [r for batch in batches for r in decode(batch)]
+    return responses, time.time() - start_time
+
+def run_stream(sampler, builder, requests, max_rows):
+    start_time = time.time()
+    responses = [None] * len(requests)
+    for i, output in sampler.generate_stream(requests, max_rows=max_rows):
+        responses[i] = tokens(builder, output['predictions'])[0]
+    return responses, time.time() - start_time
+
+def report(name, responses, elapsed, row_steps, ref_responses=None):
+    mismatches = 0
+    if ref_responses is not None:
+        mismatches = sum(r != ref_r for r, ref_r in zip(responses, ref_responses))
+    print '{:<34} {:>10.0f} {:>11} {:>11}'.format(name, len(responses) / elapsed, row_steps,
+            '-' if ref_responses is None else mismatches)
+    return mismatches
+
+def compare_sampling(sampler, builder, turns, batches, ref_responses=None):
+    """Decode with each loop; with `ref_responses`, count the responses that
+    are not the same. Returns the number of mismatches.
+    """
+    print '{:<34} {:>10} {:>11} {:>11}'.format('sampling', 'turns/s', 'row-steps', 'mismatches')
+    decode = lambda b: tokens(builder, sampler.generate_batch(b)['predictions'])
+    responses, elapsed = run(decode, turns)
+    mismatches = report('one turn at a time', responses, elapsed,
+            response_steps(responses, sampler.max_length), ref_responses)
+    for name, until_done in (('max_length steps (reference)', False), ('until all done (reference)', True)):
+        row_steps = [0]
+        def decode(batch):
+            preds, steps = reference_sample_batch(sampler, batch, until_done)
+            row_steps[0] += steps
+            return tokens(builder, preds)
+        responses, elapsed = run(decode, batches)
+        mismatches += report(name, responses, elapsed, row_steps[0], ref_responses)
+    responses, elapsed = run(lambda b: tokens(builder, sampler.generate_batch(b)['predictions']), batches)
+    mismatches += report('eviction', responses, elapsed,
+            response_steps(responses, sampler.max_length), ref_responses)
+    responses, elapsed = run_stream(sampler, builder, turns, batches[0].size)
+    mismatches += report('eviction + joins (stream)', responses, elapsed,
+            response_steps(responses, sampler.max_length), ref_responses)
+    return mismatches
+
+def compare_beam_search(generator, builder, batches):
+    print '{:<34} {:>10} {:>11} {:>11}'.format('beam search ({})'.format(generator.beam_size),
+            'turns/s', 'row-steps', 'mismatches')
+    row_steps = [0]
+    def decode(batch):
+        preds, steps = reference_beam_batch(generator, batch)
+        row_steps[0] += steps
+        return [builder.build_target_tokens(p[0]) for p in preds]
+    ref_responses, elapsed = run(decode, batches)
+    report('all beams (reference)', ref_responses, elapsed, row_steps[0])
+    responses, elapsed = run(lambda b: tokens(builder, generator.generate_batch(b)['predictions']), batches)
+    return report('eviction', responses, elapsed, '-', ref_responses)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-turns', type=int, default=320, help='Number of test turns')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('--beam', type=int, default=4, help='Beam size of beam search')
+    options.add_data_generator_arguments(parser)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    args.sample = True
+
+    dummy_parser = argparse.ArgumentParser()
+    options.add_model_arguments(dummy_parser)
+    options.add_data_generator_arguments(dummy_parser)
+    dummy_args = dummy_parser.parse_known_args([])[0]
+
+    mappings, model, model_args = model_builder.load_test_model(args.checkpoint, args, dummy_args.__dict__)
+    make_model_mappings(model_args.model, mappings)
+    schema = Schema(model_args.schema_path, None)
+    vocab = mappings['tgt_vocab']
+    sampler = get_generator(model, vocab, Scorer(args.alpha), args, model_args)
+    sampler.num_samples = 1
+    beam_search = Generator(model, vocab, beam_size=args.beam, n_best=1, max_length=args.max_length,
+                            global_scorer=Scorer(args.alpha), min_length=args.min_length)
+    builder = UtteranceBuilder(vocab)
+    torch.manual_seed(args.seed)
+
+    turns = read_batches(args, model_args, schema, 1)[:args.max_turns]
+    responses, _ = run(lambda b: tokens(builder, sampler.generate_batch(b)['predictions']), turns)
+    lengths = sorted(len(r) + 1 for r in responses)
+    print '{} turns, sampled response length: median {}, 90% {}, max {} (max_length {})'.format(
+            len(turns), lengths[len(lengths) / 2], lengths[len(lengths) * 9 / 10], lengths[-1],
+            args.max_length)
+
+    for batch_size in args.batch_sizes:
+        batches = read_batches(args, model_args, schema, batch_size)
+        # The first batches with --max-turns turns in all
+        num_turns = 0
+        for num_batches, batch in enumerate(batches):
+            num_turns += batch.size
+            if num_turns >= len(turns):
+                break
+        batches = batches[:num_batches+1]
+        batch_turns = turns[:num_turns]
+        print '\nbatch size {} ({} turns)'.format(batch_size, num_turns)
+
+        # Greedy: the same responses as the turns decoded alone
+        top_k = sampler.top_k
+        sampler.top_k = 1
+        ref_responses, _ = run(lambda b: tokens(builder, sampler.generate_batch(b)['predictions']), batch_turns)
+        print 'greedy:',
+        mismatches = compare_sampling(sampler, builder, batch_turns, batches, ref_responses)
+        assert not mismatches
+        sampler.top_k = top_k
+
+        print 'sampled:',
+        compare_sampling(sampler, builder, batch_turns, batches)
+        mismatches = compare_beam_search(beam_search, builder, batches)
+        assert not mismatches
@@ -0,0 +1,112 @@
+'''
+Export a training checkpoint for CPU inference with int8 Linear and LSTM
+weights (cocoa/neural/checkpoint.py --quantize) and compare it with the
+training checkpoint on the test examples (e.g. the dev set):
+    - perplexity, and (smoothed) BLEU of the generated responses against the
+      references;
+    - latency per turn (batch size 1) and memory of the loaded model.
+Each model is evaluated in its own process so that memory is measured alone.
+'''
+
+import argparse
+import gc
+import time
+import torch
+from multiprocessing import Process, Queue
+
+from cocoa.core.schema import Schema
+from cocoa.lib.bleu import bleu_stats, smoothed_bleu
+from cocoa.neural.beam import Scorer
+from cocoa.neural.checkpoint import convert_checkpoint
+from cocoa.neural.loss import SimpleLossCompute
+from cocoa.options import add_generator_arguments
+
+from neural import get_data_generator, make_model_mappings
+from neural import model_builder
+from neural.generator import get_generator
+from neural.trainer import Trainer
+from neural.utterance import UtteranceBuilder
+import options
+
+def rss():
+    with open('/proc/self/status') as fin:
+        for line in fin:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.
+
+def read_data(args, model_args, schema, batch_size):
+    args.batch_size = batch_size
+    return get_data_generator(args, model_args, schema, test=True)
+
+def evaluate_bleu(generator, builder, data):
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    stats = [0] * 10
+    for batch in data_iter:
+        if batch is None:
+            continue
+        predictions = generator.generate_batch(batch, gt_prefix=1)['predictions']
+        for b in xrange(batch.size):
+            gold = builder.build_target_tokens(batch.targets.data[:, b])
+            if gold:
+                pred = builder.build_target_tokens(predictions[b][0])
+                stats = [x + y for x, y in zip(stats, bleu_stats(pred, gold))]
+    return smoothed_bleu(stats) * 100
+
+def evaluate_latency(generator, data, max_turns):
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    batches = [batch for batch in data_iter if batch is not None][:max_turns]
+    start_time = time.time()
+    for batch in batches:
+        generator.generate_batch(batch, gt_prefix=1)
+    return (time.time() - start_time) / len(batches) * 1000
+
+def evaluate(args, dummy_args, model_path, queue):
+    torch.set_num_threads(args.num_threads)
+    memory = rss()
+    mappings, model, model_args = model_builder.load_test_model(model_path, args, dummy_args.__dict__)
+    gc.collect()
+    memory = rss() - memory
+
+    make_model_mappings(model_args.model, mappings)
+    schema = Schema(model_args.schema_path, None)
+    vocab = mappings['tgt_vocab']
+    data = read_data(args, model_args, schema, args.batch_size)
+
+    trainer = Trainer(model, None, SimpleLossCompute(model.generator, vocab), None)
+    ppl = trainer.validate(data.generator('test', shuffle=False, cuda=False)).ppl()
+    model.eval()
+
+    generator = get_generator(model, vocab, Scorer(args.alpha), args, model_args)
+    builder = UtteranceBuilder(vocab)
+    bleu_score = evaluate_bleu(generator, builder, data)
+    latency = evaluate_latency(generator, read_data(args, model_args, schema, 1), args.max_turns)
+    queue.put((ppl, bleu_score, latency, memory))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--export-path', required=True, help='Directory to write the exported checkpoint')
+    parser.add_argument('--max-turns', type=int, default=200, help='Number of turns to measure latency on')
+    parser.add_argument('--num-threads', type=int, default=1, help='CPU threads per model')
+    options.add_data_generator_arguments(parser)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    dummy_parser = argparse.ArgumentParser()
+    options.add_model_arguments(dummy_parser)
+    options.add_data_generator_arguments(dummy_parser)
+    dummy_args = dummy_parser.parse_known_args([])[0]
+
+    convert_checkpoint(args.checkpoint, args.export_path, quantize=True)
+
+    print '{:<10} {:>8} {:>6} {:>12} {:>10}'.format('model', 'ppl', 'BLEU', 'ms/turn', 'memory')
+    for name, model_path in (('float', args.checkpoint), ('int8', args.export_path)):
+        queue = Queue()
+        worker = Process(target=evaluate, args=(args, dummy_args, model_path, queue))
+        worker.start()
+        worker.join()
+        if worker.exitcode != 0:
+            raise RuntimeError('Evaluating the {} model failed'.format(name))
+        ppl, bleu_score, latency, memory = queue.get()
+        print '{:<10} {:>8.3f} {:>6.2f} {:>12.1f} {:>8.1f}MB'.format(name, ppl, bleu_score, latency, memory)
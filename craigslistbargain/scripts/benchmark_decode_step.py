@@ -0,0 +1,149 @@
+'''
+Step-wise decoding with decode_step (memory banks prepared once per batch,
+cached keys and values of the Transformer decoder) against calling the
+decoder's forward on every step:
+    - sample responses for the test turns with both and check that they are
+      the same (same seed), and report the speed of each;
+    - run a Transformer decoder (random weights) on outputs of increasing
+      length and report the time per step, which grows with the length when
+      forward runs the decoder on the whole prefix again.
+'''
+
+import argparse
+import time
+import torch
+from torch.autograd import Variable
+
+from cocoa.core.schema import Schema
+from cocoa.options import add_generator_arguments
+from cocoa.neural.beam import Scorer
+from onmt.modules import Embeddings, TransformerDecoder
+
+from neural import get_data_generator, make_model_mappings
+from neural import model_builder
+from neural.generator import get_generator
+from neural.utterance import UtteranceBuilder
+from neural.symbols import markers
+import options
+
+def reference_generate_batch(sampler, batch, gt_prefix=1):
+    """Sampler.generate_batch calling the decoder's forward on every step.
+    """
+    lengths = batch.lengths
+    dec_states, enc_memory_bank = sampler._run_encoder(batch)
+    memory_bank = sampler._run_attention_memory(batch, enc_memory_bank)
+    inp = batch.decoder_inputs[:gt_prefix]
+    dec_out, dec_states, _ = sampler.model.decoder(
+        inp, memory_bank, dec_states, memory_lengths=lengths)
+
+    preds = []
+    for i in xrange(sampler.max_length):
+        dec_out = dec_out.squeeze(0)
+        out = sampler.model.generator.forward(dec_out).data
+        scores = out.div(sampler.temperature)
+        scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
+        pred = torch.multinomial(scores.exp(), 1).squeeze(1)
+        preds.append(pred)
+        inp = Variable(pred.view(1, -1))
+        dec_out, dec_states, _ = sampler.model.decoder(
+            inp, memory_bank, dec_states, memory_lengths=lengths)
+    return torch.stack(preds).t().unsqueeze(1)
+
+def read_batches(args, model_args, schema):
+    data = get_data_generator(args, model_args, schema, test=True)
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    return [batch for batch in data_iter if batch is not None]
+
+def tokens(builder, predictions):
+    return [builder.build_target_tokens(p[0]) for p in predictions]
+
+def compare_sampler(sampler, builder, batches, seed):
+    mismatches = 0
+    times = [0., 0.]
+    for i, batch in enumerate(batches):
+        torch.manual_seed(seed + i)
+        start_time = time.time()
+        ref_preds = reference_generate_batch(sampler, batch)
+        times[0] += time.time() - start_time
+        torch.manual_seed(seed + i)
+        start_time = time.time()
+        preds = sampler.generate_batch(batch)['predictions']
+        times[1] += time.time() - start_time
+        mismatches += tokens(builder, ref_preds) != tokens(builder, preds)
+    return mismatches, times
+
+def time_transformer(decoder, vocab_size, hidden_size, batch_size, src_len, length, eos):
+    """Seconds per step of forward and of decode_step over `length` steps,
+    and the largest difference between their outputs.
+    """
+    # No padding in the source: forward masks PAD tokens, decode_step lengths
+    src = Variable(torch.LongTensor(src_len, batch_size).fill_(eos), volatile=True)
+    memory_bank = Variable(torch.randn(src_len, batch_size, hidden_size), volatile=True)
+    lengths = torch.LongTensor(batch_size).fill_(src_len)
+    tgt = Variable(torch.LongTensor(length, batch_size).random_(1, vocab_size), volatile=True)
+
+    state = decoder.init_decoder_state(src, memory_bank, None)
+    start_time = time.time()
+    outputs = []
+    for i in xrange(length):
+        out, state, _ = decoder(tgt[i:i+1], memory_bank, state)
+        outputs.append(out[-1].data)
+    forward_time = (time.time() - start_time) / length
+
+    state = decoder.init_decoder_state(src, memory_bank, None)
+    start_time = time.time()
+    memory = decoder.init_decoder_memory(memory_bank, lengths)
+    diff = 0
+    for i in xrange(length):
+        out, state, _ = decoder.decode_step(tgt[i:i+1], memory, state)
+        diff = max(diff, float((out.data - outputs[i]).abs().max()))
+    step_time = (time.time() - start_time) / length
+    return forward_time, step_time, diff
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-turns', type=int, default=200, help='Number of test batches to sample')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 25, 50, 100],
+                        help='Output lengths for the Transformer decoder')
+    parser.add_argument('--transformer-layers', type=int, default=2)
+    parser.add_argument('--transformer-size', type=int, default=256, help='Hidden size (a multiple of 8)')
+    options.add_data_generator_arguments(parser)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    args.sample = True
+
+    dummy_parser = argparse.ArgumentParser()
+    options.add_model_arguments(dummy_parser)
+    options.add_data_generator_arguments(dummy_parser)
+    dummy_args = dummy_parser.parse_known_args([])[0]
+
+    mappings, model, model_args = model_builder.load_test_model(args.checkpoint, args, dummy_args.__dict__)
+    make_model_mappings(model_args.model, mappings)
+    schema = Schema(model_args.schema_path, None)
+    vocab = mappings['tgt_vocab']
+    sampler = get_generator(model, vocab, Scorer(args.alpha), args, model_args)
+    builder = UtteranceBuilder(vocab)
+
+    if model_args.model != 'lf2lf':
+        batches = read_batches(args, model_args, schema)[:args.max_turns]
+        num_turns = sum(batch.size for batch in batches)
+        mismatches, (ref_time, step_time) = compare_sampler(sampler, builder, batches, args.seed)
+        print '{} batches, same seed: {} mismatches'.format(len(batches), mismatches)
+        print 'forward     {:>8.0f} turns/s'.format(num_turns / ref_time)
+        print 'decode_step {:>8.0f} turns/s'.format(num_turns / step_time)
+        assert not mismatches
+
+    hidden_size = args.transformer_size
+    embeddings = Embeddings(hidden_size, vocab.size, vocab.to_ind(markers.PAD), position_encoding=True)
+    decoder = TransformerDecoder(args.transformer_layers, hidden_size, 'general', False, 0., embeddings)
+    decoder.eval()
+    print 'Transformer decoder, {} layers, hidden size {}, batch size {}'.format(
+            args.transformer_layers, hidden_size, args.batch_size)
+    print '{:>6} {:>16} {:>16} {:>10}'.format('length', 'forward ms/step', 'decode_step', 'max diff')
+    for length in args.lengths:
+        forward_time, step_time, diff = time_transformer(decoder, vocab.size, hidden_size, args.batch_size, 20, length,
+                vocab.to_ind(markers.EOS))
+        print '{:>6} {:>16.2f} {:>16.2f} {:>10.2g}'.format(length, forward_time * 1000, step_time * 1000, diff)
+        assert diff < 1e-4
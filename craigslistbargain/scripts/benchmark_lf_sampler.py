@@ -0,0 +1,156 @@
+'''
+Sample logical forms for the test turns with the batched LFSampler.
+Check it against the sampler it replaced, which decodes one example at a time:
+    - at batch size 1 and the same seed, the predictions are the same;
+    - in larger batches, each row gets the tokens and the final decoder state
+      it gets when decoded alone (at a low temperature, where sampling is
+      nearly deterministic).
+Then report the throughput at each batch size.
+'''
+
+import argparse
+import copy
+import time
+import torch
+from torch.autograd import Variable
+
+from cocoa.core.schema import Schema
+from cocoa.options import add_generator_arguments
+from cocoa.neural.beam import Scorer
+
+from neural import get_data_generator, make_model_mappings
+from neural import model_builder
+from neural.generator import get_generator
+from neural.utterance import UtteranceBuilder
+import options
+
+def reference_generate_batch(sampler, batch, gt_prefix=1):
+    """LFSampler.generate_batch before batching: a new mask on every step and
+    the grammar checked on pred[0].
+    """
+    assert batch.size == 1
+    lengths = batch.lengths
+    dec_states, enc_memory_bank = sampler._run_encoder(batch)
+    memory_bank = sampler._run_attention_memory(batch, enc_memory_bank)
+    inp = batch.decoder_inputs[:gt_prefix]
+    dec_out, dec_states, _ = sampler.model.decoder(
+        inp, memory_bank, dec_states, memory_lengths=lengths)
+
+    preds = []
+    for i in xrange(sampler.max_length):
+        dec_out = dec_out.squeeze(0)
+        out = sampler.model.generator.forward(dec_out).data
+        scores = out.div(sampler.temperature)
+        if i > 0:
+            mask = torch.zeros(scores.size())
+            if pred[0] in sampler.price_actions:
+                mask[:, sampler.price_list] = 1
+            elif pred[0] in sampler.prices or pred[0] in sampler.actions:
+                mask = torch.zeros(scores.size())
+                mask[:, sampler.eos] = 1
+            else:
+                mask[:, :] = 1
+            scores[mask == 0] = -100.
+        scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
+        pred = torch.multinomial(scores.exp(), 1).squeeze(1)
+        preds.append(pred)
+        if pred[0] == sampler.eos:
+            break
+        inp = Variable(pred.view(1, -1))
+        dec_out, dec_states, _ = sampler.model.decoder(
+            inp, memory_bank, dec_states, memory_lengths=lengths)
+    return torch.stack(preds).t().unsqueeze(1), dec_states
+
+def select_row(batch, i):
+    """A batch of size 1 with row `i` of `batch` (padding included).
+    """
+    row = copy.copy(batch)
+    for attr in ('encoder_inputs', 'decoder_inputs', 'title_inputs', 'desc_inputs', 'targets', 'context_inputs'):
+        if hasattr(batch, attr):
+            setattr(row, attr, getattr(batch, attr)[:, i:i+1])
+    row.lengths = batch.lengths[i:i+1]
+    row.size = 1
+    return row
+
+def read_batches(args, model_args, schema, batch_size):
+    args.batch_size = batch_size
+    data = get_data_generator(args, model_args, schema, test=True)
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    return [batch for batch in data_iter if batch is not None]
+
+def tokens(builder, predictions):
+    return [builder.build_target_tokens(p[0]) for p in predictions]
+
+def check_seed(sampler, builder, batches, seed):
+    mismatches = 0
+    for i, batch in enumerate(batches):
+        torch.manual_seed(seed + i)
+        ref_preds, _ = reference_generate_batch(sampler, batch)
+        torch.manual_seed(seed + i)
+        preds = sampler.generate_batch(batch)['predictions']
+        mismatches += tokens(builder, ref_preds) != tokens(builder, preds)
+    return mismatches
+
+def check_rows(sampler, builder, batches):
+    mismatches = 0
+    for batch in batches:
+        output = sampler.generate_batch(batch)
+        hidden = output['dec_states'].hidden
+        for i, pred in enumerate(tokens(builder, output['predictions'])):
+            row_output = sampler.generate_batch(select_row(batch, i))
+            same_state = all(torch.allclose(h.data[:, i], row_h.data[:, 0], atol=1e-5)
+                for h, row_h in zip(hidden, row_output['dec_states'].hidden))
+            mismatches += not (pred == tokens(builder, row_output['predictions'])[0] and same_state)
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--seed', type=int, default=1)
+    options.add_data_generator_arguments(parser)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    args.sample = True
+
+    dummy_parser = argparse.ArgumentParser()
+    options.add_model_arguments(dummy_parser)
+    options.add_data_generator_arguments(dummy_parser)
+    dummy_args = dummy_parser.parse_known_args([])[0]
+
+    mappings, model, model_args = model_builder.load_test_model(args.checkpoint, args, dummy_args.__dict__)
+    assert model_args.model == 'lf2lf', 'LFSampler is used by lf2lf models'
+    make_model_mappings(model_args.model, mappings)
+    schema = Schema(model_args.schema_path, None)
+    vocab = mappings['tgt_vocab']
+    sampler = get_generator(model, vocab, Scorer(args.alpha), args, model_args)
+    builder = UtteranceBuilder(vocab)
+
+    batches = read_batches(args, model_args, schema, 1)
+    mismatches = check_seed(sampler, builder, batches, args.seed)
+    print '{} turns, same seed: {} mismatches'.format(len(batches), mismatches)
+    assert not mismatches
+
+    temperature = sampler.temperature
+    sampler.temperature = 1e-3
+    for batch_size in args.batch_sizes:
+        if batch_size > 1:
+            mismatches = check_rows(sampler, builder, read_batches(args, model_args, schema, batch_size)[:5])
+            print 'batch size {}, rows decoded alone: {} mismatches'.format(batch_size, mismatches)
+            assert not mismatches
+    sampler.temperature = temperature
+
+    for batch_size in args.batch_sizes:
+        batches = read_batches(args, model_args, schema, batch_size)
+        num_turns = sum(batch.size for batch in batches)
+        start_time = time.time()
+        for batch in batches:
+            sampler.generate_batch(batch)
+        t = time.time() - start_time
+        line = 'batch size {:<3} {:.3f}s  {:>8.0f} turns/s'.format(batch_size, t, num_turns / t)
+        if batch_size == 1:
+            start_time = time.time()
+            for batch in batches:
+                reference_generate_batch(sampler, batch)
+            line += '  (unbatched sampler {:>8.0f} turns/s)'.format(num_turns / (time.time() - start_time))
+        print line
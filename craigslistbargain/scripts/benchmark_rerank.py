@@ -0,0 +1,159 @@
+'''
+Rerank sampled responses for the test turns (one turn per batch, as in a
+session) with Reranker:
+    - the teacher-forced scores of `score_batch` are the log probabilities
+      accumulated by the sampler, and those of the n-best hypotheses of beam
+      search (which are reranked as well);
+    - report the latency per turn of one sample, of N candidates sampled and
+      rescored in one pass each, and of N passes of each;
+    - report the margin of the responses with a price, with and without the
+      margin utility, and the number of candidates under a latency budget.
+'''
+
+import argparse
+import time
+import torch
+
+from cocoa.core.entity import is_entity
+from cocoa.core.schema import Schema
+from cocoa.options import add_generator_arguments
+from cocoa.neural.beam import Scorer
+from cocoa.neural.generator import Generator
+from cocoa.neural.rerank import Reranker
+
+from neural import get_data_generator, make_model_mappings
+from neural import model_builder
+from neural.generator import get_generator
+from neural.rerank import price_margin
+from neural.utterance import UtteranceBuilder
+import options
+
+def read_batches(args, model_args, schema):
+    data = get_data_generator(args, model_args, schema, test=True)
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    return [batch for batch in data_iter if batch is not None]
+
+def kbs(batch):
+    return batch.context_data['kbs']
+
+def check_scores(sampler, batches, num_samples):
+    """Largest difference between the scores of the sampler and those of
+    `score_batch`.
+    """
+    diff = 0
+    for batch in batches:
+        output = sampler.generate_batch(batch, num_samples=num_samples)
+        scores, _ = sampler.score_batch(batch, output['predictions'])
+        diff = max(diff, float((scores - torch.FloatTensor(output['scores'])).abs().max()))
+    return diff
+
+def check_beam_scores(reranker, batches):
+    """Largest difference between the scores of the n-best hypotheses of
+    beam search (without length penalty) and those of `score_batch`; each
+    batch is also reranked.
+    """
+    generator = reranker.generator
+    diff = 0
+    for batch in batches:
+        output = generator.generate_batch(batch)
+        candidates = reranker._candidates(output['predictions'])
+        scores, _ = generator.score_batch(batch, candidates)
+        beam_scores = [[float(s) for s in example[:candidates.size(1)]] for example in output['scores']]
+        diff = max(diff, float((scores - torch.FloatTensor(beam_scores)).abs().max()))
+        reranker.generate_batch(batch, kbs(batch))
+    return diff
+
+def generate_separately(reranker, batch):
+    """Reranker.generate_batch with one pass per candidate.
+    """
+    sampler = reranker.generator
+    outputs = [sampler.generate_batch(batch, num_samples=1) for _ in xrange(reranker.num_candidates)]
+    scores = [reranker.score(batch, output['predictions'], kbs(batch)) for output in outputs]
+    return outputs[int(torch.cat(scores, 1).max(1)[1].view(-1)[0])]
+
+def latency(generate, batches):
+    start_time = time.time()
+    for batch in batches:
+        generate(batch)
+    return (time.time() - start_time) / len(batches) * 1000
+
+def mean_margin(builder, generate, batches):
+    """Mean margin of the responses with a price, and their number.
+    """
+    margins = []
+    for batch in batches:
+        predictions = generate(batch)['predictions']
+        for pred, kb in zip(predictions, kbs(batch)):
+            tokens = builder.build_target_tokens(pred[0], kb)
+            if any(is_entity(t) for t in tokens):
+                margins.append(price_margin(tokens, kb))
+    return sum(margins) / max(1, len(margins)), len(margins)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-turns', type=int, default=200, help='Number of test turns')
+    parser.add_argument('--candidates', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--weight', type=float, default=5., help='Weight of the margin utility')
+    parser.add_argument('--budget', type=float, default=0.01, help='Latency budget (seconds)')
+    options.add_data_generator_arguments(parser)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    args.sample = True
+    args.batch_size = 1
+
+    dummy_parser = argparse.ArgumentParser()
+    options.add_model_arguments(dummy_parser)
+    options.add_data_generator_arguments(dummy_parser)
+    dummy_args = dummy_parser.parse_known_args([])[0]
+
+    mappings, model, model_args = model_builder.load_test_model(args.checkpoint, args, dummy_args.__dict__)
+    make_model_mappings(model_args.model, mappings)
+    schema = Schema(model_args.schema_path, None)
+    vocab = mappings['tgt_vocab']
+    sampler = get_generator(model, vocab, Scorer(args.alpha), args, model_args)
+    builder = UtteranceBuilder(vocab)
+    batches = read_batches(args, model_args, schema)[:args.max_turns]
+    torch.manual_seed(args.seed)
+
+    diff = check_scores(sampler, batches, max(args.candidates))
+    print '{} turns, teacher-forced against sampled log probabilities: max diff {:.2g}'.format(len(batches), diff)
+    assert diff < 1e-3
+
+    n = max(args.candidates)
+    beam_search = Generator(model, vocab, beam_size=n, n_best=n, max_length=args.max_length,
+                            global_scorer=Scorer(0.), min_length=args.min_length)
+    diff = check_beam_scores(Reranker(beam_search, builder, n, utility=price_margin, weight=args.weight),
+                             batches)
+    print '{} turns, teacher-forced against beam search log probabilities of the {}-best: max diff {:.2g}'.format(
+            len(batches), n, diff)
+    assert diff < 1e-3
+
+    print '{:<12} {:>16} {:>16} {:>16}'.format('candidates', '1 sample ms', 'reranked ms', 'N passes ms')
+    for n in args.candidates:
+        reranker = Reranker(sampler, builder, n, utility=price_margin, weight=args.weight, alpha=args.alpha)
+        print '{:<12} {:>16.2f} {:>16.2f} {:>16.2f}'.format(n,
+                latency(lambda b: sampler.generate_batch(b, num_samples=1), batches),
+                latency(lambda b: reranker.generate_batch(b, kbs(b)), batches),
+                latency(lambda b: generate_separately(reranker, b), batches))
+
+    n = max(args.candidates)
+    print '{:<24} {:>8} {:>8}'.format('margin of price turns', 'mean', 'turns')
+    print '{:<24} {:>8.3f} {:>8}'.format('1 sample', *mean_margin(builder,
+            lambda b: sampler.generate_batch(b, num_samples=1), batches))
+    for name, utility in (('likelihood', None), ('margin utility', price_margin)):
+        reranker = Reranker(sampler, builder, n, utility=utility, weight=args.weight, alpha=args.alpha)
+        print '{:<24} {:>8.3f} {:>8}'.format('{} x{}'.format(name, n), *mean_margin(builder,
+                lambda b: reranker.generate_batch(b, kbs(b)), batches))
+
+    reranker = Reranker(sampler, builder, n, utility=price_margin, weight=args.weight, alpha=args.alpha,
+            budget=args.budget)
+    num_candidates = []
+    start_time = time.time()
+    for batch in batches:
+        num_candidates.append(reranker.num_candidates)
+        reranker.generate_batch(batch, kbs(batch))
+    print 'budget {:.0f} ms: {:.2f} ms/turn, {:.1f} candidates on average, {} turns not rescored'.format(
+            args.budget * 1000, (time.time() - start_time) / len(batches) * 1000,
+            float(sum(num_candidates)) / len(num_candidates), reranker.num_skipped)
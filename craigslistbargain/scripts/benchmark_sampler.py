@@ -0,0 +1,191 @@
+'''
+Sample responses for the test turns with the sampling engine of Sampler
+(top-k / nucleus truncation, vocabulary masks, per-row temperature and
+several samples per context) and check it against the sampler it replaced,
+which samples from the full softmax:
+    - with no truncation and the same seed, the samples are the same, and so
+      are they with a per-row temperature equal to the global one;
+    - `truncate_scores` (topk) keeps the same tokens as a truncation that sorts
+      the vocabulary, and masked tokens are never sampled.
+Then report the throughput of each setting, and of sampling several responses
+per context in one pass against one pass per sample.
+'''
+
+import argparse
+import time
+import torch
+from torch.autograd import Variable
+
+from cocoa.core.entity import is_entity
+from cocoa.core.schema import Schema
+from cocoa.options import add_generator_arguments
+from cocoa.neural.beam import Scorer
+from cocoa.neural.generator import truncate_scores
+import cocoa.neural.generator as cocoa_generator
+
+from neural import get_data_generator, make_model_mappings
+from neural import model_builder
+from neural.generator import get_generator
+from neural.utterance import UtteranceBuilder
+import options
+
+def reference_generate_batch(sampler, batch, gt_prefix=1):
+    """Sampler.generate_batch before the sampling engine: full softmax.
+    """
+    lengths = batch.lengths
+    dec_states, enc_memory_bank = sampler._run_encoder(batch)
+    memory_bank = sampler._run_attention_memory(batch, enc_memory_bank)
+    inp = batch.decoder_inputs[:gt_prefix]
+    dec_out, dec_states, _ = sampler.model.decoder(
+        inp, memory_bank, dec_states, memory_lengths=lengths)
+    dec_out = dec_out.squeeze(0)
+    memory = sampler.model.decoder.init_decoder_memory(memory_bank, lengths)
+
+    preds = []
+    for i in xrange(sampler.max_length):
+        out = sampler.model.generator.forward(dec_out).data
+        scores = out.div(sampler.temperature)
+        scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
+        pred = torch.multinomial(scores.exp(), 1).squeeze(1)
+        preds.append(pred)
+        inp = Variable(pred.view(1, -1))
+        dec_out, dec_states, _ = sampler.model.decoder.decode_step(inp, memory, dec_states)
+    return torch.stack(preds).t().unsqueeze(1)
+
+def sort_truncate_scores(scores, top_k=0, top_p=1.):
+    """truncate_scores with a sort of the whole vocabulary.
+    """
+    sorted_scores, indices = scores.sort(1, descending=True)
+    if 0 < top_k < scores.size(1):
+        sorted_scores[:, top_k:] = -float('inf')
+    if top_p < 1:
+        probs = sorted_scores.sub(sorted_scores[:, :1].expand_as(sorted_scores)).exp_()
+        probs.div_(probs.sum(1, keepdim=True).expand_as(probs))
+        cum_probs = probs.cumsum(1)
+        # Keep the token reaching top_p
+        removed = cum_probs[:, :-1] >= top_p
+        sorted_scores[:, 1:].masked_fill_(removed, -float('inf'))
+    return scores.scatter_(1, indices, sorted_scores)
+
+class SortTruncation(object):
+    """Sample with `sort_truncate_scores` in place of `truncate_scores`.
+    """
+    def __enter__(self):
+        self.truncate_scores = cocoa_generator.truncate_scores
+        cocoa_generator.truncate_scores = sort_truncate_scores
+
+    def __exit__(self, *args):
+        cocoa_generator.truncate_scores = self.truncate_scores
+
+def read_batches(args, model_args, schema):
+    data = get_data_generator(args, model_args, schema, test=True)
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    return [batch for batch in data_iter if batch is not None]
+
+def tokens(builder, predictions):
+    return [[builder.build_target_tokens(p) for p in preds] for preds in predictions]
+
+def check_seed(sampler, builder, batches, seed):
+    mismatches = [0, 0]
+    for i, batch in enumerate(batches):
+        torch.manual_seed(seed + i)
+        ref_preds = tokens(builder, reference_generate_batch(sampler, batch))
+        torch.manual_seed(seed + i)
+        mismatches[0] += ref_preds != tokens(builder, sampler.generate_batch(batch)['predictions'])
+        torch.manual_seed(seed + i)
+        temperature = torch.FloatTensor(batch.size).fill_(sampler.temperature)
+        preds = sampler.generate_batch(batch, temperature=temperature)['predictions']
+        mismatches[1] += ref_preds != tokens(builder, preds)
+    return mismatches
+
+def check_truncation(sampler, batches, settings):
+    """Number of rows where `truncate_scores` and `sort_truncate_scores` keep
+    different tokens, out of the number of rows.
+    """
+    mismatches, rows = 0, 0
+    for batch in batches:
+        dec_out, _, _ = sampler._start_decoder(batch, 1, None, 1)
+        out = sampler.model.generator.forward(dec_out).data
+        for top_k, top_p in settings:
+            kept = truncate_scores(out.clone(), top_k, top_p).ne(-float('inf'))
+            sort_kept = sort_truncate_scores(out.clone(), top_k, top_p).ne(-float('inf'))
+            mismatches += kept.ne(sort_kept).long().sum(1).gt(0).long().sum()
+            rows += out.size(0)
+    return mismatches, rows
+
+def check_mask(sampler, builder, batches, deny):
+    """Number of masked tokens sampled.
+    """
+    mask = sampler.vocab_mask(deny=deny)
+    denied = set(map(sampler.vocab.to_word, deny))
+    sampled = 0
+    for batch in batches:
+        preds = sampler.generate_batch(batch, vocab_mask=mask)['predictions']
+        sampled += sum(1 for sample in tokens(builder, preds) for p in sample for w in p if w in denied)
+    return sampled
+
+def throughput(generate, batches, repeat=1):
+    start_time = time.time()
+    for batch in batches:
+        for _ in xrange(repeat):
+            generate(batch)
+    return time.time() - start_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-turns', type=int, default=100, help='Number of test batches')
+    parser.add_argument('--samples', type=int, default=8, help='Samples per context for the multi-sample pass')
+    options.add_data_generator_arguments(parser)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    args.sample = True
+
+    dummy_parser = argparse.ArgumentParser()
+    options.add_model_arguments(dummy_parser)
+    options.add_data_generator_arguments(dummy_parser)
+    dummy_args = dummy_parser.parse_known_args([])[0]
+
+    mappings, model, model_args = model_builder.load_test_model(args.checkpoint, args, dummy_args.__dict__)
+    assert model_args.model != 'lf2lf', 'See benchmark_lf_sampler.py for LFSampler'
+    make_model_mappings(model_args.model, mappings)
+    schema = Schema(model_args.schema_path, None)
+    vocab = mappings['tgt_vocab']
+    sampler = get_generator(model, vocab, Scorer(args.alpha), args, model_args)
+    sampler.top_k, sampler.top_p, sampler.num_samples = 0, 1., 1
+    builder = UtteranceBuilder(vocab)
+    batches = read_batches(args, model_args, schema)[:args.max_turns]
+    num_turns = sum(batch.size for batch in batches)
+
+    mismatches = check_seed(sampler, builder, batches, args.seed)
+    print '{} batches, same seed: {} mismatches, {} with per-row temperature'.format(len(batches), *mismatches)
+    assert not any(mismatches)
+
+    settings = [(10, 1.), (0, 0.9), (0, 0.99), (20, 0.9)]
+    mismatches, rows = check_truncation(sampler, batches, settings)
+    print 'top-k/nucleus against full sort: {} of {} rows keep different tokens'.format(mismatches, rows)
+
+    prices = [vocab.to_ind(w) for w in vocab.word_to_ind if is_entity(w)]
+    sampled = check_mask(sampler, builder, batches, prices)
+    print 'masked {} price tokens: {} sampled'.format(len(prices), sampled)
+    assert not sampled
+
+    print '{:<28} {:>10}'.format('sampling', 'turns/s')
+    print '{:<28} {:>10.0f}'.format('full softmax (reference)',
+            num_turns / throughput(lambda b: reference_generate_batch(sampler, b), batches))
+    for top_k, top_p in [(0, 1.)] + settings:
+        sampler.top_k, sampler.top_p = top_k, top_p
+        name = 'top-k {} top-p {}'.format(top_k, top_p)
+        print '{:<28} {:>10.0f}'.format(name, num_turns / throughput(sampler.generate_batch, batches))
+        if top_p < 1:
+            with SortTruncation():
+                print '{:<28} {:>10.0f}'.format(name + ' (sort)',
+                        num_turns / throughput(sampler.generate_batch, batches))
+    sampler.top_k, sampler.top_p = 0, 0.9
+
+    n = args.samples
+    t = throughput(lambda b: sampler.generate_batch(b, num_samples=n), batches)
+    print '{:<28} {:>10.0f}'.format('{} samples, one pass'.format(n), num_turns * n / t)
+    t = throughput(sampler.generate_batch, batches, repeat=n)
+    print '{:<28} {:>10.0f}'.format('{} samples, {} passes'.format(n, n), num_turns * n / t)
@@ -0,0 +1,103 @@
+'''
+Compute the training loss and gradients of the largest test batch with the
+generator and the loss sharded over time steps (SimpleLossCompute with
+--shard-size) and without, for several batch sizes:
+    - the gradients are the same (up to float rounding);
+    - report the peak memory of the forward and backward pass, and its time.
+Each setting runs in its own process so that peak memory is measured alone.
+'''
+
+import argparse
+import time
+import torch
+from multiprocessing import Process, Queue
+
+from cocoa.core.schema import Schema
+from cocoa.neural.loss import SimpleLossCompute
+from cocoa.options import add_generator_arguments
+
+from neural import get_data_generator, make_model_mappings
+from neural import model_builder
+from neural.trainer import Trainer
+import options
+
+def memory_status():
+    """Current and peak resident memory of this process in MB.
+    """
+    status = {}
+    with open('/proc/self/status') as fin:
+        for line in fin:
+            fields = line.split()
+            if fields[0] in ('VmRSS:', 'VmHWM:'):
+                status[fields[0][:-1]] = int(fields[1]) / 1024.
+    return status['VmRSS'], status['VmHWM']
+
+def reset_peak_memory():
+    with open('/proc/self/clear_refs', 'w') as fout:
+        fout.write('5')
+
+def largest_batch(args, model_args, schema, batch_size):
+    args.batch_size = batch_size
+    data = get_data_generator(args, model_args, schema, test=True)
+    data_iter = data.generator('test', shuffle=False, cuda=False)
+    data_iter.next()
+    batches = [batch for batch in data_iter if batch is not None]
+    return max(batches, key=lambda batch: batch.targets.numel())
+
+def run(args, dummy_args, batch_size, shard_size, queue):
+    torch.manual_seed(args.seed)
+    mappings, model, model_args = model_builder.load_test_model(args.checkpoint, args, dummy_args.__dict__, cache=False)
+    make_model_mappings(model_args.model, mappings)
+    schema = Schema(model_args.schema_path, None)
+    batch = largest_batch(args, model_args, schema, batch_size)
+
+    loss = SimpleLossCompute(model.generator, mappings['tgt_vocab'], shard_size=shard_size)
+    trainer = Trainer(model, loss, None, None)
+    # No dropout, so that the gradients can be compared
+    model.eval()
+
+    memory, _ = memory_status()
+    reset_peak_memory()
+    start_time = time.time()
+    model.zero_grad()
+    outputs, _, _ = trainer._run_batch(batch)
+    stats = loss.sharded_compute_loss(batch.targets, outputs)
+    elapsed = time.time() - start_time
+    _, peak_memory = memory_status()
+
+    grads = [p.grad.data.clone() for p in model.parameters() if p.grad is not None]
+    queue.put((tuple(batch.targets.size()), stats.n_words, peak_memory - memory, elapsed, grads))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[64, 256, 512])
+    parser.add_argument('--shard-sizes', type=int, nargs='+', default=[0, 8, 2],
+                        help='Time steps per shard (0: no sharding)')
+    options.add_data_generator_arguments(parser)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    args.sample = True
+
+    dummy_parser = argparse.ArgumentParser()
+    options.add_model_arguments(dummy_parser)
+    options.add_data_generator_arguments(dummy_parser)
+    dummy_args = dummy_parser.parse_known_args([])[0]
+
+    print '{:>6} {:>10} {:>7} {:>12} {:>8} {:>10}'.format(
+            'batch', 'tokens', 'shard', 'peak memory', 'time', 'grad diff')
+    for batch_size in args.batch_sizes:
+        ref_grads = None
+        for shard_size in args.shard_sizes:
+            queue = Queue()
+            worker = Process(target=run, args=(args, dummy_args, batch_size, shard_size, queue))
+            worker.start()
+            size, num_words, memory, elapsed, grads = queue.get()
+            worker.join()
+            if ref_grads is None:
+                ref_grads = grads
+            diff = max(float((g - ref_g).abs().max() / (ref_g.abs().max() + 1e-8))
+                    for g, ref_g in zip(grads, ref_grads))
+            print '{:>6} {:>10} {:>7} {:>10.1f}MB {:>7.3f}s {:>10.2g}'.format(
+                    size[1], '{}x{}'.format(*size), shard_size or '-', memory, elapsed, diff)
+            assert diff < 1e-4
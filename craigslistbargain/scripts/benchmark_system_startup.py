@@ -0,0 +1,60 @@
+'''
+Start several worker processes that each load a system (like web workers) and
+report the load time and memory of each. Run with and without --asset-cache
+to compare. With --num-agents, each worker loads the system once per agent
+(like bot_bot_chat.py); neural systems share the model unless --no-shared-model.
+'''
+
+import argparse
+import time
+from multiprocessing import Process, Queue
+
+from cocoa.core.schema import Schema
+from cocoa.options import add_scenario_arguments
+
+import options
+from systems import get_system
+
+def memory_usage():
+    """Return (RSS, PSS) of this process in MB; PSS counts shared pages once.
+    """
+    usage = {'Rss': 0, 'Pss': 0}
+    with open('/proc/self/smaps') as fin:
+        for line in fin:
+            fields = line.split()
+            if fields[0][:-1] in usage:
+                usage[fields[0][:-1]] += int(fields[1])
+    return usage['Rss'] / 1024., usage['Pss'] / 1024.
+
+def load_system(args, queue):
+    start_time = time.time()
+    schema = Schema(args.schema_path) if args.schema_path else None
+    systems = [get_system(args.system, args, schema=schema, model_path=args.checkpoint, shared_model=args.shared_model)
+            for _ in xrange(args.num_agents)]
+    load_time = time.time() - start_time
+    # Keep the systems alive while other workers are measured
+    queue.put((load_time, ) + memory_usage())
+    time.sleep(args.hold)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--system', default='rulebased', help='Type of system to load')
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--hold', type=float, default=5., help='Seconds each worker keeps its system loaded')
+    parser.add_argument('--num-agents', type=int, default=1, help='Number of systems each worker loads')
+    parser.add_argument('--no-shared-model', dest='shared_model', action='store_false', help='Load a model per agent')
+    options.add_system_arguments(parser)
+    add_scenario_arguments(parser)
+    args = parser.parse_args()
+
+    queue = Queue()
+    workers = []
+    # Start workers one after another so that the first one builds the assets
+    for i in xrange(args.num_workers):
+        worker = Process(target=load_system, args=(args, queue))
+        worker.start()
+        workers.append(worker)
+        load_time, rss, pss = queue.get()
+        print 'worker {}: load {:.2f}s, RSS {:.1f}MB, PSS {:.1f}MB'.format(i, load_time, rss, pss)
+    for worker in workers:
+        worker.join()
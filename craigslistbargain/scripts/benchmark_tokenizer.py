@@ -0,0 +1,62 @@
+'''
+Tokenize all messages in transcripts with the NLTK pipeline (the reference),
+the fast tokenizer and the cached tokenizer; check that the tokens are the
+same and report the throughput of each.
+'''
+
+import argparse
+import re
+import time
+
+from cocoa.core.util import read_json
+from core.tokenizer import stick_dollar_sign, tokenize, tokenize_batch, _tokenize
+
+def reference_tokenize(utterance, lowercase=True):
+    from nltk.tokenize import word_tokenize
+    if lowercase:
+        utterance = utterance.lower()
+    utterance = re.sub(r'\.{2,}', '...', utterance)
+    utterance = re.sub(r'\\|>|/', ' ', utterance)
+    return stick_dollar_sign(word_tokenize(utterance))
+
+def read_messages(paths):
+    messages = []
+    for path in paths:
+        for example in read_json(path):
+            messages.extend([e['data'] for e in example['events'] if e['action'] == 'message'])
+    return messages
+
+def run(name, tokenize_all, messages, repeat):
+    times = []
+    for _ in xrange(repeat):
+        start_time = time.time()
+        tokens = tokenize_all(messages)
+        times.append(time.time() - start_time)
+    t = min(times)
+    print '{:<10} {:.3f}s  {:>8.0f} messages/s'.format(name, t, len(messages) / t)
+    return tokens, t
+
+def cached(messages):
+    tokenize.clear()
+    return tokenize_batch(messages)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transcripts', nargs='+', required=True, help='JSON transcripts')
+    parser.add_argument('--repeat', type=int, default=3, help='Report the fastest of this many runs')
+    args = parser.parse_args()
+
+    messages = read_messages(args.transcripts)
+    print '{} messages, {} unique'.format(len(messages), len(set(messages)))
+    # Load NLTK data before timing
+    reference_tokenize(u'hi.'); _tokenize(u'hi.')
+
+    ref_tokens, ref_time = run('nltk', lambda m: [reference_tokenize(x) for x in m], messages, args.repeat)
+    fast_tokens, fast_time = run('fast', lambda m: [_tokenize(x) for x in m], messages, args.repeat)
+    cached_tokens, cached_time = run('cached', cached, messages, args.repeat)
+
+    mismatches = [m for m, a, b, c in zip(messages, ref_tokens, fast_tokens, cached_tokens) if not a == b == c]
+    for message in mismatches[:10]:
+        print 'MISMATCH:', repr(message)
+    assert not mismatches, '{} messages are tokenized differently'.format(len(mismatches))
+    print 'Tokens identical. Speedup: fast {:.1f}x, cached {:.1f}x'.format(ref_time / fast_time, ref_time / cached_time)
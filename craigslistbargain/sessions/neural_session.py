@@ -7,10 +7,12 @@ from onmt.Utils import use_gpu
 
 from cocoa.model.vocab import Vocabulary
 from cocoa.core.entity import is_entity, Entity
+from cocoa.neural.generator import Sampler
 
 from core.event import Event
 from session import Session
-from neural.preprocess import markers, Dialogue
+from neural.preprocess import markers, Dialogue, category_to_marker
+from neural.symbols import category_markers
 from neural.batcher import Batch
 
 class NeuralSession(Session):
@@ -111,10 +113,23 @@ class PytorchNeuralSession(NeuralSession):
 
         self.dec_state = None
         self.stateful = self.env.model.stateful
+        self.reranker = env.reranker
 
         self.new_turn = False
         self.end_turn = False
 
+        # Tokens that are never valid outputs in this dialogue, masked once
+        # for all turns when sampling
+        self.vocab_mask = None
+        if isinstance(self.generator, Sampler):
+            self.vocab_mask = self.generator.vocab_mask(deny=self._invalid_tokens())
+
+    def _invalid_tokens(self):
+        category = category_to_marker[self.kb.category]
+        words = [markers.GO_S, markers.GO_B, markers.PAD, Vocabulary.UNK] + \
+                [w for w in category_markers if w != category]
+        return [self.vocab.to_ind(w) for w in words if self.vocab.has(w)]
+
     def get_decoder_inputs(self):
         # Don't include EOS
         utterance = self.dialogue._insert_markers(self.agent, [], True)[:-1]
@@ -155,7 +170,15 @@ class PytorchNeuralSession(NeuralSession):
         batch = self._create_batch()
 
         enc_state = self.dec_state.hidden if self.dec_state is not None else None
-        output_data = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix, enc_state=enc_state)
+        kwargs = {}
+        if self.vocab_mask is not None:
+            kwargs = {'vocab_mask': self.vocab_mask, 'num_samples': 1}
+        if self.reranker is not None:
+            output_data = self.reranker.generate_batch(batch, [self.kb], gt_prefix=self.gt_prefix,
+                    enc_state=enc_state, **kwargs)
+        else:
+            output_data = self.generator.generate_batch(batch, gt_prefix=self.gt_prefix, enc_state=enc_state,
+                    **kwargs)
 
         if self.stateful:
             # TODO: only works for Sampler for now. cannot do beam search.
@@ -1,32 +1,72 @@
+import time
+
 from cocoa.core.util import read_json, read_pickle
+from cocoa.io.assets import AssetRegistry
 
 import options
 
 
-def get_system(name, args, schema=None, timed=False, model_path=None):
+def get_asset_registry(args):
+    """Registry of shared system assets if --asset-cache is set.
+    """
+    cache_dir = getattr(args, 'asset_cache', None)
+    if cache_dir is None:
+        return None
+    return AssetRegistry(cache_dir)
+
+def load_price_tracker(args, registry=None):
     from core.price_tracker import PriceTracker
-    lexicon = PriceTracker(args.price_tracker_model)
+    path = args.price_tracker_model
+    if registry is None:
+        return PriceTracker(path)
+    return registry.get('price_tracker', [path], load=lambda: PriceTracker(path))
+
+def load_generator(args, registry=None):
+    from model.generator import Templates, Generator
+    if registry is None:
+        return Generator(Templates.from_pickle(args.templates))
+    build = lambda path: Generator(Templates.from_pickle(args.templates)).write_assets(path)
+    return registry.get('generator', [args.templates], load=Generator.from_assets, build=build)
+
+def load_manager(args, registry=None):
+    from model.manager import Manager
+    if registry is None:
+        return Manager.from_pickle(args.policy)
+    return registry.get('manager', [args.policy], load=lambda: Manager.from_pickle(args.policy))
+
+def get_system(name, args, schema=None, timed=False, model_path=None, shared_model=True, rerank=None):
+    """Load the system `name`.
+
+    Neural systems share their model with other systems loading the same
+    checkpoint, unless `shared_model` is False (e.g. the model is trained).
+    `rerank` overrides the --rerank-* options of neural systems (see
+    neural.rerank.get_reranker).
+    """
+    start_time = time.time()
+    registry = get_asset_registry(args)
+    lexicon = load_price_tracker(args, registry)
 
     if name == 'rulebased':
         from rulebased_system import RulebasedSystem
-        from model.generator import Templates, Generator
-        from model.manager import Manager
-        templates = Templates.from_pickle(args.templates)
-        generator = Generator(templates)
-        manager = Manager.from_pickle(args.policy)
-        return RulebasedSystem(lexicon, generator, manager, timed)
+        generator = load_generator(args, registry)
+        manager = load_manager(args, registry)
+        system = RulebasedSystem(lexicon, generator, manager, timed)
     elif name == 'hybrid':
         from hybrid_system import HybridSystem
-        templates = Templates.from_pickle(args.templates)
-        manager = PytorchNeuralSystem(args, schema, lexicon, model_path, timed)
-        generator = Generator(templates)
-        return HybridSystem(lexicon, generator, manager, timed)
+        from neural_system import PytorchNeuralSystem
+        manager = PytorchNeuralSystem(args, schema, lexicon, model_path, timed, registry=registry, shared_model=shared_model,
+                rerank=rerank)
+        generator = load_generator(args, registry)
+        system = HybridSystem(lexicon, generator, manager, timed)
     elif name == 'cmd':
         from cmd_system import CmdSystem
-        return CmdSystem()
+        system = CmdSystem()
     elif name == 'pt-neural':
         from neural_system import PytorchNeuralSystem
         assert model_path
-        return PytorchNeuralSystem(args, schema, lexicon, model_path, timed)
+        system = PytorchNeuralSystem(args, schema, lexicon, model_path, timed, registry=registry, shared_model=shared_model,
+                rerank=rerank)
     else:
         raise ValueError('Unknown system %s' % name)
+    print 'Loaded system {} [{:.2f} s]'.format(name, time.time() - start_time)
+    return system
@@ -7,8 +7,10 @@ from cocoa.systems.system import System
 from cocoa.sessions.timed_session import TimedSessionWrapper
 from cocoa.core.util import read_pickle, read_json
 from cocoa.neural.beam import Scorer
+from cocoa.neural.checkpoint import is_inference_checkpoint, convert_checkpoint
 
 from neural.generator import get_generator
+from neural.rerank import get_reranker
 from sessions.neural_session import PytorchNeuralSession
 from neural import model_builder, get_data_generator, make_model_mappings
 from neural.preprocess import markers, TextIntMap, Preprocessor, Dialogue
@@ -22,7 +24,8 @@ class PytorchNeuralSystem(System):
     NeuralSystem loads a neural model from disk and provides a function instantiate a new dialogue agent (NeuralSession
     object) that makes use of this underlying model to send and receive messages in a dialogue.
     """
-    def __init__(self, args, schema, price_tracker, model_path, timed):
+    def __init__(self, args, schema, price_tracker, model_path, timed, registry=None, shared_model=True,
+            rerank=None):
         super(PytorchNeuralSystem, self).__init__()
         self.schema = schema
         self.price_tracker = price_tracker
@@ -34,15 +37,27 @@ class PytorchNeuralSystem(System):
         options.add_data_generator_arguments(dummy_parser)
         dummy_args = dummy_parser.parse_known_args([])[0]
 
-        # Load the model.
-        mappings, model, model_args = model_builder.load_test_model(
-                model_path, args, dummy_args.__dict__)
+        # Load the model. Systems with `shared_model` share it with other
+        # systems loading the same checkpoint in this process.
+        if registry is None or not shared_model or is_inference_checkpoint(model_path):
+            mappings, model, model_args = model_builder.load_test_model(
+                    model_path, args, dummy_args.__dict__, cache=shared_model)
+        else:
+            # Convert the training checkpoint once into the shared cache
+            # The loaded model depends on the device, and load_test_model
+            # checks that it supports the generator
+            mappings, model, model_args = registry.get('model', [model_path],
+                    load=lambda path: model_builder.load_test_model(path, args, dummy_args.__dict__, cache=shared_model),
+                    build=lambda path: convert_checkpoint(model_path, path),
+                    key=(use_gpu(args), args.sample))
         self.model_name = model_args.model
         vocab = mappings['utterance_vocab']
         self.mappings = mappings
 
         generator = get_generator(model, vocab, Scorer(args.alpha), args, model_args)
         builder = UtteranceBuilder(vocab, args.n_best, has_tgt=True)
+        # Options of this system override the --rerank-* options
+        reranker = get_reranker(generator, builder, args, rerank)
 
         preprocessor = Preprocessor(schema, price_tracker, model_args.entity_encoding_form,
                 model_args.entity_decoding_form, model_args.entity_target_form)
@@ -64,12 +79,13 @@ class PytorchNeuralSystem(System):
         Env = namedtuple('Env', ['model', 'vocab', 'preprocessor', 'textint_map',
             'stop_symbol', 'remove_symbols', 'gt_prefix',
             'max_len', 'dialogue_batcher', 'cuda',
-            'dialogue_generator', 'utterance_builder', 'model_args'])
+            'dialogue_generator', 'utterance_builder', 'model_args', 'reranker'])
         self.env = Env(model, vocab, preprocessor, textint_map,
             stop_symbol=vocab.to_ind(markers.EOS), remove_symbols=remove_symbols,
             gt_prefix=1,
             max_len=20, dialogue_batcher=dialogue_batcher, cuda=use_cuda,
-            dialogue_generator=generator, utterance_builder=builder, model_args=model_args)
+            dialogue_generator=generator, utterance_builder=builder, model_args=model_args,
+            reranker=reranker)
 
     @classmethod
     def name(cls):
@@ -86,7 +86,8 @@ def add_systems(args, config_dict, schema, debug=False):
         if info["active"]:
             name = info["type"]
             try:
-                model = get_system(name, args, schema=schema, timed=timed, model_path=info.get('checkpoint'))
+                model = get_system(name, args, schema=schema, timed=timed, model_path=info.get('checkpoint'),
+                        rerank=info.get('rerank'))
             except ValueError:
                 warnings.warn(
                     'Unrecognized model type in {} for configuration '
@@ -40,6 +40,8 @@ cuda = False # use CUDA
 plot_graphs = False # use visdom
 domain = "object_division" # domain for the dialogue
 rnn_ctx_encoder = False # Whether to use RNN for encoding the context
+nprocs = 1 # number of data-parallel training processes
+async_valid = False # validate in a separate process while training continues
 
 # rl settings
 rl_temperature = 0.1
@@ -13,6 +13,8 @@ import sys
 import pdb
 import copy
 import re
+import json
+from array import array
 from collections import OrderedDict
 import logging
 import torch
@@ -91,6 +93,29 @@ class Dictionary(object):
     def __len__(self):
         return len(self.idx2word)
 
+    @staticmethod
+    def from_freqs(token_freqs, freq_cutoff=-1, init_dict=True):
+        """Builds a dictionary of the tokens more frequent than the cutoff,
+        most frequent first.
+
+        `token_freqs` is an OrderedDict of token counts in order of first appearance.
+        """
+        dictionary = Dictionary(init=init_dict)
+        token_freqs = sorted(token_freqs.items(), key=lambda x: x[1], reverse=True)
+        for token, freq in token_freqs:
+            if freq > freq_cutoff:
+                dictionary.add_word(token)
+        return dictionary
+
+    @staticmethod
+    def from_words(words):
+        """Rebuilds a dictionary from its `idx2word` list."""
+        dictionary = Dictionary(init=False)
+        for word in words:
+            dictionary.add_word(word)
+        return dictionary
+
+    @staticmethod
     def read_tag(file_name, tag, freq_cutoff=-1, init_dict=True):
         """Extracts all the values inside the given tag.
 
@@ -103,13 +128,9 @@ class Dictionary(object):
                 tokens = get_tag(tokens, tag)
                 for token in tokens:
                     token_freqs[token] = token_freqs.get(token, 0) + 1
-        dictionary = Dictionary(init=init_dict)
-        token_freqs = sorted(token_freqs.items(), key=lambda x: x[1], reverse=True)
-        for token, freq in token_freqs:
-            if freq > freq_cutoff:
-                dictionary.add_word(token)
-        return dictionary
+        return Dictionary.from_freqs(token_freqs, freq_cutoff, init_dict)
 
+    @staticmethod
     def from_file(file_name, freq_cutoff):
         """Constructs a dictionary from the given file."""
         assert os.path.exists(file_name)
@@ -119,111 +140,298 @@ class Dictionary(object):
         return word_dict, item_dict, context_dict
 
 
+def read_examples(file_name):
+    """Yields (input, dialogue, output) tokens of each line of the file."""
+    assert os.path.exists(file_name), 'file does not exists %s' % file_name
+    with open(file_name, 'r') as f:
+        for line in f:
+            tokens = line.split()
+            yield get_tag(tokens, 'input'), get_tag(tokens, 'dialogue'), get_tag(tokens, 'output')
+
+
+def is_cached(cache_files, source_files):
+    """Checks that the cache files exist and are newer than the source files."""
+    if not all(os.path.exists(f) for f in cache_files):
+        return False
+    return min(os.path.getmtime(f) for f in cache_files) >= \
+        max(os.path.getmtime(f) for f in source_files)
+
+
+class _TokenCounter(object):
+    """Numbers tokens in order of first appearance and counts them."""
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+        self.counts = []
+
+    def add(self, tokens):
+        """Counts the tokens and returns their numbers."""
+        ids = []
+        for token in tokens:
+            i = self.ids.get(token)
+            if i is None:
+                i = self.ids[token] = len(self.tokens)
+                self.tokens.append(token)
+                self.counts.append(0)
+            self.counts[i] += 1
+            ids.append(i)
+        return ids
+
+    def freqs(self):
+        return OrderedDict(zip(self.tokens, self.counts))
+
+    def renumber(self, ids, dictionary):
+        """Maps token numbers to their indices in the dictionary."""
+        table = np.array([dictionary.get_idx(token) for token in self.tokens], dtype=np.int32)
+        return table[ids] if len(table) > 0 else ids
+
+
+class IntDataset(object):
+    """A tokenized dataset stored as int32 arrays.
+
+    Example i has context `inputs[i]`, selection `items[i]` and dialogue
+    `words[offsets[i]:offsets[i + 1]]`. Arrays loaded from the cache are
+    memory-mapped.
+    """
+    FIELDS = ('inputs', 'words', 'offsets', 'items')
+
+    def __init__(self, inputs, words, offsets, items):
+        self.inputs = inputs
+        self.words = words
+        self.offsets = offsets
+        self.items = items
+
+    @staticmethod
+    def from_examples(examples):
+        """Builds a dataset from (input_idxs, word_idxs, item_idxs) tuples."""
+        inputs, words, items, lengths = array('i'), array('i'), array('i'), array('l')
+        for input_idxs, word_idxs, item_idxs in examples:
+            inputs.extend(input_idxs)
+            words.extend(word_idxs)
+            items.extend(item_idxs)
+            lengths.append(len(word_idxs))
+        n = len(lengths)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.frombuffer(lengths, dtype=np.dtype('l')))
+        # contexts and selections have the same length in all examples
+        def to_matrix(a):
+            a = np.frombuffer(a, dtype=np.int32)
+            return a.reshape(n, -1) if n > 0 else a.reshape(0, 0)
+        return IntDataset(to_matrix(inputs), np.frombuffer(words, dtype=np.int32), offsets, to_matrix(items))
+
+    @staticmethod
+    def cache_files(prefix):
+        return ['%s.%s.npy' % (prefix, field) for field in IntDataset.FIELDS]
+
+    @staticmethod
+    def load(prefix):
+        arrays = [np.load(f, mmap_mode='r') for f in IntDataset.cache_files(prefix)]
+        return IntDataset(*arrays)
+
+    def save(self, prefix):
+        for field, file_name in zip(self.FIELDS, self.cache_files(prefix)):
+            # write and rename, so that a partially written file is never loaded
+            tmp_file = file_name[:-len('.npy')] + '.tmp.npy'
+            np.save(tmp_file, getattr(self, field))
+            os.rename(tmp_file, file_name)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return (list(self.inputs[i]), list(self.words[self.offsets[i]:self.offsets[i + 1]]),
+            list(self.items[i]))
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+class BatchIterator(object):
+    """Batches of a dataset. Tensors are built when a batch is accessed.
+
+    Examples are shuffled and then sorted by dialogue length, so that each
+    batch has dialogues of similar lengths.
+    """
+    def __init__(self, dataset, bsz, pad, shuffle=True, device_id=None, rng=random):
+        self.dataset = dataset
+        self.pad = pad
+        self.device_id = device_id
+
+        lengths = dataset.lengths()
+        order = list(range(len(dataset)))
+        if shuffle:
+            rng.shuffle(order)
+        order = np.array(order, dtype=np.int64)
+        # stable sort keeps dialogues of the same length in random order
+        order = order[np.argsort(lengths[order], kind='mergesort')]
+        self.batches = [order[i:i + bsz] for i in range(0, len(order), bsz)]
+        if shuffle:
+            rng.shuffle(self.batches)
+
+        self.stats = {
+            'n': int(sum(len(b) * lengths[b].max() for b in self.batches)),
+            'nonpadn': int(lengths.sum()),
+        }
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, i):
+        return self.make_batch(self.batches[i])
+
+    def __iter__(self):
+        for idx in self.batches:
+            yield self.make_batch(idx)
+
+    def make_batch(self, idx):
+        """Returns (ctx, inpt, tgt, sel_tgt) tensors of the examples `idx`."""
+        dataset = self.dataset
+        starts = dataset.offsets[idx]
+        lengths = dataset.offsets[idx + 1] - starts
+        max_len = lengths.max()
+
+        # pad all the dialogues to match the longest dialogue
+        positions = np.arange(max_len)
+        mask = positions[None, :] < lengths[:, None]
+        words = np.full((len(idx), max_len), self.pad, dtype=np.int64)
+        words[mask] = dataset.words[(starts[:, None] + positions[None, :])[mask]]
+
+        # construct tensors for context, dialogue and selection target
+        ctx = torch.from_numpy(dataset.inputs[idx].astype(np.int64)).t().contiguous()
+        data = torch.from_numpy(words).t().contiguous()
+        sel_tgt = torch.from_numpy(dataset.items[idx].astype(np.int64)).t().contiguous().view(-1)
+        if self.device_id is not None:
+            ctx = ctx.cuda(self.device_id)
+            data = data.cuda(self.device_id)
+            sel_tgt = sel_tgt.cuda(self.device_id)
+
+        # construct tensor for input and target
+        inpt = data.narrow(0, 0, data.size(0) - 1)
+        tgt = data.narrow(0, 1, data.size(0) - 1).view(-1)
+        return ctx, inpt, tgt, sel_tgt
+
+
 class WordCorpus(object):
     """An utility that stores the entire dataset.
 
     It has the train, valid and test datasets and corresponding dictionaries.
+    Dictionaries are built in one pass over the train file, which also
+    tokenizes it. With `cache`, dictionaries and tokenized datasets are saved
+    next to the text files and loaded from there while they are newer than
+    the text files.
     """
 
     def __init__(self, path, freq_cutoff=2, train='train.txt',
-        valid='val.txt', test='test.txt', verbose=False):
+        valid='val.txt', test='test.txt', verbose=False, cache=True):
         self.verbose = verbose
-        # only add words from the train dataset
-        self.word_dict, self.item_dict, self.context_dict = Dictionary.from_file(
-            os.path.join(path, train),
-            freq_cutoff=freq_cutoff)
-
-        # construct all 3 datasets
-        self.train = self.tokenize(os.path.join(path, train)) if train else []
-        self.valid = self.tokenize(os.path.join(path, valid)) if valid else []
-        self.test = self.tokenize(os.path.join(path, test)) if test else []
+        self.cache = cache
+        train_file = os.path.join(path, train)
+        self.cache_name = '%s-%d' % (os.path.splitext(train)[0], freq_cutoff)
+        self.dict_file = '%s.%s.dict.json' % (train_file, self.cache_name)
+
+        if cache and is_cached([self.dict_file] + IntDataset.cache_files(self.cache_prefix(train_file)),
+                [train_file]):
+            self.load_dicts()
+            self.train = IntDataset.load(self.cache_prefix(train_file))
+        else:
+            # only add words from the train dataset
+            self.train = self.build(train_file, freq_cutoff)
+
+        # construct the other datasets
+        self.valid = self.tokenize(os.path.join(path, valid)) if valid else IntDataset.from_examples([])
+        self.test = self.tokenize(os.path.join(path, test)) if test else IntDataset.from_examples([])
 
         # find out the output length from the train dataset
-        self.output_length = max([len(x[2]) for x in self.train])
+        self.output_length = self.train.items.shape[1]
+
+    def cache_prefix(self, file_name):
+        return '%s.%s' % (file_name, self.cache_name)
+
+    def load_dicts(self):
+        with open(self.dict_file, 'r') as f:
+            dicts = json.load(f)
+        self.word_dict = Dictionary.from_words(dicts['word'])
+        self.item_dict = Dictionary.from_words(dicts['item'])
+        self.context_dict = Dictionary.from_words(dicts['context'])
+
+    def save_dicts(self):
+        dicts = {
+            'word': self.word_dict.idx2word,
+            'item': self.item_dict.idx2word,
+            'context': self.context_dict.idx2word,
+        }
+        tmp_file = self.dict_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(dicts, f)
+        os.rename(tmp_file, self.dict_file)
+
+    def build(self, file_name, freq_cutoff):
+        """Builds the dictionaries and the train dataset in one pass over the file.
+
+        Tokens are first numbered in order of appearance, and renumbered when
+        the dictionaries are known.
+        """
+        tags = (_TokenCounter(), _TokenCounter(), _TokenCounter())
+        examples = (tuple(counter.add(tokens) for counter, tokens in zip(tags, example))
+            for example in read_examples(file_name))
+        dataset = IntDataset.from_examples(examples)
+
+        context_tokens, word_tokens, item_tokens = tags
+        self.word_dict = Dictionary.from_freqs(word_tokens.freqs(), freq_cutoff)
+        self.item_dict = Dictionary.from_freqs(item_tokens.freqs(), init_dict=False)
+        self.context_dict = Dictionary.from_freqs(context_tokens.freqs(), init_dict=False)
+        dataset = IntDataset(
+            context_tokens.renumber(dataset.inputs, self.context_dict),
+            word_tokens.renumber(dataset.words, self.word_dict),
+            dataset.offsets,
+            item_tokens.renumber(dataset.items, self.item_dict))
+        self._log_stats(file_name, dataset)
+
+        if self.cache:
+            # datasets are saved after the dictionaries, so they are newer
+            self.save_dicts()
+            dataset.save(self.cache_prefix(file_name))
+        return dataset
 
     def tokenize(self, file_name):
         """Tokenizes the file and produces a dataset."""
-        lines = read_lines(file_name)
-        random.shuffle(lines)
-
-        unk = self.word_dict.get_idx('<unk>')
-        dataset, total, unks = [], 0, 0
-        for line in lines:
-            tokens = line.split()
-            input_idxs = self.context_dict.w2i(get_tag(tokens, 'input'))
-            word_idxs = self.word_dict.w2i(get_tag(tokens, 'dialogue'))
-            item_idxs = self.item_dict.w2i(get_tag(tokens, 'output'))
-            dataset.append((input_idxs, word_idxs, item_idxs))
-            # compute statistics
-            total += len(input_idxs) + len(word_idxs) + len(item_idxs)
-            unks += np.count_nonzero([idx == unk for idx in word_idxs])
+        prefix = self.cache_prefix(file_name)
+        if self.cache and is_cached(IntDataset.cache_files(prefix), [file_name, self.dict_file]):
+            return IntDataset.load(prefix)
+        dataset = IntDataset.from_examples(
+            (self.context_dict.w2i(input_tokens), self.word_dict.w2i(word_tokens), self.item_dict.w2i(item_tokens))
+            for input_tokens, word_tokens, item_tokens in read_examples(file_name))
+        self._log_stats(file_name, dataset)
+        if self.cache:
+            dataset.save(prefix)
+        return dataset
 
+    def _log_stats(self, file_name, dataset):
         if self.verbose:
+            unk = self.word_dict.get_idx('<unk>')
+            total = dataset.inputs.size + dataset.words.size + dataset.items.size
+            unks = np.count_nonzero(dataset.words == unk)
             logging.info('dataset %s, total %d, unks %s, ratio %0.2f%%' % (
-                file_name, total, unks, 100. * unks / total))
-        return dataset
-
-    def train_dataset(self, bsz, shuffle=True, device_id=None):
-        return self._split_into_batches(copy.copy(self.train), bsz,
-            shuffle=shuffle, device_id=device_id)
+                file_name, total, unks, 100. * unks / max(total, 1)))
 
-    def valid_dataset(self, bsz, shuffle=True, device_id=None):
-        return self._split_into_batches(copy.copy(self.valid), bsz,
-            shuffle=shuffle, device_id=device_id)
+    def train_dataset(self, bsz, shuffle=True, device_id=None, rng=random):
+        return self._split_into_batches(self.train, bsz,
+            shuffle=shuffle, device_id=device_id, rng=rng)
 
-    def test_dataset(self, bsz, shuffle=True, device_id=None):
-        return self._split_into_batches(copy.copy(self.test), bsz, shuffle=shuffle,
-            device_id=device_id)
+    def valid_dataset(self, bsz, shuffle=True, device_id=None, rng=random):
+        return self._split_into_batches(self.valid, bsz,
+            shuffle=shuffle, device_id=device_id, rng=rng)
 
-    def _split_into_batches(self, dataset, bsz, shuffle=True, device_id=None):
-        """Splits given dataset into batches."""
-        if shuffle:
-            random.shuffle(dataset)
-
-        # sort and pad
-        dataset.sort(key=lambda x: len(x[1]))
-        pad = self.word_dict.get_idx('<pad>')
-
-        batches = []
-        stats = {
-            'n': 0,
-            'nonpadn': 0
-        }
+    def test_dataset(self, bsz, shuffle=True, device_id=None, rng=random):
+        return self._split_into_batches(self.test, bsz, shuffle=shuffle,
+            device_id=device_id, rng=rng)
 
-        for i in range(0, len(dataset), bsz):
-            # groups contexes, words and items
-            inputs, words, items = [], [], []
-            for j in range(i, min(i + bsz, len(dataset))):
-                inputs.append(dataset[j][0])
-                words.append(dataset[j][1])
-                items.append(dataset[j][2])
-
-            # the longest dialogue in the batch
-            max_len = len(words[-1])
-
-            # pad all the dialogues to match the longest dialogue
-            for j in range(len(words)):
-                stats['n'] += max_len
-                stats['nonpadn'] += len(words[j])
-                words[j] += [pad] * (max_len - len(words[j]))
-
-            # construct tensor for context
-            ctx = torch.LongTensor(inputs).transpose(0, 1).contiguous()
-            data = torch.LongTensor(words).transpose(0, 1).contiguous()
-            # construct tensor for selection target
-            sel_tgt = torch.LongTensor(items).transpose(0, 1).contiguous().view(-1)
-            if device_id is not None:
-                ctx = ctx.cuda(device_id)
-                data = data.cuda(device_id)
-                sel_tgt = sel_tgt.cuda(device_id)
-
-            # construct tensor for input and target
-            inpt = data.narrow(0, 0, data.size(0) - 1)
-            tgt = data.narrow(0, 1, data.size(0) - 1).view(-1)
-
-            batches.append((ctx, inpt, tgt, sel_tgt))
+    def _split_into_batches(self, dataset, bsz, shuffle=True, device_id=None, rng=random):
+        """Splits given dataset into batches.
 
-        if shuffle:
-            random.shuffle(batches)
-
-        return batches, stats
+        Returns a BatchIterator, which builds the tensors of a batch when it
+        is accessed, and padding statistics.
+        """
+        batches = BatchIterator(dataset, bsz, self.word_dict.get_idx('<pad>'),
+            shuffle=shuffle, device_id=device_id, rng=rng)
+        return batches, batches.stats
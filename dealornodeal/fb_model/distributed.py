@@ -0,0 +1,109 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Data-parallel training on local CPU processes with torch.distributed (gloo).
+"""
+
+import multiprocessing
+
+import torch
+import torch.distributed as dist
+
+
+_rank = 0
+_world_size = 1
+
+
+def init_process_group(rank, world_size, init_method, backend='gloo'):
+    """Joins the process group of the training processes."""
+    global _rank, _world_size
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    _rank, _world_size = rank, world_size
+
+
+def get_rank():
+    return _rank
+
+
+def get_world_size():
+    return _world_size
+
+
+def is_master():
+    return _rank == 0
+
+
+def broadcast_parameters(model):
+    """Copies the parameters of the master to all processes."""
+    if _world_size > 1:
+        for param in model.parameters():
+            dist.broadcast(param.data, 0)
+
+
+def all_reduce_sum(values):
+    """Sums a list of numbers over all processes."""
+    if _world_size == 1:
+        return values
+    tensor = torch.DoubleTensor([float(v) for v in values])
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def all_reduce(tensor):
+    """Sums a tensor over all processes in place."""
+    if _world_size > 1:
+        dist.all_reduce(tensor)
+    return tensor
+
+
+def all_reduce_gradients(params, normalization=1.):
+    """Sums the gradients over all processes in one flat buffer and divides
+    them by `normalization`.
+
+    Processes that had no batch in this step contribute zeros.
+    """
+    params = [p for p in params if p.requires_grad]
+    grads = [p.grad.data.view(-1) if p.grad is not None else p.data.new(p.numel()).zero_()
+        for p in params]
+    flat = torch.cat(grads)
+    dist.all_reduce(flat)
+    flat.div_(normalization)
+    offset = 0
+    for p in params:
+        grad = flat[offset:offset + p.numel()].view_as(p.data)
+        if p.grad is None:
+            p.grad = grad.clone()
+        else:
+            p.grad.data.copy_(grad)
+        offset += p.numel()
+
+
+def _run(rank, world_size, init_method, num_threads, fn, args):
+    torch.set_num_threads(num_threads)
+    # same data order on all processes, different dropout masks
+    torch.manual_seed(torch.initial_seed() + rank)
+    init_process_group(rank, world_size, init_method)
+    fn(*args)
+
+
+def launch(fn, world_size, init_method='tcp://127.0.0.1:23457', args=()):
+    """Forks `world_size` processes that each call `fn(*args)`.
+
+    Data loaded before the call (corpus, model) is shared with the forked
+    processes. CPU threads are split evenly between them.
+    """
+    num_threads = max(1, multiprocessing.cpu_count() // world_size)
+    workers = []
+    for rank in range(world_size):
+        worker = multiprocessing.Process(target=_run,
+            args=(rank, world_size, init_method, num_threads, fn, args))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError('Training failed in process(es) %s' % failed)
@@ -15,14 +15,19 @@ import itertools
 import sys
 import copy
 import re
+import os
 import logging
+import threading
 import torch
+import torch.multiprocessing as mp
 from torch import optim
 import torch.nn as nn
 from torch.autograd import Variable
 import numpy as np
 
 from data import STOP_TOKENS
+import distributed
+import utils
 import vis
 
 class Criterion(object):
@@ -40,10 +45,121 @@ class Criterion(object):
         return self.crit(out, tgt)
 
 
+def snapshot(model):
+    """Copies the weights of the model."""
+    return {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+
+class Validator(object):
+    """Runs a validation pass on the model when it is submitted.
+
+    While `keep_best` is set, a snapshot of the weights with the lowest
+    selection loss so far (the first one on ties) is kept in `best`, as
+    (epoch, valid_select_loss, weights).
+    """
+    def __init__(self, engine, N, validdata):
+        self.engine = engine
+        self.N = N
+        self.validset, self.validset_stats = validdata
+        self.finished = []
+        self.keep_best = True
+        self.best = None
+
+    def submit(self, epoch, model):
+        valid_loss, valid_select_loss = self.engine.valid_pass(self.N, self.validset, self.validset_stats)
+        if self.is_best(valid_select_loss):
+            self.best = (epoch, valid_select_loss, snapshot(model))
+        self.finished.append((epoch, valid_loss, valid_select_loss))
+
+    def is_best(self, valid_select_loss):
+        return self.keep_best and (self.best is None or valid_select_loss < self.best[1])
+
+    def results(self, wait=False):
+        """Returns (epoch, valid_loss, valid_select_loss) of the finished
+        validations, in order of submission.
+        """
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+        pass
+
+
+class AsyncValidator(Validator):
+    """Runs validation passes in a separate process on snapshots of the
+    weights, while training continues.
+    """
+    def __init__(self, engine, N, validdata):
+        super(AsyncValidator, self).__init__(engine, N, validdata)
+        self.pending = {}
+        self.requests = mp.Queue()
+        self.responses = mp.Queue()
+        self.process = mp.Process(target=self._run, args=(torch.get_num_threads(),))
+        self.process.daemon = True
+        self.process.start()
+
+    def _run(self, num_threads):
+        torch.set_num_threads(num_threads)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            epoch, weights = request
+            self.engine.model.load_state_dict(weights)
+            valid_loss, valid_select_loss = self.engine.valid_pass(
+                self.N, self.validset, self.validset_stats)
+            self.responses.put((epoch, valid_loss, valid_select_loss))
+
+    def submit(self, epoch, model):
+        # the weights are kept until their validation finishes
+        weights = snapshot(model)
+        self.pending[epoch] = weights
+        self.requests.put((epoch, weights))
+
+    def results(self, wait=False):
+        finished = []
+        while self.pending and (wait or not self.responses.empty()):
+            epoch, valid_loss, valid_select_loss = self.responses.get()
+            weights = self.pending.pop(epoch)
+            if self.is_best(valid_select_loss):
+                self.best = (epoch, valid_select_loss, weights)
+            finished.append((epoch, valid_loss, valid_select_loss))
+        return finished
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join()
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints of the model in a background thread."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.thread = None
+
+    def save(self, model):
+        self.wait()
+        model = copy.deepcopy(model)
+        self.thread = threading.Thread(target=self._write, args=(model,))
+        self.thread.start()
+
+    def _write(self, model):
+        # write and rename, so that the checkpoint is never partially written
+        tmp_file = self.file_name + '.tmp'
+        utils.save_model(model, tmp_file)
+        os.rename(tmp_file, self.file_name)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
 class Engine(object):
     """The training engine.
 
-    Performs training and evaluation.
+    Performs training and evaluation. With `args.nprocs` > 1 it runs in each
+    of the data-parallel training processes (see distributed.launch).
     """
     def __init__(self, model, args, device_id=None, verbose=False):
         self.model = model
@@ -56,6 +172,11 @@ class Engine(object):
         self.crit = Criterion(self.model.word_dict, device_id=device_id)
         self.sel_crit = Criterion(
             self.model.item_dict, device_id=device_id, bad_toks=['<disconnect>', '<disagree>'])
+        self.pad = self.model.word_dict.get_idx('<pad>')
+        self.async_valid = getattr(self.args, 'async_valid', False)
+        checkpoint_file = getattr(self.args, 'checkpoint_file', '')
+        self.checkpointer = AsyncCheckpointer(checkpoint_file) \
+            if checkpoint_file and distributed.is_master() else None
         if self.args.visual:
             self.model_plot = vis.ModulePlot(self.model, plot_weight=False, plot_grad=True)
             self.loss_plot = vis.Plot(['train', 'valid', 'valid_select'],
@@ -63,6 +184,7 @@ class Engine(object):
             self.ppl_plot = vis.Plot(['train', 'valid', 'valid_select'],
                 'perplexity', 'ppl', 'epoch', running_n=1)
 
+    @staticmethod
     def forward(model, batch, requires_grad=False):
         """A helper function to perform a forward pass on a batch."""
 
@@ -93,36 +215,65 @@ class Engine(object):
         return self.model
 
     def train_pass(self, N, trainset):
-        """Training pass."""
+        """Training pass.
+
+        Batches are distributed round-robin over the training processes,
+        which average their gradients before each update.
+        """
         # make the model trainable
         self.model.train()
 
-        total_loss = 0
+        rank, world_size = distributed.get_rank(), distributed.get_world_size()
+        total_loss, num_batches, num_tokens = 0, 0, 0
         start_time = time.time()
 
+        if world_size > 1:
+            self.check_shards(trainset)
+
         # training loop
-        for batch in trainset:
+        num_steps = (len(trainset) + world_size - 1) // world_size
+        for step in range(num_steps):
             self.t += 1
-            # forward pass
-            out, hid, tgt, sel_out, sel_tgt = Engine.forward(self.model, batch, requires_grad=True)
-
-            # compute LM loss and selection loss
-            loss = self.crit(out.view(-1, N), tgt)
-            loss += self.sel_crit(sel_out, sel_tgt) * self.model.args.sel_weight
+            i = step * world_size + rank
             self.opt.zero_grad()
-            # backward step with gradient clipping
-            loss.backward()
+            if i < len(trainset):
+                # forward pass
+                out, hid, tgt, sel_out, sel_tgt = Engine.forward(self.model, trainset[i], requires_grad=True)
+
+                # compute LM loss and selection loss
+                loss = self.crit(out.view(-1, N), tgt)
+                loss += self.sel_crit(sel_out, sel_tgt) * self.model.args.sel_weight
+                loss.backward()
+                total_loss += loss.item()
+                num_batches += 1
+                num_tokens += tgt.ne(self.pad).sum().item()
+            if world_size > 1:
+                # the last step may have fewer batches than processes
+                step_batches = min(world_size, len(trainset) - step * world_size)
+                distributed.all_reduce_gradients(self.model.parameters(), step_batches)
+            # gradient clipping
             torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.clip)
             self.opt.step()
 
             if self.args.visual and self.t % 100 == 0:
                 self.model_plot.update(self.t)
 
-            total_loss += loss.item()
-
-        total_loss /= len(trainset)
+        total_loss, num_batches, num_tokens = distributed.all_reduce_sum([total_loss, num_batches, num_tokens])
+        total_loss /= num_batches
         time_elapsed = time.time() - start_time
-        return total_loss, time_elapsed
+        return total_loss, time_elapsed, num_tokens
+
+    def check_shards(self, trainset):
+        """Checks that the processes train on each example of the epoch
+        exactly once, i.e. that they have the same batches.
+        """
+        rank, world_size = distributed.get_rank(), distributed.get_world_size()
+        counts = torch.zeros(len(trainset.dataset))
+        for i in range(rank, len(trainset), world_size):
+            counts[torch.from_numpy(trainset.batches[i])] += 1
+        distributed.all_reduce(counts)
+        if not counts.eq(1).all():
+            raise RuntimeError('The training processes do not have the same batches')
 
     def train_single(self, N, trainset):
         """A helper function to train on a random batch."""
@@ -154,56 +305,97 @@ class Engine(object):
         # because the latter includes padding
         return valid_loss / validset_stats['nonpadn'], select_loss / len(validset)
 
-    def iter(self, N, epoch, lr, traindata, validdata):
+    def iter(self, N, epoch, lr, traindata):
         """Performs on iteration of the training.
-        Runs one epoch on the training and validation datasets.
+        Runs one epoch on the training dataset and submits the model for
+        validation.
         """
         trainset, _ = traindata
-        validset, validset_stats = validdata
 
-        train_loss, train_time = self.train_pass(N, trainset)
-        valid_loss, valid_select_loss = self.valid_pass(N, validset, validset_stats)
+        train_loss, train_time, num_tokens = self.train_pass(N, trainset)
 
         if self.verbose:
-            logging.info('| epoch %03d | train_loss %.3f | train_ppl %.3f | s/epoch %.2f | lr %0.8f' % (
-                epoch, train_loss, np.exp(train_loss), train_time, lr))
-            logging.info('| epoch %03d | valid_loss %.3f | valid_ppl %.3f' % (
-                epoch, valid_loss, np.exp(valid_loss)))
-            logging.info('| epoch %03d | valid_select_loss %.3f | valid_select_ppl %.3f' % (
-                epoch, valid_select_loss, np.exp(valid_select_loss)))
+            logging.info('| epoch %03d | train_loss %.3f | train_ppl %.3f | s/epoch %.2f | tok/s %.0f | lr %0.8f' % (
+                epoch, train_loss, np.exp(train_loss), train_time, num_tokens / train_time, lr))
 
         if self.args.visual:
             self.loss_plot.update('train', epoch, train_loss)
-            self.loss_plot.update('valid', epoch, valid_loss)
-            self.loss_plot.update('valid_select', epoch, valid_select_loss)
             self.ppl_plot.update('train', epoch, np.exp(train_loss))
-            self.ppl_plot.update('valid', epoch, np.exp(valid_loss))
-            self.ppl_plot.update('valid_select', epoch, np.exp(valid_select_loss))
 
-        return train_loss, valid_loss, valid_select_loss
+        if distributed.is_master():
+            self.validator.submit(epoch, self.model)
+            if self.checkpointer is not None:
+                self.checkpointer.save(self.model)
+
+        return train_loss
+
+    def validation_results(self, wait=False):
+        """Logs and returns the finished validations (see Validator.results)."""
+        if not distributed.is_master():
+            return []
+        results = self.validator.results(wait)
+        for epoch, valid_loss, valid_select_loss in results:
+            if self.verbose:
+                logging.info('| epoch %03d | valid_loss %.3f | valid_ppl %.3f' % (
+                    epoch, valid_loss, np.exp(valid_loss)))
+                logging.info('| epoch %03d | valid_select_loss %.3f | valid_select_ppl %.3f' % (
+                    epoch, valid_select_loss, np.exp(valid_select_loss)))
+
+            if self.args.visual:
+                self.loss_plot.update('valid', epoch, valid_loss)
+                self.loss_plot.update('valid_select', epoch, valid_select_loss)
+                self.ppl_plot.update('valid', epoch, np.exp(valid_loss))
+                self.ppl_plot.update('valid_select', epoch, np.exp(valid_select_loss))
+        return results
+
+    def shuffle_rng(self, epoch):
+        """Random generator that shuffles the training batches of an epoch.
+
+        All the processes must shuffle the same way, whatever else they do
+        with the global random state (which multiprocessing reseeds in each
+        process).
+        """
+        if distributed.get_world_size() == 1:
+            return random
+        return random.Random(self.args.seed + epoch)
 
     def train(self, corpus):
-        """Entry point."""
+        """Entry point.
+
+        Returns the train loss and (on the master) the validation losses of
+        the last epoch.
+        """
         N = len(corpus.word_dict)
-        best_model, best_valid_select_loss = None, 1e20
         lr = self.args.lr
         last_decay_epoch = 0
         self.t = 0
 
-        validdata = corpus.valid_dataset(self.args.bsz, device_id=self.device_id)
-        for epoch in range(1, self.args.max_epoch + 1):
-            traindata = corpus.train_dataset(self.args.bsz, device_id=self.device_id)
-            _, _, valid_select_loss = self.iter(N, epoch, lr, traindata, validdata)
-
-            if valid_select_loss < best_valid_select_loss:
-                best_valid_select_loss = valid_select_loss
-                best_model = copy.deepcopy(self.model)
+        distributed.broadcast_parameters(self.model)
+        if distributed.is_master():
+            validdata = corpus.valid_dataset(self.args.bsz, device_id=self.device_id)
+            validator_ty = AsyncValidator if self.async_valid else Validator
+            self.validator = validator_ty(self, N, validdata)
 
-        if self.verbose:
-            logging.info('| start annealing | best validselectloss %.3f | best validselectppl %.3f' % (
-                best_valid_select_loss, np.exp(best_valid_select_loss)))
+        # validations finish while training goes on
+        results = []
+        for epoch in range(1, self.args.max_epoch + 1):
+            traindata = corpus.train_dataset(self.args.bsz, device_id=self.device_id,
+                rng=self.shuffle_rng(epoch))
+            train_loss = self.iter(N, epoch, lr, traindata)
+            results.extend(self.validation_results())
+        results.extend(self.validation_results(wait=True))
+
+        if distributed.is_master():
+            # the first epoch with the lowest selection loss
+            _, best_valid_select_loss, best_weights = self.validator.best
+            self.validator.keep_best = False
+            self.validator.best = None
+            if self.verbose:
+                logging.info('| start annealing | best validselectloss %.3f | best validselectppl %.3f' % (
+                    best_valid_select_loss, np.exp(best_valid_select_loss)))
+            self.model.load_state_dict(best_weights)
+        distributed.broadcast_parameters(self.model)
 
-        self.model = best_model
         for epoch in range(self.args.max_epoch + 1, 100):
             if epoch - last_decay_epoch >= self.args.decay_every:
                 last_decay_epoch = epoch
@@ -212,8 +404,16 @@ class Engine(object):
                     break
                 self.opt = optim.SGD(self.model.parameters(), lr=lr)
 
-            traindata = corpus.train_dataset(self.args.bsz, device_id=self.device_id)
-            train_loss, valid_loss, valid_select_loss = self.iter(
-                N, epoch, lr, traindata, validdata)
-
+            traindata = corpus.train_dataset(self.args.bsz, device_id=self.device_id,
+                rng=self.shuffle_rng(epoch))
+            train_loss = self.iter(N, epoch, lr, traindata)
+            results.extend(self.validation_results())
+        results.extend(self.validation_results(wait=True))
+
+        valid_loss, valid_select_loss = None, None
+        if distributed.is_master():
+            _, valid_loss, valid_select_loss = results[-1]
+            self.validator.close()
+            if self.checkpointer is not None:
+                self.checkpointer.wait()
         return train_loss, valid_loss, valid_select_loss
@@ -23,6 +23,7 @@ import time
 # local imports
 import config
 import data
+import distributed
 from engine import Engine
 from models.dialog_model import DialogModel
 import utils
@@ -87,6 +88,14 @@ def main():
         help='domain for the dialogue')
     parser.add_argument('--rnn_ctx_encoder', action='store_true', default=config.rnn_ctx_encoder,
         help='whether to use RNN for encoding the context')
+    parser.add_argument('--nprocs', type=int, default=config.nprocs,
+        help='number of data-parallel training processes')
+    parser.add_argument('--dist_init_method', type=str, default='tcp://127.0.0.1:23457',
+        help='address used by the training processes to find each other')
+    parser.add_argument('--async_valid', action='store_true', default=config.async_valid,
+        help='validate in a separate process while training continues')
+    parser.add_argument('--checkpoint_file', type=str, default='',
+        help='path to save a checkpoint after every epoch (in the background)')
     args = parser.parse_args()
 
     device_id = utils.use_cuda(args.cuda)
@@ -104,12 +113,21 @@ def main():
     if device_id is not None:
         model.cuda(device_id)
   
-    engine = Engine(model, args, device_id, verbose=True)
+    if args.nprocs > 1:
+        logging.info("Training model in %d processes" % args.nprocs)
+        distributed.launch(train, args.nprocs, args.dist_init_method, (model, corpus, args, device_id))
+    else:
+        train(model, corpus, args, device_id)
+
+
+def train(model, corpus, args, device_id):
+    """Trains the model; runs in each training process."""
+    engine = Engine(model, args, device_id, verbose=distributed.is_master())
     logging.info("Training model")
     train_loss, valid_loss, select_loss = engine.train(corpus)
-    logging.info('final select_ppl %.3f' % np.exp(select_loss))
-
-    utils.save_model(engine.get_model(), args.model_file)
+    if distributed.is_master():
+        logging.info('final select_ppl %.3f' % np.exp(select_loss))
+        utils.save_model(engine.get_model(), args.model_file)
 
 
 if __name__ == '__main__':
@@ -14,6 +14,7 @@ from torch import cuda
 from cocoa.io.utils import read_json, write_json, read_pickle, write_pickle, create_path
 from cocoa.core.schema import Schema
 from cocoa.neural.trainer import Statistics
+from cocoa.neural import distributed
 from cocoa.neural.utterance import UtteranceBuilder
 import cocoa.options
 
@@ -65,11 +66,12 @@ def build_optim(opt, model, checkpoint):
 def build_trainer(opt, model, mappings, optim):
     train_loss = make_loss(opt, model, mappings)
     valid_loss = make_loss(opt, model, mappings)
-    trainer = Trainer(model, train_loss, valid_loss, optim)
+    trainer = Trainer(model, train_loss, valid_loss, optim,
+            norm_method=opt.normalization, grad_accum_count=opt.grad_accum_count)
     return trainer
 
 def make_loss(opt, model, mappings):
-    loss = SimpleLossCompute(model.generator, mappings['tgt_vocab'])
+    loss = SimpleLossCompute(model.generator, mappings['tgt_vocab'], shard_size=opt.shard_size)
     if use_gpu(opt):
         loss.cuda()
     return loss
@@ -95,6 +97,29 @@ def report_func(opt, epoch, batch, num_batches, start_time, report_stats):
 
     return report_stats
 
+def train(args, model_args, data_generator):
+    mappings = data_generator.mappings
+
+    # TODO: load from checkpoint
+    ckpt = None
+
+    # Build the model
+    model = build_model(model_args, args, mappings, ckpt)
+    tally_parameters(model)
+    create_path(args.model_path)
+    config_path = os.path.join(args.model_path, 'config.json')
+    write_json(vars(args), config_path)
+
+    builder = UtteranceBuilder(mappings['tgt_vocab'], 1, has_tgt=True)
+
+    # Build optimizer and trainer
+    optim = build_optim(args, model, ckpt)
+    # vocab is used to make_loss, so use target vocab
+    trainer = build_trainer(args, model, mappings, optim)
+    trainer.builder = builder
+    # Perform actual training
+    trainer.learn(args, data_generator, report_func)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--random-seed', help='Random seed', type=int, default=1)
@@ -135,22 +160,8 @@ if __name__ == '__main__':
     #        data_generator.dialogue_batcher.print_batch(batch, i, data_generator.textint_map)
     #        import sys; sys.exit()
 
-    # TODO: load from checkpoint
-    ckpt = None
-
-    # Build the model
-    model = build_model(model_args, args, mappings, ckpt)
-    tally_parameters(model)
-    create_path(args.model_path)
-    config_path = os.path.join(args.model_path, 'config.json')
-    write_json(vars(args), config_path)
-
-    builder = UtteranceBuilder(mappings['tgt_vocab'], 1, has_tgt=True)
-
-    # Build optimizer and trainer
-    optim = build_optim(args, model, ckpt)
-    # vocab is used to make_loss, so use target vocab
-    trainer = build_trainer(args, model, mappings, optim)
-    trainer.builder = builder
-    # Perform actual training
-    trainer.learn(args, data_generator, report_func)
+    if args.world_size > 1:
+        distributed.launch(train, args.world_size, args.dist_init_method,
+                args=(args, model_args, data_generator))
+    else:
+        train(args, model_args, data_generator)
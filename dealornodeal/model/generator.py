@@ -7,18 +7,20 @@ from core.tokenizer import detokenize
 from parser import Parser
 
 class Generator(BaseGenerator):
+    filter_columns = ('proposal_type', 'tag', 'context_tag')
+
     def get_filter(self, used_templates=None, proposal_type=None, context_tag=None, tag=None, **kwargs):
         print 'filter:', proposal_type, context_tag, tag
         locs = [super(Generator, self).get_filter(used_templates)]
         if proposal_type:
-            self._add_filter(locs, self.templates.proposal_type == proposal_type)
+            self._add_filter(locs, self.index.mask('proposal_type', proposal_type))
             # proposal_type must be satisfied
-            if np.sum(locs[-1]) == 0:
+            if not locs[-1].any():
                 return None
         if tag:
-            self._add_filter(locs, self.templates.tag == tag)
+            self._add_filter(locs, self.index.mask('tag', tag))
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
+            self._add_filter(locs, self.index.mask('context_tag', context_tag))
         return self._select_filter(locs)
 
 class Templates(BaseTemplates):
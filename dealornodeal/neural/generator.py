@@ -35,6 +35,8 @@ class Sampler(BaseSampler):
         #print 'decoder inputs:', map(self.vocab.to_word, inp.data[:, 0])
         decoder_outputs, dec_states, _ = self.model.decoder(
             inp, memory_banks, enc_final, memory_lengths=lengths)
+        decoder_outputs = decoder_outputs.squeeze(0)  # (batch_size, rnn_size)
+        memory = self.model.decoder.init_decoder_memory(memory_banks, lengths)
 
         # (2) Sampling
         batch_size = batch.size
@@ -42,20 +44,15 @@ class Sampler(BaseSampler):
         item_id = 0
         for i in xrange(self.max_length):
             # Outputs to probs
-            decoder_outputs = decoder_outputs.squeeze(0)  # (batch_size, rnn_size)
             out = self.model.generator.forward(decoder_outputs).data  # Logprob (batch_size, vocab_size)
-            # Sample with temperature
-            scores = out.div(self.temperature)
-
-            scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
-            pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
+            pred = self.sample(out)
             preds.append(pred)
             if pred[0] == self.eos:
                 break
             # Forward step
             inp = Variable(pred.view(1, -1))  # (seq_len=1, batch_size)
-            decoder_outputs, dec_states, _ = self.model.decoder(
-                inp, memory_banks, dec_states, memory_lengths=lengths)
+            decoder_outputs, dec_states, _ = self.model.decoder.decode_step(
+                inp, memory, dec_states)
 
         # (4) Wrap up predictions for viewing later
         preds = torch.stack(preds).t()  # (batch_size, seq_len)
@@ -75,8 +72,10 @@ class Sampler(BaseSampler):
 
 class LFSampler(Sampler):
     def __init__(self, model, vocab,
-                 temperature=1, max_length=100, cuda=False):
-        super(LFSampler, self).__init__(model, vocab, temperature=temperature, max_length=max_length, cuda=cuda)
+                 temperature=1, max_length=100, cuda=False,
+                 top_k=0, top_p=1.):
+        super(LFSampler, self).__init__(model, vocab, temperature=temperature, max_length=max_length, cuda=cuda,
+                top_k=top_k, top_p=top_p)
         self.eos = self.vocab.to_ind(markers.EOS)
         self.count_actions = map(self.vocab.to_ind, ('insist', 'propose', markers.SELECT))
         counts = [w for w in self.vocab.word_to_ind if '=' in w]
@@ -109,6 +108,8 @@ class LFSampler(Sampler):
         inp = batch.decoder_inputs[:gt_prefix]
         decoder_outputs, dec_states, _ = self.model.decoder(
             inp, memory_banks, enc_final, memory_lengths=lengths)
+        decoder_outputs = decoder_outputs.squeeze(0)  # (batch_size, rnn_size)
+        memory = self.model.decoder.init_decoder_memory(memory_banks, lengths)
 
         # (2) Sampling
         batch_size = batch.size
@@ -116,14 +117,10 @@ class LFSampler(Sampler):
         item_id = 0
         for i in xrange(self.max_length):
             # Outputs to probs
-            decoder_outputs = decoder_outputs.squeeze(0)  # (batch_size, rnn_size)
             out = self.model.generator.forward(decoder_outputs).data  # Logprob (batch_size, vocab_size)
-            # Sample with temperature
-            scores = out.div(self.temperature)
-
             # Masking to ensure valid LF
             # NOTE: batch size must be 1. TODO: relax this restriction
-            mask = torch.zeros(scores.size())
+            mask = torch.zeros(out.size())
             if i > 0:
                 if pred[0] in self.count_actions:
                     item_id = 0
@@ -145,17 +142,17 @@ class LFSampler(Sampler):
                     mask[:, self.select] = 1
                 else:
                     mask[:, self.actions] = 1
-            scores[mask == 0] = -1e10
+            # 0 for allowed tokens, -1e10 for the others
+            mask.sub_(1).mul_(1e10)
 
-            scores.sub_(scores.max(1, keepdim=True)[0].expand(scores.size(0), scores.size(1)))
-            pred = torch.multinomial(scores.exp(), 1).squeeze(1)  # (batch_size,)
+            pred = self.sample(out, mask=mask)
             preds.append(pred)
             if pred[0] == self.eos:
                 break
             # Forward step
             inp = Variable(pred.view(1, -1))  # (seq_len=1, batch_size)
-            decoder_outputs, dec_states, _ = self.model.decoder(
-                inp, memory_banks, dec_states, memory_lengths=lengths)
+            decoder_outputs, dec_states, _ = self.model.decoder.decode_step(
+                inp, memory, dec_states)
 
         # (4) Wrap up predictions for viewing later
         preds = torch.stack(preds).t()  # (batch_size, seq_len)
@@ -181,11 +178,13 @@ def get_generator(model, vocab, scorer, args, model_args):
         if model_args.model == 'lf2lf':
             generator = LFSampler(model, vocab, args.temperature,
                                 max_length=args.max_length,
-                                cuda=use_gpu(args))
+                                cuda=use_gpu(args),
+                                top_k=args.top_k, top_p=args.top_p)
         else:
             generator = Sampler(model, vocab, args.temperature,
                                 max_length=args.max_length,
-                                cuda=use_gpu(args))
+                                cuda=use_gpu(args),
+                                top_k=args.top_k, top_p=args.top_p)
     else:
         raise ValueError('Beam search not available yet.')
     return generator
@@ -15,6 +15,7 @@ from cocoa.neural.models import MeanEncoder, StdRNNEncoder, StdRNNDecoder, \
 from models import NegotiationModel
 
 from cocoa.io.utils import read_pickle
+from cocoa.neural.checkpoint import load_checkpoint, share_weights, quantize_dynamic, freeze, ModelCache
 from onmt.Utils import use_gpu
 
 from symbols import markers
@@ -136,20 +137,38 @@ def make_decoder(opt, embeddings, tgt_dict):
                              embeddings=embeddings,
                              pad=pad)
 
-def load_test_model(model_path, opt, dummy_opt):
-    checkpoint = torch.load(model_path, map_location=lambda storage, loc: storage)
+def load_test_model(model_path, opt, dummy_opt, cache=True):
+    """Load a model for inference from a training checkpoint (.pt) or an
+    inference checkpoint (see cocoa.neural.checkpoint).
 
+    With `cache`, the model is loaded once per process and shared (read-only)
+    by all callers; use cache=False for a model that will be trained.
+    """
+    gpu = use_gpu(opt)
+    load = lambda: build_test_model(load_checkpoint(model_path), gpu, dummy_opt, read_only=cache)
+    if cache:
+        return ModelCache.get(model_path, load, gpu)
+    return load()
+
+def build_test_model(checkpoint, gpu, dummy_opt, read_only=True):
     model_opt = checkpoint['opt']
     for arg in dummy_opt:
         if arg not in model_opt:
             model_opt.__dict__[arg] = dummy_opt[arg]
 
-    mappings = read_pickle('{}/vocab.pkl'.format(model_opt.mappings))
-    mappings = make_model_mappings(model_opt.model, mappings)
+    mappings = make_model_mappings(model_opt.model, checkpoint['vocab'])
 
-    model = make_base_model(model_opt, mappings, use_gpu(opt), checkpoint)
+    model = make_base_model(model_opt, mappings, gpu, checkpoint)
     model.eval()
     model.generator.eval()
+    if not gpu:
+        share_weights(model, checkpoint)
+    if getattr(model_opt, 'quantize', False):
+        if gpu:
+            raise ValueError('Quantized models run on CPU only')
+        quantize_dynamic(model)
+    if read_only:
+        freeze(model)
     return mappings, model, model_opt
 
 
@@ -15,6 +15,8 @@ from cocoa.core.util import read_pickle, write_pickle, read_json
 from cocoa.core.entity import Entity, CanonicalEntity, is_entity
 from cocoa.lib.bleu import compute_bleu
 from cocoa.model.vocab import Vocabulary
+from cocoa.neural.prefetch import BatchPrefetcher
+from cocoa.neural.batching import dialogue_shape, bucket_dialogues, padding_ratio, shuffled_order
 
 from core.tokenizer import tokenize
 from batcher import DialogueBatcherFactory, Batch
@@ -339,15 +341,20 @@ class DataGenerator(object):
     def __init__(self, train_examples, dev_examples, test_examples, preprocessor,
             args, schema, mappings_path=None, cache='.cache',
             ignore_cache=False, num_context=1, batch_size=1,
-            model='seq2seq'):
+            model='seq2seq', batch_tokens=0):
         examples = {'train': train_examples, 'dev': dev_examples, 'test': test_examples}
         self.num_examples = {k: len(v) if v else 0 for k, v in examples.iteritems()}
         self.num_context = num_context
         self.model = model
+        self.batch_tokens = batch_tokens
+        # Batches are shuffled by a seed derived from this and the epoch
+        self.shuffle_seed = random.randint(0, 2**31)
 
         self.cache = cache
         self.ignore_cache = ignore_cache
-        if (not os.path.exists(cache)) or ignore_cache:
+        self.batch_size = batch_size
+        cache_files = [self._cache_file(k) for k, v in examples.iteritems() if v]
+        if ignore_cache or not all(os.path.exists(f) for f in cache_files):
             # NOTE: each dialogue is made into two examples from each agent's perspective
             self.dialogues = {k: preprocessor.preprocess(v)  for k, v in examples.iteritems() if v}
 
@@ -373,6 +380,10 @@ class DataGenerator(object):
                 mappings=self.mappings, num_context=num_context)
 
         self.batches = {k: self.create_batches(k, dialogues, batch_size, args.verbose) for k, dialogues in self.dialogues.iteritems()}
+        self.padding = {k: padding_ratio(batches,
+                self.mappings['utterance_vocab'].to_ind(markers.PAD),
+                self.mappings['tgt_vocab'].to_ind(markers.PAD))
+            for k, batches in self.batches.iteritems()}
 
     def load_mappings(self, model_type, mappings_path, schema, preprocessor):
         vocab_path = os.path.join(mappings_path, 'vocab.pkl')
@@ -403,26 +414,22 @@ class DataGenerator(object):
         return DialogueBatcher(dialogues).create_batch()
 
     def dialogue_sort_score(self, d):
-        # Sort dialogues by number o turns
-        return len(d.turns[0])
+        # Sort dialogues by number of turns, then by the longest turn
+        return dialogue_shape(d)
 
     def create_dialogue_batches(self, dialogues, batch_size):
-        dialogue_batches = []
-        dialogues.sort(key=lambda d: self.dialogue_sort_score(d))
-        N = len(dialogues)
-        start = 0
-        while start < N:
-            # NOTE: last batch may have a smaller size if we don't have enough examples
-            end = min(start + batch_size, N)
-            dialogue_batch = dialogues[start:end]
-            dialogue_batches.append(self.dialogue_batcher.create_batch(dialogue_batch))
-            start = end
-        return dialogue_batches
+        groups = bucket_dialogues(dialogues, batch_size, self.batch_tokens, shape=self.dialogue_sort_score)
+        return [self.dialogue_batcher.create_batch(dialogue_batch) for dialogue_batch in groups]
+
+    def _cache_file(self, name):
+        # Batches depend on the batching parameters
+        return os.path.join(self.cache, '%s_batches_size%d_tokens%d.pkl' % (
+            name, self.batch_size, self.batch_tokens))
 
     def create_batches(self, name, dialogues, batch_size, verbose):
         if not os.path.isdir(self.cache):
             os.makedirs(self.cache)
-        cache_file = os.path.join(self.cache, '%s_batches.pkl' % name)
+        cache_file = self._cache_file(name)
         if (not os.path.exists(cache_file)) or self.ignore_cache:
             random.shuffle(dialogues)
             for dialogue in dialogues:
@@ -441,12 +448,34 @@ class DataGenerator(object):
                 print '[%d s]' % (time.time() - start_time)
         return dialogue_batches
 
-    def generator(self, name, shuffle=True, cuda=True):
+    def generator(self, name, shuffle=True, cuda=True, prefetch=0, epoch=None,
+            rank=0, world_size=1):
+        '''
+        Yield the number of batches, then batches of each dialogue followed by
+        None. If `prefetch` > 0, up to `prefetch` batches are built ahead of
+        time in a background thread. If `epoch` is given, the shuffled order
+        is the same whenever the same epoch is requested. For distributed
+        training, only every `world_size`-th dialogue starting from `rank` is
+        used.
+        '''
+        batches = self.batch_iter(name, shuffle=shuffle, cuda=cuda, epoch=epoch,
+                rank=rank, world_size=world_size)
+        if prefetch > 0:
+            return BatchPrefetcher(batches, prefetch)
+        return batches
+
+    def batch_iter(self, name, shuffle=True, cuda=True, epoch=None, rank=0, world_size=1):
         dialogue_batches = self.batches[name]
-        yield sum([len(b) for b in dialogue_batches])
-        inds = range(len(dialogue_batches))
         if shuffle:
-            random.shuffle(inds)
+            seed = None if epoch is None else (self.shuffle_seed, epoch)
+            inds = shuffled_order(len(dialogue_batches), seed)
+        else:
+            inds = range(len(dialogue_batches))
+        inds = inds[rank::world_size]
+        num_batches = sum([len(dialogue_batches[i]) for i in inds])
+        if rank == 0:
+            print '%s: %d batches, %.1f%% padding' % (name, num_batches, self.padding[name] * 100)
+        yield num_batches
         for ind in inds:
             for batch in dialogue_batches[ind]:
                 yield Batch(batch['encoder_args'],
@@ -63,30 +63,3 @@ class Trainer(BaseTrainer):
                 lengths, dec_state, enc_state)
 
         return outputs, attns, dec_state
-
-    def _gradient_accumulation(self, true_batchs, total_stats, report_stats):
-        if self.grad_accum_count > 1:
-            self.model.zero_grad()
-
-        dec_state = None
-        for batch in true_batchs:
-            if batch is None:
-                dec_state = None
-                continue
-            elif not self.model.stateful:
-                dec_state = None
-            enc_state = dec_state.hidden if dec_state is not None else None
-
-            outputs, attns, dec_state = self._run_batch(batch, None, enc_state)
-            loss, batch_stats = self.train_loss.compute_loss(batch.targets, outputs)
-
-            self.model.zero_grad()
-            loss.backward()
-            self.optim.step()
-
-            total_stats.update(batch_stats)
-            report_stats.update(batch_stats)
-
-            # Don't backprop fully.
-            if dec_state is not None:
-                dec_state.detach()
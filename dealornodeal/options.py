@@ -8,6 +8,7 @@ def add_preprocess_arguments(parser):
     parser.add_argument('--entity-target-form', choices=['canonical', 'type'], default='canonical', help='Output entity form to the decoder')
     parser.add_argument('--cache', default='.cache', help='Path to cache for preprocessed batches')
     parser.add_argument('--ignore-cache', action='store_true', help='Ignore existing cache')
+    parser.add_argument('--batch-tokens', type=int, default=0, help='Maximum padded tokens (dialogues x turns x turn length) per batch; 0 to batch by --batch-size only. Batches are cached per --batch-size and --batch-tokens')
     parser.add_argument('--mappings', help='Path to vocab mappings')
 
 def add_data_generator_arguments(parser):
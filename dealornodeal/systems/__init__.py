@@ -7,7 +7,12 @@ from cmd_system import CmdSystem
 from neural_system import FBNeuralSystem, PytorchNeuralSystem
 from hybrid_system import HybridSystem
 
-def get_system(name, args, schema=None, timed=False, model_path=None):
+def get_system(name, args, schema=None, timed=False, model_path=None, shared_model=True):
+    """Load the system `name`.
+
+    Neural systems share their model with other systems loading the same
+    checkpoint, unless `shared_model` is False (e.g. the model is trained).
+    """
     lexicon = Lexicon(schema.values['item'])
     if name == 'rulebased':
         templates = Templates.from_pickle(args.templates)
@@ -17,7 +22,7 @@ def get_system(name, args, schema=None, timed=False, model_path=None):
     elif name == 'hybrid':
         assert model_path
         templates = Templates.from_pickle(args.templates)
-        manager = PytorchNeuralSystem(args, schema, lexicon, model_path, timed)
+        manager = PytorchNeuralSystem(args, schema, lexicon, model_path, timed, shared_model=shared_model)
         generator = Generator(templates)
         return HybridSystem(lexicon, generator, manager, timed)
     elif name == 'cmd':
@@ -27,6 +32,6 @@ def get_system(name, args, schema=None, timed=False, model_path=None):
         return FBNeuralSystem(model_path, args.temperature, timed_session=timed, gpu=False)
     elif name == 'pt-neural':
         assert model_path
-        return PytorchNeuralSystem(args, schema, lexicon, model_path, timed)
+        return PytorchNeuralSystem(args, schema, lexicon, model_path, timed, shared_model=shared_model)
     else:
         raise ValueError('Unknown system %s' % name)
@@ -41,7 +41,7 @@ class FBNeuralSystem(System):
         return session
 
 class PytorchNeuralSystem(System):
-    def __init__(self, args, schema, lexicon, model_path, timed):
+    def __init__(self, args, schema, lexicon, model_path, timed, shared_model=True):
         super(PytorchNeuralSystem, self).__init__()
         self.schema = schema
         self.lexicon = lexicon
@@ -53,9 +53,10 @@ class PytorchNeuralSystem(System):
         options.add_data_generator_arguments(dummy_parser)
         dummy_args = dummy_parser.parse_known_args([])[0]
 
-        # Load the model.
+        # Load the model. Systems with `shared_model` share it with other
+        # systems loading the same checkpoint in this process.
         mappings, model, model_args = model_builder.load_test_model(
-                model_path, args, dummy_args.__dict__)
+                model_path, args, dummy_args.__dict__, cache=shared_model)
         logstats.add_args('model_args', model_args)
         self.model_name = model_args.model
         utterance_vocab = mappings['utterance_vocab']
@@ -4,19 +4,21 @@ from cocoa.model.generator import Templates as BaseTemplates, Generator as BaseG
 from core.tokenizer import detokenize
 
 class Generator(BaseGenerator):
+    filter_columns = ('signature', 'tag', 'context_tag')
+
     def get_filter(self, used_templates=None, signature=None, context_tag=None, tag=None, **kwargs):
         locs = [super(Generator, self).get_filter(used_templates)]
         if signature:
-            self._add_filter(locs, self.templates.signature == signature)
+            self._add_filter(locs, self.index.mask('signature', signature))
             # signature must be satisfied
-            if np.sum(locs[-1]) == 0:
+            if not locs[-1].any():
                 print 'no signature=', signature
                 return None
         if tag:
             print 'tag=', tag
-            self._add_filter(locs, self.templates.tag == tag)
+            self._add_filter(locs, self.index.mask('tag', tag))
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
+            self._add_filter(locs, self.index.mask('context_tag', context_tag))
         return self._select_filter(locs)
 
 class Templates(BaseTemplates):
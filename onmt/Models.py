@@ -1,4 +1,5 @@
 from __future__ import division
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -8,7 +9,7 @@ from torch.nn.utils.rnn import pack_padded_sequence as pack
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 
 import onmt
-from onmt.Utils import aeq
+from onmt.Utils import aeq, padding_mask, select_rows, cat_rows
 
 
 def rnn_factory(rnn_type, **kwargs):
@@ -603,6 +604,8 @@ class DecoderState(object):
     input_feeding and non-recurrent models.
 
     Modules need to implement this to utilize beam search decoding.
+    States that can be concatenated (rows of several batches decoded
+    together) also implement a static `cat(states)`.
     """
     def detach(self):
         for h in self._all:
@@ -617,6 +620,68 @@ class DecoderState(object):
                 sent_states.data.index_select(1, positions))
 
 
+class DecoderMemory(object):
+    """The memory banks of a batch, prepared once for step-wise decoding
+    (see `init_decoder_memory` and `decode_step` of the decoders).
+
+    Args:
+        banks: batch-first memory bank(s) `[batch x src_len x dim]`
+        lengths (`LongTensor`): the source lengths `[batch]`
+        keys: attention keys (and values) of the banks precomputed by the
+            decoder, or None
+        pad_mask (`ByteTensor`): 1 at padding `[batch x src_len]`, or None
+    """
+    def __init__(self, banks, lengths=None, keys=None, pad_mask=None):
+        self.banks = banks
+        self.lengths = lengths
+        self.keys = keys
+        self.pad_mask = pad_mask
+
+    def index_select(self, index):
+        """The memory of the rows `index` (`LongTensor`) of the batch."""
+        return DecoderMemory(select_rows(self.banks, index),
+                             select_rows(self.lengths, index),
+                             select_rows(self.keys, index),
+                             select_rows(self.pad_mask, index))
+
+    @staticmethod
+    def cat(memories):
+        """The memory of the rows of `memories` in one batch. Banks of
+        different lengths are padded, and their padding masked: the padding
+        mask of each bank (a list for several banks) is built from the
+        lengths for the first bank, and is empty for the others."""
+        src_lens = set(tuple(bank.size(1) for bank in _banks(m.banks))
+                       for m in memories)
+        pad_masks = [m.pad_mask for m in memories]
+        if len(src_lens) > 1 or any(mask is not None for mask in pad_masks):
+            pad_masks = [m._pad_masks() for m in memories]
+        return DecoderMemory(cat_rows([m.banks for m in memories], pad_dim=1),
+                             cat_rows([m.lengths for m in memories]),
+                             cat_rows([m.keys for m in memories], pad_dim=1),
+                             cat_rows(pad_masks, pad_dim=1, pad_value=1))
+
+    def _pad_masks(self):
+        """The padding mask, with the masks of the banks that have none."""
+        banks = _banks(self.banks)
+        masks = self.pad_mask
+        if not isinstance(self.banks, list):
+            masks = [masks]
+        masks = list(masks or [None] * len(banks))
+        for k, bank in enumerate(banks):
+            if masks[k] is not None:
+                continue
+            if k == 0 and self.lengths is not None:
+                masks[k] = padding_mask(self.lengths, bank.size(1))
+            else:
+                # A comparison, so that the mask has the type of padding_mask
+                masks[k] = bank.data.new(bank.size(0), bank.size(1)).zero_().ne(0)
+        return masks if isinstance(self.banks, list) else masks[0]
+
+
+def _banks(banks):
+    return banks if isinstance(banks, list) else [banks]
+
+
 class RNNDecoderState(DecoderState):
     def __init__(self, hidden_size, rnnstate):
         """
@@ -655,3 +720,21 @@ class RNNDecoderState(DecoderState):
                 for e in self._all]
         self.hidden = tuple(vars[:-1])
         self.input_feed = vars[-1]
+
+    def index_select(self, index):
+        """ The state of the rows `index` of the batch. """
+        state = copy.copy(self)
+        state.update_state(select_rows(self.hidden, index, 1),
+                           select_rows(self.input_feed, index, 1),
+                           select_rows(self.coverage, index, 1))
+        return state
+
+    @staticmethod
+    def cat(states):
+        """ The state of the rows of `states` in one batch. """
+        state = copy.copy(states[0])
+        state.update_state(cat_rows([s.hidden for s in states], 1),
+                           cat_rows([s.input_feed for s in states], 1),
+                           cat_rows([s.coverage for s in states], 1,
+                                    pad_dim=2))
+        return state
@@ -1,4 +1,5 @@
 import torch
+from torch.autograd import Variable
 
 
 def aeq(*args):
@@ -23,6 +24,90 @@ def sequence_mask(lengths, max_len=None):
             .lt(lengths.unsqueeze(1)))
 
 
+def padding_mask(lengths, max_len=None):
+    """
+    Creates a mask that is 1 at the padding of sequences of `lengths`
+    `[batch x max_len]`: the complement of `sequence_mask`.
+    """
+    batch_size = lengths.numel()
+    max_len = max_len or lengths.max()
+    return (torch.arange(0, max_len)
+            .type_as(lengths)
+            .unsqueeze(0)
+            .expand(batch_size, max_len)
+            .ge(lengths.unsqueeze(1).expand(batch_size, max_len)))
+
+
+class MaskCache(object):
+    """
+    The padding mask of the last lengths seen. Attention is called with the
+    same memory lengths at every decoding step (and for every bank of a
+    batch), so the mask is built once for them.
+    """
+    def __init__(self):
+        self.key = None
+        self.mask = None
+
+    def get(self, lengths, max_len=None):
+        data = lengths.data if isinstance(lengths, Variable) else lengths
+        key = (data.data_ptr(), data.size(), data.stride(), max_len)
+        if key != self.key:
+            # Keep the lengths so that their memory is not reused while cached
+            self.key, self.lengths = key, lengths
+            self.mask = padding_mask(data, max_len)
+        return self.mask
+
+
+def select_rows(values, index, dim=0):
+    """
+    Select the entries `index` (`LongTensor`) along `dim` of a tensor or
+    Variable, or of each one in a (nested) list, tuple or dict of them.
+    None is kept as is.
+    """
+    if values is None:
+        return None
+    if isinstance(values, (list, tuple)):
+        return type(values)(select_rows(v, index, dim) for v in values)
+    if isinstance(values, dict):
+        return {k: select_rows(v, index, dim) for k, v in values.iteritems()}
+    if isinstance(values, Variable):
+        index = Variable(index)
+    return values.index_select(dim, index)
+
+
+def _pad(value, dim, size, pad_value):
+    if value.size(dim) == size:
+        return value
+    pad_size = list(value.size())
+    pad_size[dim] = size - value.size(dim)
+    data = value.data if isinstance(value, Variable) else value
+    padding = data.new(*pad_size).fill_(pad_value)
+    if isinstance(value, Variable):
+        padding = Variable(padding)
+    return torch.cat([value, padding], dim)
+
+
+def cat_rows(values, dim=0, pad_dim=None, pad_value=0):
+    """
+    Concatenate along `dim` a list of tensors or Variables, or of (nested)
+    lists, tuples or dicts of them with the same structure. With `pad_dim`,
+    they are first padded with `pad_value` to the same size along it.
+    """
+    first = values[0]
+    if first is None:
+        return None
+    if isinstance(first, (list, tuple)):
+        return type(first)(cat_rows(list(v), dim, pad_dim, pad_value)
+                           for v in zip(*values))
+    if isinstance(first, dict):
+        return {k: cat_rows([v[k] for v in values], dim, pad_dim, pad_value)
+                for k in first}
+    if pad_dim is not None:
+        size = max(v.size(pad_dim) for v in values)
+        values = [_pad(v, pad_dim, size, pad_value) for v in values]
+    return torch.cat(values, dim)
+
+
 def use_gpu(opt):
     return (hasattr(opt, 'gpuid') and len(opt.gpuid) > 0) or \
         (hasattr(opt, 'gpu') and opt.gpu > -1)
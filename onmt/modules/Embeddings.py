@@ -30,11 +30,12 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, emb):
+    def forward(self, emb, step=0):
+        """`emb` holds the positions from `step` on."""
         # We must wrap the self.pe in Variable to compute, not the other
         # way - unwrap emb(i.e. emb.data). Otherwise the computation
         # wouldn't be watched to build the compute graph.
-        emb = emb + Variable(self.pe[:emb.size(0), :1, :emb.size(2)]
+        emb = emb + Variable(self.pe[step:step + emb.size(0), :1, :emb.size(2)]
                              .expand_as(emb), requires_grad=False)
         emb = self.dropout(emb)
         return emb
@@ -123,18 +124,25 @@ class Embeddings(nn.Module):
             if fixed:
                 self.word_lut.weight.requires_grad = False
 
-    def forward(self, input):
+    def forward(self, input, step=0):
         """
         Computes the embeddings for words and features.
 
         Args:
             input (`LongTensor`): index tensor `[len x batch x nfeat]`
+            step (int): position of the first token, for the positional
+                encoding (step-wise decoding)
         Return:
             `FloatTensor`: word embeddings `[len x batch x embedding_size]`
         """
         in_length, in_batch = input.size()
 
-        emb = self.make_embedding(input)
+        if step == 0:
+            emb = self.make_embedding(input)
+        else:
+            emb = self.make_embedding.wordvec(input)
+            if hasattr(self.make_embedding, 'pe'):
+                emb = self.make_embedding.pe(emb, step)
 
         out_length, out_batch, emb_size = emb.size()
         aeq(in_length, out_length)
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 
 from onmt.modules.UtilClass import BottleLinear
-from onmt.Utils import aeq, sequence_mask
+from onmt.Utils import aeq, MaskCache
 
 
 class GlobalAttention(nn.Module):
@@ -63,11 +63,25 @@ class GlobalAttention(nn.Module):
         if coverage:
             self.linear_cover = nn.Linear(1, dim, bias=False)
 
-    def score(self, h_t, h_s):
+        self.mask_cache = MaskCache()
+
+    def memory_keys(self, memory_bank):
+        """The part of the scores of `memory_bank` `[batch x src_len x dim]`
+        that does not depend on the query ("mlp" attention), or None. It can
+        be computed once per batch and passed to `forward`.
+        """
+        if self.attn_type != "mlp":
+            return None
+        batch, src_len, dim = memory_bank.size()
+        uh = self.linear_context(memory_bank.contiguous().view(-1, dim))
+        return uh.view(batch, src_len, dim)
+
+    def score(self, h_t, h_s, memory_keys=None):
         """
         Args:
           h_t (`FloatTensor`): sequence of queries `[batch x tgt_len x dim]`
           h_s (`FloatTensor`): sequence of sources `[batch x src_len x dim]`
+          memory_keys (`FloatTensor`): `memory_keys(h_s)`, or None
 
         Returns:
           :obj:`FloatTensor`:
@@ -97,8 +111,9 @@ class GlobalAttention(nn.Module):
             wq = wq.view(tgt_batch, tgt_len, 1, dim)
             wq = wq.expand(tgt_batch, tgt_len, src_len, dim)
 
-            uh = self.linear_context(h_s.contiguous().view(-1, dim))
-            uh = uh.view(src_batch, 1, src_len, dim)
+            if memory_keys is None:
+                memory_keys = self.memory_keys(h_s)
+            uh = memory_keys.view(src_batch, 1, src_len, dim)
             uh = uh.expand(src_batch, tgt_len, src_len, dim)
 
             # (batch, t_len, s_len, d)
@@ -106,7 +121,8 @@ class GlobalAttention(nn.Module):
 
             return self.v(wquh.view(-1, dim)).view(tgt_batch, tgt_len, src_len)
 
-    def forward(self, input, memory_bank, memory_lengths=None, coverage=None):
+    def forward(self, input, memory_bank, memory_lengths=None, coverage=None,
+                memory_keys=None, pad_mask=None):
         """
 
         Args:
@@ -114,6 +130,11 @@ class GlobalAttention(nn.Module):
           memory_bank (`FloatTensor`): source vectors `[batch x src_len x dim]`
           memory_lengths (`LongTensor`): the source context lengths `[batch]`
           coverage (`FloatTensor`): None (not supported yet)
+          memory_keys (`FloatTensor`): see `memory_keys`; ignored with
+            coverage, which changes the memory bank
+          pad_mask (`ByteTensor`): 1 at the padding of the memory bank
+            `[batch x src_len]`, e.g. `DecoderMemory.pad_mask`; built from
+            `memory_lengths` (once for the same lengths) if not given
 
         Returns:
           (`FloatTensor`, `FloatTensor`):
@@ -144,14 +165,17 @@ class GlobalAttention(nn.Module):
             cover = coverage.view(-1).unsqueeze(1)
             memory_bank += self.linear_cover(cover).view_as(memory_bank)
             memory_bank = self.tanh(memory_bank)
+            memory_keys = None
 
         # compute attention scores, as in Luong et al.
-        align = self.score(input, memory_bank)
-
-        if memory_lengths is not None:
-            mask = sequence_mask(memory_lengths)
-            mask = mask.unsqueeze(1)  # Make it broadcastable.
-            align.data.masked_fill_(1 - mask, -float('inf'))
+        align = self.score(input, memory_bank, memory_keys)
+
+        if pad_mask is None and memory_lengths is not None:
+            pad_mask = self.mask_cache.get(memory_lengths, sourceL)
+        if pad_mask is not None:
+            # Make it broadcastable.
+            pad_mask = pad_mask.unsqueeze(1).expand_as(align.data)
+            align.data.masked_fill_(pad_mask, -float('inf'))
 
         # Softmax to normalize attention weights
         align_vectors = self.sm(align.view(batch*targetL, sourceL))
@@ -1,7 +1,6 @@
 import math
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 
 from onmt.Utils import aeq
 from onmt.modules.UtilClass import BottleLinear, BottleSoftmax
@@ -70,7 +69,14 @@ class MultiHeadedAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.res_dropout = nn.Dropout(dropout)
 
-    def forward(self, key, value, query, mask=None):
+    def project(self, key, value):
+        """
+        Project keys and values `[batch, key_len, dim]` for `forward`, e.g.
+        once for a memory bank, or once per position of a decoded prefix.
+        """
+        return self.linear_keys(key), self.linear_values(value)
+
+    def forward(self, key, value, query, mask=None, projected=None):
         """
         Compute the context vector and the attention vectors.
 
@@ -83,12 +89,17 @@ class MultiHeadedAttention(nn.Module):
                  query vectors  `[batch, query_len, dim]`
            mask: binary mask indicating which keys have
                  non-zero attention `[batch, query_len, key_len]`
+           projected: `project(key, value)`, if already computed; `key`
+                 and `value` are then not used
         Returns:
            (`FloatTensor`, `FloatTensor`) :
 
            * output context vectors `[batch, query_len, dim]`
            * one of the attention vectors `[batch, query_len, key_len]`
         """
+        if projected is None:
+            projected = self.project(key, value)
+        key, value = projected
 
         # CHECKS
         batch, k_len, d = key.size()
@@ -120,8 +131,8 @@ class MultiHeadedAttention(nn.Module):
                     .view(b, l, self.head_count * self.dim_per_head)
 
         residual = query
-        key_up = shape_projection(self.linear_keys(key))
-        value_up = shape_projection(self.linear_values(value))
+        key_up = shape_projection(key)
+        value_up = shape_projection(value)
         query_up = shape_projection(self.linear_query(query))
 
         scaled = torch.bmm(query_up, key_up.transpose(1, 2))
@@ -129,18 +140,18 @@ class MultiHeadedAttention(nn.Module):
         bh, l, dim_per_head = scaled.size()
         b = bh // self.head_count
         if mask is not None:
-
-            scaled = scaled.view(b, self.head_count, l, dim_per_head)
-            mask = mask.unsqueeze(1).expand_as(scaled)
-            scaled = scaled.masked_fill(Variable(mask), -1e18) \
-                           .view(bh, l, dim_per_head)
+            # In place: the mask is a view of the padding mask of the batch
+            # (e.g. `DecoderMemory.pad_mask`) expanded over the heads
+            mask = mask.unsqueeze(1).expand(b, self.head_count, l, dim_per_head)
+            scaled.data.view(b, self.head_count, l, dim_per_head) \
+                .masked_fill_(mask, -1e18)
         attn = self.sm(scaled)
         # Return one attn
         top_attn = attn \
             .view(b, self.head_count, l, dim_per_head)[:, 0, :, :] \
             .contiguous()
 
-        drop_attn = self.dropout(self.sm(scaled))
+        drop_attn = self.dropout(attn)
 
         # values : (batch * 8) x qlen x dim
         out = unshape_projection(torch.bmm(drop_attn, value_up), residual)
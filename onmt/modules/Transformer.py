@@ -2,6 +2,7 @@
 Implementation of "Attention is All You Need"
 """
 
+import copy
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
@@ -9,12 +10,17 @@ import numpy as np
 
 import onmt
 from onmt.Models import EncoderBase
-from onmt.Models import DecoderState
-from onmt.Utils import aeq
+from onmt.Models import DecoderState, DecoderMemory
+from onmt.Utils import aeq, padding_mask, select_rows
 
 MAX_SIZE = 5000
 
 
+def _words(input):
+    """Word indices `[len x batch]` of an input with or without features."""
+    return input[:, :, 0] if input.dim() == 3 else input
+
+
 class PositionwiseFeedForward(nn.Module):
     """ A two-layer Feed-Forward-Network with residual layer norm.
 
@@ -163,28 +169,49 @@ class TransformerDecoderLayer(nn.Module):
         # it gets TransformerDecoderLayer's cuda behavior automatically.
         self.register_buffer('mask', mask)
 
-    def forward(self, input, memory_bank, src_pad_mask, tgt_pad_mask):
+    def forward(self, input, memory_bank, src_pad_mask, tgt_pad_mask,
+                layer_cache=None, memory_kv=None):
+        """
+        Args:
+            layer_cache (dict): keys and values of the self-attention for the
+                previous positions, or None. `input` holds the positions
+                that follow them, and their keys and values are added.
+            memory_kv: keys and values of `memory_bank` projected for the
+                context attention, or None
+        """
         # Args Checks
         input_batch, input_len, _ = input.size()
         contxt_batch, contxt_len, _ = memory_bank.size()
         aeq(input_batch, contxt_batch)
 
         src_batch, t_len, s_len = src_pad_mask.size()
-        tgt_batch, t_len_, t_len__ = tgt_pad_mask.size()
+        tgt_batch, t_len_, key_len = tgt_pad_mask.size()
         aeq(input_batch, contxt_batch, src_batch, tgt_batch)
-        aeq(t_len, t_len_, t_len__, input_len)
+        aeq(t_len, t_len_, input_len)
         aeq(s_len, contxt_len)
         # END Args Checks
 
-        dec_mask = torch.gt(tgt_pad_mask + self.mask[:, :tgt_pad_mask.size(1),
-                            :tgt_pad_mask.size(1)]
+        # Positions of the input among the keys
+        offset = key_len - input_len
+        dec_mask = torch.gt(tgt_pad_mask + self.mask[:, offset:key_len,
+                            :key_len]
                             .expand_as(tgt_pad_mask), 0)
         input_norm = self.layer_norm_1(input)
-        query, attn = self.self_attn(input_norm, input_norm, input_norm,
-                                     mask=dec_mask)
+        if layer_cache is None:
+            query, attn = self.self_attn(input_norm, input_norm, input_norm,
+                                         mask=dec_mask)
+        else:
+            keys, values = self.self_attn.project(input_norm, input_norm)
+            if layer_cache:
+                keys = torch.cat([layer_cache["keys"], keys], 1)
+                values = torch.cat([layer_cache["values"], values], 1)
+            layer_cache["keys"], layer_cache["values"] = keys, values
+            query, attn = self.self_attn(None, None, input_norm,
+                                         mask=dec_mask,
+                                         projected=(keys, values))
         query_norm = self.layer_norm_2(query+input)
         mid, attn = self.context_attn(memory_bank, memory_bank, query_norm,
-                                      mask=src_pad_mask)
+                                      mask=src_pad_mask, projected=memory_kv)
         output = self.feed_forward(mid+query+input)
 
         # CHECKS
@@ -265,7 +292,7 @@ class TransformerDecoder(nn.Module):
         """
         # CHECKS
         assert isinstance(state, TransformerDecoderState)
-        tgt_len, tgt_batch, _ = tgt.size()
+        tgt_len, tgt_batch = tgt.size()[:2]
         memory_len, memory_batch, _ = memory_bank.size()
         aeq(tgt_batch, memory_batch)
 
@@ -273,8 +300,8 @@ class TransformerDecoder(nn.Module):
             tgt = torch.cat([state.previous_input, tgt], 0)
 
         src = state.src
-        src_words = src[:, :, 0].transpose(0, 1)
-        tgt_words = tgt[:, :, 0].transpose(0, 1)
+        src_words = _words(src).transpose(0, 1)
+        tgt_words = _words(tgt).transpose(0, 1)
         src_batch, src_len = src_words.size()
         tgt_batch, tgt_len = tgt_words.size()
         aeq(tgt_batch, memory_batch, src_batch, tgt_batch)
@@ -325,8 +352,76 @@ class TransformerDecoder(nn.Module):
     def init_decoder_state(self, src, memory_bank, enc_hidden):
         return TransformerDecoderState(src)
 
+    def init_decoder_memory(self, memory_bank, memory_lengths=None):
+        """Prepare `memory_bank` `[src_len x batch x hidden]` for
+        `decode_step`: its keys and values are projected once for the
+        context attention of each layer.
+        """
+        bank = memory_bank.transpose(0, 1).contiguous()
+        keys = [layer.context_attn.project(bank, bank)
+                for layer in self.transformer_layers]
+        if memory_lengths is not None:
+            pad_mask = padding_mask(memory_lengths, bank.size(1))
+        else:
+            # A comparison, so that the mask has the type of padding_mask
+            pad_mask = bank.data.new(bank.size(0), bank.size(1)).zero_().ne(0)
+        return DecoderMemory(bank, memory_lengths, keys, pad_mask)
+
+    def decode_step(self, input, memory, state):
+        """
+        Run the decoder on the next token of each row `[1 x batch]`, as
+        `forward` does, but attend to the keys and values of the previous
+        tokens cached in `state` instead of running the decoder on them
+        again: a step costs time linear in the number of previous tokens.
+
+        Returns:
+            (`FloatTensor`, :obj:`TransformerDecoderState`, dict):
+                the output `[batch x hidden]`, the state and the attention
+                distributions `{"std": [batch x src_len]}`
+        """
+        assert isinstance(state, TransformerDecoderState)
+        if state.cache is None:
+            # Tokens decoded by forward() are not cached yet
+            state.cache = [{} for _ in self.transformer_layers]
+            if state.previous_input is not None:
+                input = torch.cat([state.previous_input, input], 0)
+                state.previous_input = None
+        step = 0
+        tgt = input
+        if state.previous_input is not None:
+            step = state.previous_input.size(0)
+            tgt = torch.cat([state.previous_input, input], 0)
+
+        input_words = _words(input)
+        input_len, batch = input_words.size()
+        tgt_len = tgt.size(0)
+        bank = memory.banks
+        src_len = bank.size(1)
+
+        padding_idx = self.embeddings.word_padding_idx
+        tgt_pad_mask = _words(tgt).data.transpose(0, 1).eq(padding_idx) \
+            .unsqueeze(1).expand(batch, input_len, tgt_len)
+        src_pad_mask = memory.pad_mask.unsqueeze(1) \
+            .expand(batch, input_len, src_len)
+
+        emb = self.embeddings(input, step=step)
+        output = emb.transpose(0, 1).contiguous()
+        for layer, layer_cache, memory_kv in zip(self.transformer_layers,
+                                                 state.cache, memory.keys):
+            output, attn = layer(output, bank, src_pad_mask, tgt_pad_mask,
+                                 layer_cache=layer_cache, memory_kv=memory_kv)
+        output = self.layer_norm(output[:, -1])
+
+        state.update_state(tgt, state.cache)
+        attns = {"std": attn[:, -1]}
+        if self._copy:
+            attns["copy"] = attns["std"]
+        return output, state, attns
+
 
 class TransformerDecoderState(DecoderState):
+    # No `cat`: rows decoded for different numbers of steps would need their
+    # own positions and self-attention masks
     def __init__(self, src):
         """
         Args:
@@ -335,6 +430,9 @@ class TransformerDecoderState(DecoderState):
         """
         self.src = src
         self.previous_input = None
+        # Keys and values of the self-attention of each layer
+        # `[batch x len x dim]`, kept by decode_step()
+        self.cache = None
 
     @property
     def _all(self):
@@ -343,11 +441,45 @@ class TransformerDecoderState(DecoderState):
         """
         return (self.previous_input, self.src)
 
-    def update_state(self, input):
-        """ Called for every decoder forward pass. """
+    @property
+    def _cached(self):
+        return [v for layer_cache in self.cache or [] for v in layer_cache.values()]
+
+    def update_state(self, input, cache=None):
+        """ Called for every decoder forward pass. `cache` holds the keys
+        and values of `input` (see decode_step); without it the cache is
+        stale, and is dropped so that the next decode_step rebuilds it. """
         self.previous_input = input
+        self.cache = cache
+
+    def beam_update(self, idx, positions, beam_size):
+        # Batch is the second dimension of the inputs, and the first one of
+        # the cache
+        for e, dim in [(e, 1) for e in self._all if e is not None] + \
+                [(e, 0) for e in self._cached]:
+            size = list(e.size())
+            sent_states = e.view(*(size[:dim] + [beam_size, -1] + size[dim + 1:])) \
+                .select(dim + 1, idx)
+            sent_states.data.copy_(
+                sent_states.data.index_select(dim, positions))
 
     def repeat_beam_size_times(self, beam_size):
         """ Repeat beam_size times along batch dimension. """
-        self.src = Variable(self.src.data.repeat(1, beam_size, 1),
-                            volatile=True)
+        def repeat(e, dim):
+            sizes = [1] * e.dim()
+            sizes[dim] = beam_size
+            return Variable(e.data.repeat(*sizes), volatile=True)
+        self.src = repeat(self.src, 1)
+        if self.previous_input is not None:
+            self.previous_input = repeat(self.previous_input, 1)
+        for layer_cache in self.cache or []:
+            for k in layer_cache:
+                layer_cache[k] = repeat(layer_cache[k], 0)
+
+    def index_select(self, index):
+        """ The state of the rows `index` of the batch. """
+        state = copy.copy(self)
+        state.src = select_rows(self.src, index, 1)
+        state.previous_input = select_rows(self.previous_input, index, 1)
+        state.cache = select_rows(self.cache, index)
+        return state
@@ -0,0 +1,72 @@
+'''
+Report import time of entry-point modules, similar to `python -X importtime`
+(which Python 2 does not have), and check it against a budget.
+
+Each module is imported in a fresh interpreter. Run from a task directory,
+e.g. in craigslistbargain/:
+    PYTHONPATH=..:. python ../scripts/benchmark_imports.py core.tokenizer systems --budget 2
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Runs in the child interpreter: wrap __import__ and time every first import
+_PROFILE = r'''
+import __builtin__, json, sys, time
+_import = __builtin__.__import__
+times = {}
+stack = []
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = set(sys.modules)
+    start = time.time()
+    stack.append(0.)
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        nested = stack.pop()
+        elapsed = time.time() - start
+        if stack:
+            stack[-1] += elapsed
+        if len(sys.modules) > len(before):
+            times[name] = (elapsed - nested, elapsed)
+__builtin__.__import__ = timed_import
+start = time.time()
+__import__(sys.argv[1])
+total = time.time() - start
+__builtin__.__import__ = _import
+print json.dumps({'total': total, 'modules': times})
+'''
+
+def profile_import(module):
+    output = subprocess.check_output([sys.executable, '-c', _PROFILE, module], env=os.environ)
+    return json.loads(output.strip().split('\n')[-1])
+
+def print_report(module, result, top):
+    print '{}: {:.3f}s'.format(module, result['total'])
+    print '  {:>10} {:>10}  {}'.format('self [us]', 'cumul [us]', 'imported module')
+    modules = sorted(result['modules'].iteritems(), key=lambda x: x[1][1], reverse=True)
+    for name, (self_time, cumulative) in modules[:top]:
+        print '  {:>10d} {:>10d}  {}'.format(int(self_time * 1e6), int(cumulative * 1e6), name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='+', help='Modules to import (entry points)')
+    parser.add_argument('--budget', type=float, default=None, help='Fail if any import takes longer (seconds)')
+    parser.add_argument('--repeat', type=int, default=3, help='Report the fastest of this many runs')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to show')
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        results = [profile_import(module) for _ in xrange(args.repeat)]
+        result = min(results, key=lambda r: r['total'])
+        print_report(module, result, args.top)
+        if args.budget is not None and result['total'] > args.budget:
+            over_budget.append(module)
+
+    if over_budget:
+        print 'Over budget ({}s): {}'.format(args.budget, ' '.join(over_budget))
+        sys.exit(1)
@@ -0,0 +1,78 @@
+'''
+Compare the NLTK-style n-gram model with the array-backed one on template
+scoring and per-turn policy lookup.
+'''
+
+import argparse
+import random
+import time
+import numpy as np
+
+from cocoa.core.util import read_pickle
+from cocoa.model.counter import build_vocabulary, count_ngrams, count_ngrams_array
+from cocoa.model.ngram import MLENgramModel, ArrayNgramModel
+
+def random_sequences(num_sequences, vocab_size, max_len):
+    vocab = ['w%d' % i for i in xrange(vocab_size)]
+    return [[random.choice(vocab) for _ in xrange(random.randint(1, max_len))] for _ in xrange(num_sequences)]
+
+def timeit(f, repeat=1):
+    start = time.time()
+    for _ in xrange(repeat):
+        result = f()
+    return (time.time() - start) / repeat, result
+
+def benchmark_scoring(sequences, n):
+    vocab = build_vocabulary(1, *sequences)
+
+    t_count, counter = timeit(lambda: count_ngrams(n, vocab, sequences, pad_left=True, pad_right=False))
+    t_count_array, array_counter = timeit(lambda: count_ngrams_array(n, vocab, sequences, pad_left=True, pad_right=False))
+    model = MLENgramModel(counter)
+    array_model = ArrayNgramModel(array_counter)
+
+    t_score, scores = timeit(lambda: [-1.*model.entropy(s)*len(s) for s in sequences])
+    lengths = np.array([len(s) for s in sequences])
+    t_score_array, array_scores = timeit(lambda: -1. * array_model.entropies(sequences) * lengths)
+    assert np.allclose(scores, array_scores)
+
+    print 'Template scoring ({} sequences)'.format(len(sequences))
+    print 'count: {:.4f}s -> {:.4f}s'.format(t_count, t_count_array)
+    print 'score: {:.4f}s -> {:.4f}s'.format(t_score, t_score_array)
+
+def benchmark_policy(model, num_turns):
+    array_model = ArrayNgramModel.from_model(model)
+    actions = [w for w in array_model.ngram_counter.words]
+    contexts = [tuple(random.choice(actions) for _ in xrange(model.order - 1)) for _ in xrange(num_turns)]
+
+    t_lookup, dists = timeit(lambda: [sorted(model.freqdist(c)) for c in contexts])
+    t_lookup_array, array_dists = timeit(lambda: [sorted(array_model.freqdist(c)) for c in contexts])
+    assert dists == array_dists
+
+    print 'Policy lookup ({} turns)'.format(num_turns)
+    print 'freqdist: {:.2f}us -> {:.2f}us per turn'.format(t_lookup / num_turns * 1e6, t_lookup_array / num_turns * 1e6)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--templates', help='Path to pickled templates (default: random sequences)')
+    parser.add_argument('--policy', help='Path to pickled manager (default: trained on random sequences)')
+    parser.add_argument('--num-sequences', type=int, default=20000)
+    parser.add_argument('--num-turns', type=int, default=10000)
+    parser.add_argument('-n', type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    if args.templates:
+        templates = read_pickle(args.templates)
+        sequences = [s.split() for s in templates.template.values]
+    else:
+        sequences = random_sequences(args.num_sequences, 1000, 20)
+    benchmark_scoring(sequences, args.n)
+
+    if args.policy:
+        model = read_pickle(args.policy)['model']
+    else:
+        sequences = random_sequences(5000, 15, 15)
+        vocab = build_vocabulary(1, *sequences)
+        model = MLENgramModel(count_ngrams(args.n, vocab, sequences, pad_left=True, pad_right=False))
+    benchmark_policy(model, args.num_turns)